@@ -0,0 +1,60 @@
+"""
+Time to compute chart stats for a freshly added pack.
+
+Writes a synthetic pack of N songs (five charts each, mixing 8th and 16th
+measures, BPM changes and stops) to a temporary directory, then computes
+stats for all of it the way the /add_pack embed does: once with an empty
+stats cache, and once more with every chart cached (which reads no
+simfiles).
+
+    python -m benchmarks.analytics_bench [--songs 100] [--measures 96]
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.synthetic import simfile
+from itg_buddy.extensions.itg_cli.analytics import ChartAnalytics
+from itg_buddy.extensions.itg_cli.headers import read_headers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--songs", type=int, default=100)
+    parser.add_argument("--measures", type=int, default=96)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as root:
+        pack = Path(root, "Benchmark Pack")
+        for i in range(args.songs):
+            song_dir = pack.joinpath(f"Song {i}")
+            song_dir.mkdir(parents=True)
+            song_dir.joinpath("song.sm").write_text(
+                simfile(rng, f"Song {i}", args.measures)
+            )
+        # With fingerprints, as they come from the library index
+        simfiles = [
+            read_headers(p, fingerprints=True) for p in pack.glob("*/song.sm")
+        ]
+        analytics = ChartAnalytics(Path(root, "analytics.db"))
+
+        start = time.perf_counter()
+        stats = analytics.stats(simfiles)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        analytics.stats(simfiles)
+        warm = time.perf_counter() - start
+
+    charts = sum(len(s) for s in stats.values())
+    print(f"songs:    {len(stats)}")
+    print(f"charts:   {charts}")
+    print(f"uncached: {cold * 1000:.0f} ms")
+    print(f"cached:   {warm * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
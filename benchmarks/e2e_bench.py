@@ -0,0 +1,376 @@
+"""
+End-to-end latency of the add-pack and add-song paths, offline.
+
+Generates synthetic packs and songs (see synthetic.py), serves their
+archives from a local, bandwidth-capped HTTP server (see file_server.py) and
+runs a real ItgCliCog against fake Discord objects (see fake_discord.py)
+in temporary directories. Each scenario issues its commands, at most
+--concurrency at once, through the cog's own entry points:
+
+    pack     /add_pack, once per pack (ItgCliCog.add_pack)
+    song     /add_song, once per song (ItgCliCog._add_song_helper)
+    message  zips posted to the add-song channel, --batch per message
+             (ItgCliCog.on_message)
+
+Reports the cog's cold start (importing, constructing and warming it up)
+and the latency of its first command, then throughput, p50/p99 command
+latency, Discord calls per command, time spent in each stage and peak RSS.
+With --max-first-response, exits with status 1 if the cold start plus the
+first command took longer than that many seconds. --save writes the results
+to a JSON file; --compare prints them next to a saved run, e.g. one from
+before a change. The cog's usual environment variables (INSTALL_WORKERS,
+JOB_CONCURRENCY, ...) apply; the paths it uses are overridden.
+
+    python -m benchmarks.e2e_bench [--packs 4] [--songs 20] [--charts 5]
+        [--banner-kb 100] [--audio-kb 1000] [--bandwidth-mbps 100]
+        [--latency-ms 50] [--max-first-response SECONDS] [--save FILE]
+        [--compare FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import discord
+from discord.ext import commands
+
+from benchmarks.fake_discord import (
+    DiscordLog,
+    FakeAttachment,
+    FakeChannel,
+    FakeInteraction,
+    FakeMessage,
+    FakeUser,
+)
+from benchmarks.file_server import FileServer
+from benchmarks.synthetic import write_pack, write_song, write_zip
+
+SCENARIOS = ["pack", "song", "message"]
+CHANNEL_ID = 42
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(round(p * (len(values) - 1)), len(values) - 1)]
+
+
+def build_archives(root: Path, args) -> dict[str, list[Path]]:
+    """
+    Zips to add in each scenario, plus a song to warm up with, all with
+    distinct songs.
+    """
+    rng = random.Random(args.seed)
+    src = root.joinpath("src")
+    archives = {scenario: [] for scenario in SCENARIOS}
+    song_args = (
+        args.measures,
+        args.charts,
+        args.banner_kb * 1000,
+        args.audio_kb * 1000,
+    )
+    for i in range(args.packs):
+        pack_dir = src.joinpath(f"Benchmark Pack {i}")
+        write_pack(rng, pack_dir, args.songs, *song_args)
+        archives["pack"].append(
+            write_zip(pack_dir, root.joinpath(f"pack-{i}.zip"))
+        )
+    song_counts = {"song": args.singles, "message": args.singles}
+    for scenario, count in (song_counts | {"warmup": 1}).items():
+        archives.setdefault(scenario, [])
+        for i in range(count):
+            song_dir = src.joinpath(scenario, f"Benchmark {scenario} {i}")
+            write_song(rng, song_dir, song_dir.name, *song_args)
+            archives[scenario].append(
+                write_zip(song_dir, root.joinpath(f"{scenario}-{i}.zip"))
+            )
+    return archives
+
+
+def make_cog(root: Path):
+    """An ItgCliCog with its library, data and cache under `root`."""
+    # Imported here, after the environment is set up, and timed as part of
+    # the cold start
+    from itg_buddy.extensions.itg_cli import ItgCliCog
+
+    for name in ("Songs/Singles", "Courses", "Cache", "data"):
+        root.joinpath(name).mkdir(parents=True)
+    os.environ.update(
+        PACKS_PATH=str(root.joinpath("Songs")),
+        COURSES_PATH=str(root.joinpath("Courses")),
+        SINGLES_FOLDER_NAME="Singles",
+        ITGMANIA_CACHE_PATH=str(root.joinpath("Cache")),
+        ADD_SONG_CHANNEL_ID=str(CHANNEL_ID),
+        DATA_PATH=str(root.joinpath("data")),
+    )
+    os.environ.pop("METRICS_PORT", None)
+    bot = commands.Bot(
+        command_prefix="!", intents=discord.Intents.none(), help_command=None
+    )
+    return ItgCliCog(bot)
+
+
+async def run_commands(
+    commands: list[Callable[[], Awaitable[FakeChannel]]], concurrency: int
+) -> tuple[list[float], int, float]:
+    """
+    Runs `commands`, each returning the channel its result goes to, at most
+    `concurrency` at once. Returns the latencies of the ones that posted a
+    result, the number that didn't, and the wall time.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failed = 0
+
+    async def run(command):
+        nonlocal failed
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                channel = await command()
+            except Exception as e:
+                print(f"  command failed: {e!r}")
+                failed += 1
+                return
+            if channel.sent:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(command) for command in commands))
+    return latencies, failed, time.perf_counter() - start
+
+
+def scenario_commands(
+    cog, scenario: str, urls: list[str], log: DiscordLog, batch: int
+) -> list[Callable[[], Awaitable[FakeChannel]]]:
+    user = FakeUser(7)
+
+    def add_pack(url):
+        async def command():
+            channel = FakeChannel(log, CHANNEL_ID)
+            inter = FakeInteraction(log, channel, user)
+            await cog.add_pack.callback(cog, inter, url)
+            return channel
+
+        return command
+
+    def add_song(url):
+        async def command():
+            channel = FakeChannel(log, CHANNEL_ID)
+            await cog._add_song_helper(
+                FakeInteraction(log, channel, user), url
+            )
+            return channel
+
+        return command
+
+    def post(urls):
+        async def command():
+            channel = FakeChannel(log, CHANNEL_ID)
+            attachments = [
+                FakeAttachment(url, url.rsplit("/")[-1]) for url in urls
+            ]
+            await cog.on_message(FakeMessage(log, channel, user, attachments))
+            return channel
+
+        return command
+
+    if scenario == "pack":
+        return [add_pack(url) for url in urls]
+    if scenario == "song":
+        return [add_song(url) for url in urls]
+    return [post(urls[i : i + batch]) for i in range(0, len(urls), batch)]
+
+
+async def run(args) -> dict:
+    results = {"args": vars(args), "scenarios": {}}
+    with tempfile.TemporaryDirectory() as temp:
+        root = Path(temp)
+        start = time.perf_counter()
+        archives = build_archives(root, args)
+        print(f"Generated archives in {time.perf_counter() - start:.1f} s")
+        rate = args.bandwidth_mbps * 1_000_000 / 8 or None
+        with FileServer(str(root), rate) as server:
+            start = time.perf_counter()
+            cog = make_cog(root.joinpath("machine"))
+            # What the cog does once the bot is ready, except resuming jobs,
+            # which needs a bot that's logged in
+            await cog._warm_up()
+            results["cold_start"] = time.perf_counter() - start
+            from itg_buddy.extensions.itg_cli.edits import EDIT_SCHEDULER
+            from itg_buddy.extensions.itg_cli.metrics import STAGE_SECONDS
+
+            log = DiscordLog(latency=args.latency_ms / 1000)
+            try:
+                # The first command also waits for the install workers to
+                # finish starting, so it's timed on its own
+                warmup = f"{server.url}/{archives['warmup'][0].name}"
+                print("Warming up...")
+                latencies, _, _ = await run_commands(
+                    scenario_commands(cog, "song", [warmup], log, 1), 1
+                )
+                results["first_command"] = latencies[0] if latencies else None
+                for scenario in args.scenarios:
+                    paths = archives[scenario]
+                    urls = [f"{server.url}/{p.name}" for p in paths]
+                    calls = log.calls.copy()
+                    edits = asdict(EDIT_SCHEDULER.stats)
+                    print(f"Running {scenario} ({len(urls)} archives)...")
+                    latencies, failed, wall = await run_commands(
+                        scenario_commands(
+                            cog, scenario, urls, log, args.batch
+                        ),
+                        args.concurrency,
+                    )
+                    commands = len(latencies) + failed
+                    size = sum(p.stat().st_size for p in paths)
+                    results["scenarios"][scenario] = {
+                        "commands": commands,
+                        "failed": failed,
+                        "seconds": wall,
+                        "commands_per_second": commands / wall,
+                        "mb_per_second": size / 1_000_000 / wall,
+                        "p50": percentile(latencies, 0.5),
+                        "p99": percentile(latencies, 0.99),
+                        "discord_calls": dict(log.calls - calls),
+                        "edits": {
+                            key: value - edits[key]
+                            for key, value in asdict(
+                                EDIT_SCHEDULER.stats
+                            ).items()
+                        },
+                    }
+            finally:
+                await cog.cog_unload()
+    results["stages"] = {
+        labels["stage"]: {"count": s.count, "p50": s.p50, "p99": s.p99}
+        for labels, s in STAGE_SECONDS.summaries()
+    }
+    results["peak_rss_mb"] = {
+        "bot": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "workers": (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        ),
+    }
+    try:
+        results["commit"] = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        results["commit"] = None
+    return results
+
+
+def rows(results: dict) -> dict[str, float]:
+    """The numbers worth comparing between runs, flattened."""
+    flat = {}
+    if results.get("cold_start") is not None:
+        flat["cold start"] = results["cold_start"]
+    if results.get("first_command") is not None:
+        flat["first command"] = results["first_command"]
+    for scenario, r in results["scenarios"].items():
+        for key in ("commands_per_second", "mb_per_second", "p50", "p99"):
+            flat[f"{scenario} {key}"] = r[key]
+        flat[f"{scenario} failed"] = r["failed"]
+        flat[f"{scenario} discord calls/command"] = sum(
+            r["discord_calls"].values()
+        ) / max(r["commands"], 1)
+        flat[f"{scenario} edits sent"] = r["edits"]["sent"]
+    for stage, s in results["stages"].items():
+        flat[f"stage {stage} p50"] = s["p50"]
+    for process, mb in results["peak_rss_mb"].items():
+        flat[f"peak rss {process} (MB)"] = mb
+    return flat
+
+
+def print_results(results: dict, baseline: dict | None) -> None:
+    current = rows(results)
+    before = rows(baseline) if baseline else {}
+    width = max(map(len, current))
+    if baseline:
+        print(f"{'':{width}}  {'baseline':>10}  {'current':>10}  change")
+        print(
+            f"{'':{width}}  {baseline.get('commit') or '':>10}  "
+            f"{results.get('commit') or '':>10}"
+        )
+    for key, value in current.items():
+        line = f"{key:{width}}  "
+        if baseline:
+            old = before.get(key)
+            line += f"{old:>10.3f}  " if old is not None else f"{'-':>10}  "
+        line += f"{value:>10.3f}"
+        if baseline and old:
+            line += f"  {(value - old) / old:+.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS
+    )
+    parser.add_argument("--packs", type=int, default=4)
+    parser.add_argument("--songs", type=int, default=20, help="per pack")
+    parser.add_argument(
+        "--singles", type=int, default=8, help="songs per song scenario"
+    )
+    parser.add_argument("--batch", type=int, default=4, help="zips/message")
+    parser.add_argument("--charts", type=int, default=5)
+    parser.add_argument("--measures", type=int, default=96)
+    parser.add_argument("--banner-kb", type=int, default=100)
+    parser.add_argument("--audio-kb", type=int, default=1000)
+    parser.add_argument(
+        "--bandwidth-mbps",
+        type=float,
+        default=100,
+        help="per connection, 0 for no cap",
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=50, help="per Discord API call"
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--max-first-response",
+        type=float,
+        help="seconds allowed for the cold start plus the first command",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", type=Path, help="write results here")
+    parser.add_argument("--compare", type=Path, help="saved results")
+    args = parser.parse_args()
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    results = asyncio.run(run(args))
+    print_results(results, baseline)
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2, default=str))
+    if args.max_first_response is not None:
+        first_response = results["cold_start"] + (
+            results["first_command"] or float("inf")
+        )
+        if first_response > args.max_first_response:
+            print(
+                f"First response took {first_response:.2f} s, over the "
+                f"{args.max_first_response:.2f} s allowed"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
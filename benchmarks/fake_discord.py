@@ -0,0 +1,162 @@
+"""
+Stand-ins for the discord.py objects the bot's commands receive.
+
+FakeInteraction and FakeMessage pass the bot's isinstance checks, answer
+every call it makes on them after a configurable API latency, and record
+each call in a shared DiscordLog. Channels keep the titles of the embeds
+sent to them, so a benchmark can tell which commands posted a result.
+"""
+
+import asyncio
+import itertools
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+import discord
+
+IDS = itertools.count(1_000_000)
+
+
+@dataclass
+class DiscordLog:
+    """Calls made against the fakes, shared by all of them."""
+
+    # Seconds each API call waits before returning, like a round trip
+    latency: float = 0.0
+    calls: Counter = field(default_factory=Counter)
+    # Bytes of files sent with messages
+    uploaded: int = 0
+
+    async def call(self, name: str) -> None:
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+@dataclass
+class FakeUser:
+    id: int
+    name: str = "benchmark"
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeChannel:
+    def __init__(self, log: DiscordLog, id: int):
+        self.log = log
+        self.id = id
+        # Titles of the embeds sent here
+        self.sent: list[str] = []
+
+    async def send(
+        self,
+        content: Optional[str] = None,
+        *,
+        embed: Optional[discord.Embed] = None,
+        file: Optional[discord.File] = None,
+        **kwargs,
+    ) -> "FakeMessage":
+        await self.log.call("send")
+        if embed is not None:
+            self.sent.append(embed.title or "")
+        if file is not None:
+            self.log.uploaded += len(file.fp.read())
+        return FakeMessage(self.log, self, FakeUser(0, "itg-buddy"))
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def defer(self, **kwargs) -> None:
+        await self.interaction.log.call("defer")
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs) -> None:
+        await self.interaction.log.call("send_message")
+        self.done = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs) -> None:
+        await self.interaction.log.call("followup")
+
+
+class FakeInteraction(discord.Interaction):
+    """A slash command invocation by `user` in `channel`."""
+
+    def __init__(self, log: DiscordLog, channel: FakeChannel, user: FakeUser):
+        self.log = log
+        self.id = next(IDS)
+        self.channel = channel
+        self.user = user
+        self._response = FakeResponse(self)
+
+    @property
+    def channel_id(self) -> int:
+        return self.channel.id
+
+    @property
+    def response(self) -> FakeResponse:
+        return self._response
+
+    @property
+    def followup(self) -> FakeFollowup:
+        return FakeFollowup(self)
+
+    async def edit_original_response(self, **kwargs) -> None:
+        await self.log.call("edit")
+
+    async def delete_original_response(self) -> None:
+        await self.log.call("delete")
+
+
+@dataclass
+class FakeAttachment:
+    url: str
+    filename: str
+    content_type: str = "application/zip"
+
+
+class FakeMessage(discord.Message):
+    """A message by `author` in `channel`, with `attachments`."""
+
+    def __init__(
+        self,
+        log: DiscordLog,
+        channel: FakeChannel,
+        author: FakeUser,
+        attachments: list[FakeAttachment] = [],
+    ):
+        self.log = log
+        self.id = next(IDS)
+        self.channel = channel
+        self.author = author
+        self.attachments = attachments
+
+    async def reply(self, content=None, **kwargs) -> "FakeMessage":
+        await self.log.call("reply")
+        return FakeMessage(self.log, self.channel, FakeUser(0, "itg-buddy"))
+
+    async def edit(self, **kwargs) -> None:
+        await self.log.call("edit")
+
+    async def delete(self, **kwargs) -> None:
+        await self.log.call("delete")
@@ -0,0 +1,102 @@
+"""
+A local HTTP server for benchmark archives.
+
+Serves a directory with single-range requests (which archive previews and
+segmented downloads rely on) and caps each connection's bandwidth, so
+downloads take a realistic share of a job rather than finishing instantly.
+"""
+
+import http.server
+import os
+import re
+import threading
+import time
+from functools import partial
+from typing import Optional
+
+CHUNK_SIZE = 64 * 1024
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    # Bytes per second per connection, or None for no cap
+    rate: Optional[float] = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        # Bytes left to send of a range response
+        self.remaining = None
+        path = self.translate_path(self.path)
+        match = RANGE.match(self.headers.get("Range", ""))
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        first, last = match.groups()
+        if first == "":
+            start, end = max(size - int(last or 0), 0), size - 1
+        else:
+            start, end = int(first), min(int(last or size - 1), size - 1)
+        if start > end:
+            self.send_error(416)
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.remaining = end - start + 1
+        return f
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def guess_type(self, path):
+        if str(path).endswith(".zip"):
+            return "application/zip"
+        return super().guess_type(path)
+
+    def copyfile(self, source, outputfile):
+        remaining = self.remaining
+        start = time.monotonic()
+        sent = 0
+        while remaining is None or remaining > 0:
+            n = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            data = source.read(n)
+            if not data:
+                break
+            outputfile.write(data)
+            sent += len(data)
+            if remaining is not None:
+                remaining -= len(data)
+            if self.rate:
+                delay = sent / self.rate - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class FileServer:
+    """Serves `root` on 127.0.0.1 from a background thread."""
+
+    def __init__(self, root: str, rate: Optional[float] = None):
+        handler = type("Handler", (Handler,), {"rate": rate})
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(handler, directory=root)
+        )
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="file-server", daemon=True
+        )
+
+    def __enter__(self) -> "FileServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
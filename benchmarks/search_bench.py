@@ -0,0 +1,103 @@
+"""
+Autocomplete latency of the /search index on a synthetic library.
+
+Builds a SearchIndex over N songs with made-up titles, artists and packs,
+then replays what typing does: every prefix of a sample of titles and
+artists, searched in turn. Reports build time and search latency
+percentiles.
+
+    python -m benchmarks.search_bench [--songs 20000] [--queries 500]
+"""
+
+import argparse
+import random
+import statistics
+import time
+from pathlib import Path
+
+from itg_buddy.extensions.itg_cli.headers import ChartHeader, SimfileHeader
+from itg_buddy.extensions.itg_cli.search import SearchIndex
+
+SYLLABLES = (
+    "ka ra mi do re so la ti na ne no yu ki ha ru be at on in er an or "
+    "ex st ch sh th ng ly ic al ze vo da ge pi lu mo"
+).split()
+DIFFICULTIES = ["Beginner", "Easy", "Medium", "Hard", "Challenge"]
+
+
+def word(rng: random.Random) -> str:
+    return "".join(rng.choices(SYLLABLES, k=rng.randint(1, 4))).capitalize()
+
+
+def phrase(rng: random.Random, words: tuple[int, int]) -> str:
+    return " ".join(word(rng) for _ in range(rng.randint(*words)))
+
+
+def library(songs: int, seed: int = 0) -> list[SimfileHeader]:
+    rng = random.Random(seed)
+    packs = [phrase(rng, (1, 3)) for _ in range(max(songs // 50, 1))]
+    artists = [phrase(rng, (1, 2)) for _ in range(max(songs // 5, 1))]
+    simfiles = []
+    for i in range(songs):
+        title = phrase(rng, (1, 4))
+        song_dir = Path("/Songs", rng.choice(packs), f"{title} {i}")
+        charts = [
+            ChartHeader("dance-single", d, str(rng.randint(1, 20)), None)
+            for d in rng.sample(DIFFICULTIES, rng.randint(1, 5))
+        ]
+        simfiles.append(
+            SimfileHeader(
+                dir=song_dir,
+                path=song_dir / "song.ssc",
+                title=title,
+                titletranslit=None,
+                artist=rng.choice(artists),
+                banner=None,
+                charts=charts,
+            )
+        )
+    return simfiles
+
+
+def typed_queries(simfiles: list[SimfileHeader], n: int, seed: int = 1):
+    rng = random.Random(seed)
+    for sf in rng.sample(simfiles, min(n, len(simfiles))):
+        text = sf.title if rng.random() < 0.7 else sf.artist
+        if rng.random() < 0.2:
+            text += f" {rng.choice(sf.charts).meter}"
+        for end in range(1, len(text) + 1):
+            yield text[:end]
+
+
+def percentile(samples: list[float], p: float) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[p - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--songs", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    simfiles = library(args.songs)
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.replace(simfiles)
+    build = time.perf_counter() - start
+
+    latencies = []
+    for query in typed_queries(simfiles, args.queries):
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    print(f"songs:    {len(index)}")
+    print(f"build:    {build:.2f} s")
+    print(f"searches: {len(latencies)}")
+    for p in (50, 90, 99):
+        print(f"p{p}:      {percentile(latencies, p):.2f} ms")
+    print(f"max:      {max(latencies):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Synthetic simfiles, songs and packs for tests and benchmarks.
+
+Everything is generated from a seeded random.Random, so the same arguments
+always produce the same files. Charts mix 8th and 16th measures with BPM
+changes and stops; every song gets its own notes, so no two songs share a
+chart fingerprint and the bot never sees them as duplicates.
+"""
+
+import random
+import struct
+import zipfile
+import zlib
+from pathlib import Path
+
+DIFFICULTIES = [("Beginner", 2), ("Easy", 5), ("Medium", 8)]
+DIFFICULTIES += [("Hard", 10), ("Challenge", 13)]
+ARROWS = ["1000", "0100", "0010", "0001"]
+
+
+def measure(rng: random.Random, stream: bool) -> str:
+    rows = []
+    for i in range(16 if stream else 8):
+        if stream or rng.random() < 0.6:
+            row = rng.choice(ARROWS)
+            if rng.random() < 0.05:
+                row = "1001"
+            elif rng.random() < 0.03:
+                row = row.replace("1", "2")
+        else:
+            row = "0000"
+        rows.append(row)
+    return "\n".join(rows)
+
+
+def simfile(
+    rng: random.Random,
+    title: str,
+    measures: int,
+    charts: int = len(DIFFICULTIES),
+    banner: str = "",
+    music: str = "",
+) -> str:
+    """An .sm file with `charts` dance-single charts of `measures` each."""
+    lines = [
+        f"#TITLE:{title};",
+        "#ARTIST:Benchmark;",
+        f"#BANNER:{banner};",
+        f"#MUSIC:{music};",
+        "#OFFSET:0;",
+        f"#BPMS:0={rng.randint(120, 200)},64={rng.randint(120, 200)};",
+        "#STOPS:32=0.5;",
+    ]
+    for i in range(charts):
+        difficulty, meter = DIFFICULTIES[i % len(DIFFICULTIES)]
+        streamy = meter / 15
+        notes = "\n,\n".join(
+            measure(rng, rng.random() < streamy) for _ in range(measures)
+        )
+        lines.append(
+            f"#NOTES:\n dance-single:\n Chart {i}:\n {difficulty}:\n"
+            + f" {meter}:\n 0,0,0,0,0:\n{notes}\n;"
+        )
+    return "\n".join(lines)
+
+
+def png(rng: random.Random, size: int) -> bytes:
+    """
+    A valid RGB PNG of noise, about `size` bytes (noise doesn't compress),
+    at the 418x164 aspect ratio of ITG banners.
+    """
+    height = max(int((size / 3 / (418 / 164)) ** 0.5), 1)
+    width = max(size // 3 // height, 1)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        checksum = struct.pack(">I", zlib.crc32(kind + data))
+        return struct.pack(">I", len(data)) + kind + data + checksum
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def write_song(
+    rng: random.Random,
+    song_dir: Path,
+    title: str,
+    measures: int,
+    charts: int,
+    banner_bytes: int,
+    audio_bytes: int,
+) -> None:
+    """A song directory: simfile, banner and (random bytes for) music."""
+    song_dir.mkdir(parents=True)
+    song_dir.joinpath("song.sm").write_text(
+        simfile(
+            rng,
+            title,
+            measures,
+            charts,
+            banner="bn.png" if banner_bytes else "",
+            music="song.ogg" if audio_bytes else "",
+        )
+    )
+    if banner_bytes:
+        song_dir.joinpath("bn.png").write_bytes(png(rng, banner_bytes))
+    if audio_bytes:
+        song_dir.joinpath("song.ogg").write_bytes(rng.randbytes(audio_bytes))
+
+
+def write_pack(
+    rng: random.Random,
+    pack_dir: Path,
+    songs: int,
+    measures: int,
+    charts: int,
+    banner_bytes: int,
+    audio_bytes: int,
+) -> None:
+    """A pack directory of `songs` songs, with a pack banner."""
+    for i in range(songs):
+        write_song(
+            rng,
+            pack_dir.joinpath(f"Song {i:03d}"),
+            f"{pack_dir.name} Song {i:03d}",
+            measures,
+            charts,
+            banner_bytes,
+            audio_bytes,
+        )
+    if banner_bytes:
+        pack_dir.joinpath("banner.png").write_bytes(png(rng, banner_bytes))
+
+
+def write_zip(src: Path, dest: Path) -> Path:
+    """Zips `src` (a song or pack directory) the way packs are shared."""
+    with zipfile.ZipFile(dest, "w", zipfile.ZIP_DEFLATED) as zip:
+        for path in sorted(src.rglob("*")):
+            zip.write(path, path.relative_to(src.parent))
+    return dest
@@ -1,9 +1,32 @@
+import hashlib
+import json
 import logging
+import os
+from pathlib import Path
 import discord
 from discord.ext import commands
 from discord import app_commands
 from typing import Literal, Optional
 
+# Fingerprints of the command trees last synced, by application and scope,
+# kept in the bot's data directory (DATA_PATH, see ItgCliCogConfig)
+SYNCED_TREES_FILE = "synced_trees.json"
+
+
+def tree_fingerprint(
+    tree: app_commands.CommandTree, guild: Optional[discord.abc.Snowflake]
+) -> str:
+    """
+    Hash of the payload syncing `tree` to `guild` (or globally) would send.
+    """
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command["type"], command["name"]),
+    )
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode()
+    ).hexdigest()
+
 
 class ExampleCog(commands.Cog):
     logger: logging.Logger
@@ -25,6 +48,39 @@ class ExampleCog(commands.Cog):
         await inter.response.send_message(f"pong! `{latency}ms`")
         self.logger.info(f"ping: Sent pong ({latency}ms)")
 
+    def _synced_trees_path(self) -> Path:
+        data = os.getenv("DATA_PATH") or Path.home().joinpath(".itg-buddy")
+        return Path(data).joinpath(SYNCED_TREES_FILE)
+
+    async def _sync_tree(
+        self, guild: Optional[discord.abc.Snowflake], force: bool
+    ) -> Optional[list[app_commands.AppCommand]]:
+        """
+        Syncs the commands of `guild` (global ones if None) unless they're
+        unchanged since they were last synced, since syncs are heavily rate
+        limited. Returns the synced commands, or None if skipped.
+        """
+        tree = self.bot.tree
+        scope = "global" if guild is None else str(guild.id)
+        key = f"{self.bot.application_id}/{scope}"
+        fingerprint = tree_fingerprint(tree, guild)
+        path = self._synced_trees_path()
+        try:
+            synced = json.loads(path.read_text())
+        except (OSError, ValueError):
+            synced = {}
+        if not force and synced.get(key) == fingerprint:
+            self.logger.info(f"sync: Skipped {scope}, nothing changed")
+            return None
+        commands = await tree.sync(guild=guild)
+        synced[key] = fingerprint
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(synced, indent=2))
+        except OSError as e:
+            self.logger.warning(f"sync: Could not save {path}: {e}")
+        return commands
+
     # Adapted from discord.py devpost
     # https://about.abstractumbra.dev/discord.py/2023/01/29/sync-command-example.html
     @commands.command()
@@ -35,34 +91,49 @@ class ExampleCog(commands.Cog):
         ctx: commands.Context,
         guilds: commands.Greedy[discord.Object],
         spec: Optional[Literal["~", "*", "^"]] = None,
+        force: Optional[Literal["force"]] = None,
     ) -> None:
+        # Trees that haven't changed since they were last synced are skipped,
+        # unless `force` is given
+        force = force is not None
         if not guilds:
             if spec == "~":
-                synced = await ctx.bot.tree.sync(guild=ctx.guild)
+                synced = await self._sync_tree(ctx.guild, force)
             elif spec == "*":
                 ctx.bot.tree.copy_global_to(guild=ctx.guild)
-                synced = await ctx.bot.tree.sync(guild=ctx.guild)
+                synced = await self._sync_tree(ctx.guild, force)
             elif spec == "^":
                 ctx.bot.tree.clear_commands(guild=ctx.guild)
-                await ctx.bot.tree.sync(guild=ctx.guild)
+                await self._sync_tree(ctx.guild, force)
                 synced = []
             else:
-                synced = await ctx.bot.tree.sync()
+                synced = await self._sync_tree(None, force)
 
             scope = "globally" if spec is None else "to the current guild."
-            msg = f"Synced {len(synced)} commands {scope}"
+            if synced is None:
+                msg = (
+                    f"Commands {scope} are unchanged since the last sync; "
+                    "skipped (add `force` to sync anyway)"
+                )
+            else:
+                msg = f"Synced {len(synced)} commands {scope}"
             await ctx.send(msg)
             self.logger.info(msg)
 
             return
 
         ret = 0
+        skipped = 0
         for guild in guilds:
             try:
-                await ctx.bot.tree.sync(guild=guild)
+                synced = await self._sync_tree(guild, force)
             except discord.HTTPException:
                 pass
             else:
                 ret += 1
+                skipped += synced is None
 
-        await ctx.send(f"Synced the tree to {ret}/{len(guilds)}.")
+        msg = f"Synced the tree to {ret}/{len(guilds)}."
+        if skipped:
+            msg += f" ({skipped} unchanged, skipped)"
+        await ctx.send(msg)
@@ -0,0 +1,328 @@
+# Chart analytics.
+# Turns a chart's note data into arrays of rows (beat, time, arrows) and
+# derives what players ask about from them: note counts, notes per second and
+# how much of the chart is stream. All of it is computed with NumPy, a chart
+# at a time, so a whole pack takes a fraction of a second; results are cached
+# by chart hash, which the library index already has, so charts that were
+# analyzed before cost nothing, not even a read of their simfile.
+import hashlib
+import importlib.util
+import json
+import logging
+import sqlite3
+from contextlib import closing
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+# NumPy is optional (embeds then leave stats out) and imported on first use,
+# see load_numpy, since importing it takes a while
+np = None
+
+from itg_buddy.extensions.itg_cli.headers import (
+    NOTES_COMMENT,
+    ChartData,
+    ChartHeader,
+    SimfileHeader,
+    read_chart_data,
+)
+from itg_buddy.extensions.itg_cli.metrics import STAGE_SECONDS
+
+# Bump when ChartStats or how it's computed changes; old results are dropped
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chart_stats (
+    key TEXT PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+"""
+
+# Row characters that are steps: taps, hold and roll heads, lifts
+STEP_CHARS = b"124L"
+# A measure with at least this many steps is a measure of (16th) stream
+STREAM_THRESHOLD = 16
+BEATS_PER_MEASURE = 4
+# Most runs shown in a breakdown
+MAX_BREAKDOWN_RUNS = 12
+
+
+def load_numpy() -> bool:
+    """Imports NumPy as `np` if it isn't yet. False if it isn't installed."""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+@dataclass
+class ChartStats:
+    # Rows with at least one step (a jump counts once)
+    steps: int
+    jumps: int
+    holds: int
+    rolls: int
+    mines: int
+    # Steps per second: the densest measure, and over the whole chart
+    peak_nps: float
+    average_nps: float
+    stream_measures: int
+    # Measures from the first step to the last
+    measures: int
+    # Runs of stream measures, with the breaks between them in parentheses,
+    # e.g. "16 (4) 32"
+    breakdown: str
+
+    @property
+    def stream_ratio(self) -> float:
+        return self.stream_measures / self.measures if self.measures else 0.0
+
+
+def _timing_pairs(value: str) -> list[tuple[float, float]]:
+    """Parses a BPMS/STOPS value ("beat=value,...")."""
+    pairs = []
+    for item in value.split(","):
+        beat, _, amount = item.partition("=")
+        try:
+            pairs.append((float(beat), float(amount)))
+        except ValueError:
+            continue
+    return sorted(pairs)
+
+
+def beat_times(beats, bpms: str, stops: str):
+    """
+    Seconds (from beat 0) at which each of `beats` happens, given BPM
+    changes and stops. Steps on a stop's beat come before the stop.
+    """
+    changes = [(b, bpm) for b, bpm in _timing_pairs(bpms) if bpm > 0]
+    if not changes:
+        changes = [(0.0, 120.0)]
+    change_beats = np.array([b for b, _ in changes])
+    seconds_per_beat = 60 / np.array([bpm for _, bpm in changes])
+    # Time at which each BPM segment starts
+    change_times = np.concatenate(
+        ([0.0], np.cumsum(np.diff(change_beats) * seconds_per_beat[:-1]))
+    )
+    segment = np.clip(
+        np.searchsorted(change_beats, beats, side="right") - 1, 0, None
+    )
+    times = change_times[segment] + (
+        (beats - change_beats[segment]) * seconds_per_beat[segment]
+    )
+    stop_list = _timing_pairs(stops)
+    if stop_list:
+        stop_beats = np.array([b for b, _ in stop_list])
+        stop_totals = np.concatenate(
+            ([0.0], np.cumsum([s for _, s in stop_list]))
+        )
+        times += stop_totals[np.searchsorted(stop_beats, beats, side="left")]
+    return times
+
+
+def breakdown(is_stream) -> str:
+    """Run-length summary of a boolean array of stream measures."""
+    if not is_stream.any():
+        return ""
+    # Trim breaks before the first and after the last run
+    indices = np.flatnonzero(is_stream)
+    is_stream = is_stream[indices[0] : indices[-1] + 1]
+    edges = np.flatnonzero(np.diff(is_stream.astype(np.int8))) + 1
+    lengths = np.diff(np.concatenate(([0], edges, [len(is_stream)])))
+    runs = [str(n) if i % 2 == 0 else f"({n})" for i, n in enumerate(lengths)]
+    if len(runs) > MAX_BREAKDOWN_RUNS:
+        runs = runs[:MAX_BREAKDOWN_RUNS] + ["..."]
+    return " ".join(runs)
+
+
+def analyze_chart(chart: ChartData) -> Optional[ChartStats]:
+    """Stats for one chart, or None if it has no steps."""
+    # Every row of every measure, with the measure it's in and its position
+    # within it
+    measures = [
+        m.split() for m in NOTES_COMMENT.sub("", chart.notes).split(",")
+    ]
+    rows = [row for measure in measures for row in measure]
+    if not rows:
+        return None
+    width = max(map(len, rows), default=0)
+    lengths = np.array([len(m) for m in measures])
+    measure = np.repeat(np.arange(len(measures)), lengths)
+    position = np.arange(len(rows)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    beats = (measure + position / np.repeat(lengths, lengths)) * (
+        BEATS_PER_MEASURE
+    )
+    # One byte per arrow. Rows almost always have the same width, so they're
+    # encoded in one go; short (malformed) rows are padded with "0"
+    data = "".join(rows).encode("ascii", "replace")
+    if len(data) != width * len(rows):
+        data = b"".join(
+            row.encode("ascii", "replace").ljust(width, b"0") for row in rows
+        )
+    grid = np.frombuffer(data, dtype=np.uint8).reshape(len(rows), width)
+    steps_per_row = np.isin(grid, np.frombuffer(STEP_CHARS, np.uint8)).sum(1)
+    is_step = steps_per_row > 0
+    if not is_step.any():
+        return None
+    times = beat_times(beats[is_step], chart.bpms, chart.stops)
+    step_measures = measure[is_step]
+    steps_per_measure = np.bincount(step_measures, minlength=len(measures))
+    first, last = step_measures[0], step_measures[-1]
+    steps_per_measure = steps_per_measure[first : last + 1]
+
+    # Each measure's duration, from the times of its first and next beats
+    measure_beats = np.arange(first, last + 2) * BEATS_PER_MEASURE
+    measure_times = beat_times(measure_beats, chart.bpms, chart.stops)
+    durations = np.diff(measure_times)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nps = np.where(durations > 0, steps_per_measure / durations, 0.0)
+    duration = times[-1] - times[0]
+    is_stream = steps_per_measure >= STREAM_THRESHOLD
+    return ChartStats(
+        steps=int(is_step.sum()),
+        jumps=int((steps_per_row >= 2).sum()),
+        holds=int((grid == ord("2")).sum()),
+        rolls=int((grid == ord("4")).sum()),
+        mines=int((grid == ord("M")).sum()),
+        peak_nps=round(float(nps.max()), 2),
+        average_nps=(
+            round(float(is_step.sum() / duration), 2) if duration > 0 else 0.0
+        ),
+        stream_measures=int(is_stream.sum()),
+        measures=int(last - first + 1),
+        breakdown=breakdown(is_stream),
+    )
+
+
+def stats_key(chart: ChartHeader) -> Optional[str]:
+    """
+    Cache key of a chart's stats: its note data hash plus its timing hash
+    (see headers.chart_fingerprint and timing_fingerprint).
+    """
+    if chart.fingerprint is None or chart.timing is None:
+        return None
+    data = "\n".join([chart.fingerprint, chart.timing])
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def _fingerprinted(sf: SimfileHeader) -> bool:
+    # Charts without note data have no fingerprint, but still a timing one
+    return all(c.timing is not None for c in sf.charts)
+
+
+class ChartAnalytics:
+    """
+    Computes ChartStats for simfiles, caching them in SQLite by chart (see
+    stats_key). Without NumPy, nothing is computed. Blocks on disk I/O, so
+    call it off the event loop.
+    """
+
+    logger: logging.Logger
+    db_path: Path
+
+    def __init__(self, db_path: Path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.db_path = db_path
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != (
+                SCHEMA_VERSION
+            ):
+                db.execute("DROP TABLE IF EXISTS chart_stats")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.executescript(SCHEMA)
+        if importlib.util.find_spec("numpy") is None:
+            self.logger.warning(
+                "NumPy isn't installed; chart stats are left out of embeds"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        return db
+
+    @STAGE_SECONDS.time(stage="analytics")
+    def stats(
+        self, simfiles: Iterable[SimfileHeader]
+    ) -> dict[Path, list[Optional[ChartStats]]]:
+        """
+        Stats for each chart of each simfile, in chart order, keyed by song
+        directory. Charts that can't be analyzed get None.
+
+        Simfiles from the library index come with their chart fingerprints,
+        so only those with charts missing from the cache are read.
+        """
+        if not load_numpy():
+            return {}
+        simfiles = list(simfiles)
+        results = self._load(
+            {
+                key
+                for sf in simfiles
+                for chart in sf.charts
+                if (key := stats_key(chart)) is not None
+            }
+        )
+        charts: dict[Path, list[ChartHeader]] = {}
+        computed = {}
+        for sf in simfiles:
+            if _fingerprinted(sf) and all(
+                c.fingerprint is None or stats_key(c) in results
+                for c in sf.charts
+            ):
+                charts[sf.dir] = sf.charts
+                continue
+            try:
+                song = read_chart_data(sf.path)[1]
+            except Exception as e:
+                self.logger.warning(f"Could not read charts of {sf.path}: {e}")
+                continue
+            charts[sf.dir] = [chart.header for chart in song]
+            for chart in song:
+                key = stats_key(chart.header)
+                if key is None or key in results or key in computed:
+                    continue
+                try:
+                    computed[key] = analyze_chart(chart)
+                except Exception as e:
+                    self.logger.warning(f"Could not analyze a chart: {e}")
+                    computed[key] = None
+        self._store(computed)
+        results |= computed
+        return {
+            song_dir: [results.get(stats_key(chart)) for chart in song]
+            for song_dir, song in charts.items()
+        }
+
+    def _load(self, keys: set[str]) -> dict[str, Optional[ChartStats]]:
+        keys = list(keys)
+        results = {}
+        with closing(self._connect()) as db:
+            # SQLite's variable limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ", ".join("?" * len(batch))
+                for key, stats in db.execute(
+                    "SELECT key, stats FROM chart_stats "
+                    f"WHERE key IN ({placeholders})",
+                    batch,
+                ):
+                    stats = json.loads(stats)
+                    results[key] = stats and ChartStats(**stats)
+        return results
+
+    def _store(self, results: dict[str, Optional[ChartStats]]) -> None:
+        with closing(self._connect()) as db, db:
+            db.executemany(
+                "INSERT OR REPLACE INTO chart_stats VALUES (?, ?)",
+                (
+                    (key, json.dumps(stats and asdict(stats)))
+                    for key, stats in results.items()
+                ),
+            )
@@ -0,0 +1,112 @@
+import asyncio
+import re
+from dataclasses import dataclass
+from typing import Callable, Optional
+import discord
+
+from itg_buddy.extensions.itg_cli.edits import EDIT_SCHEDULER
+from itg_buddy.extensions.itg_cli.embeds import (
+    batch_progress_embed,
+    format_bytes,
+    format_duration,
+)
+from itg_buddy.extensions.itg_cli.progress import ProgressEvent
+from itg_buddy.extensions.itg_cli.singleflight import normalize_url
+
+# Longest status line shown for an item in the progress table
+MAX_STATUS_LENGTH = 60
+
+
+def parse_links(text: str) -> list[str]:
+    """
+    Links in `text` (separated by whitespace or commas), in order, without
+    duplicates.
+    """
+    links = {}
+    for token in re.split(r"[\s,]+", text):
+        if token.startswith(("http://", "https://")):
+            links.setdefault(normalize_url(token), token)
+    return list(links.values())
+
+
+@dataclass
+class BatchItem:
+    name: str
+    status: str = "Queued"
+    # Set once the item has finished, successfully or not
+    done: bool = False
+    error: Optional[str] = None
+
+
+def event_status(event: ProgressEvent) -> str:
+    """Short status line for a batch table row."""
+    if not event.is_progress:
+        return event.text[:MAX_STATUS_LENGTH]
+    if event.percent is not None:
+        return f"Downloading... {event.percent}%"
+    return f"Downloading... {format_bytes(event.done)}"
+
+
+class Batch:
+    """
+    Tracks the status of several items processed as one job and keeps a
+    single bot response updated with a table of them, through the shared
+    EDIT_SCHEDULER. Call everything except `reporter`'s callbacks on the
+    event loop.
+    """
+
+    title: str
+    items: list[BatchItem]
+    bot_response: discord.Message | discord.Interaction
+
+    def __init__(
+        self,
+        title: str,
+        items: list[BatchItem],
+        bot_response: discord.Message | discord.Interaction,
+    ):
+        self.title = title
+        self.items = items
+        self.bot_response = bot_response
+
+    def update(self) -> None:
+        # Progress edits also clear any view left over from an overwrite
+        # prompt for one of the items
+        EDIT_SCHEDULER.submit(
+            self.bot_response,
+            embed=batch_progress_embed(
+                self.title, [(item.name, item.status) for item in self.items]
+            ),
+            view=None,
+        )
+
+    def set_status(self, item: BatchItem, status: str) -> None:
+        item.status = status
+        self.update()
+
+    def finish(
+        self, item: BatchItem, status: str, error: Optional[str] = None
+    ) -> None:
+        item.done = True
+        item.error = error
+        self.set_status(item, status)
+
+    def reporter(self, item: BatchItem) -> Callable[[ProgressEvent], None]:
+        """Progress callback for `item`'s stages; safe to call off-loop."""
+        loop = asyncio.get_running_loop()
+
+        def on_event(event: ProgressEvent) -> None:
+            status = event_status(event)
+            loop.call_soon_threadsafe(lambda: self.set_status(item, status))
+
+        return on_event
+
+    def queue_reporter(self, item: BatchItem) -> Callable[[int, float], None]:
+        """Job queue callback showing `item`'s place in the queue."""
+
+        def on_queued(position: int, eta: float) -> None:
+            self.set_status(
+                item, f"Queued: #{position}, ~{format_duration(eta)}"
+            )
+
+        return on_queued
@@ -5,6 +5,13 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Self, Optional
 
+DEFAULT_DOWNLOAD_CONCURRENCY = 3
+DEFAULT_DOWNLOAD_CACHE_MB = 4096
+DEFAULT_JOB_CONCURRENCY = 2
+DEFAULT_DOWNLOAD_SEGMENTS = 4
+DEFAULT_THUMBNAIL_CACHE_MB = 64
+DEFAULT_INSTALL_WORKERS = 2
+
 
 class ItgCliCogConfigError(Exception):
     pass
@@ -19,6 +26,25 @@ class ItgCliCogConfig:
     singles: Path
     cache: Optional[Path]
     add_song_channel_id: Optional[int]
+    # Directory for the bot's own state (library index, caches, ...)
+    data: Path
+    # Number of add-song/add-pack downloads allowed to run at once
+    download_concurrency: int
+    # Size cap for cached archives in bytes (0 disables the cache)
+    download_cache_size: int
+    # Number of queued jobs allowed to run at once. Each /bulk_add link is a
+    # job of its own; several songs posted in one message are one job.
+    job_concurrency: int
+    # Number of parallel connections used for each large download
+    download_segments: int
+    # Size cap for cached banner thumbnails in bytes (0 disables them)
+    thumbnail_cache_size: int
+    # Number of processes extracting and installing packs (0 runs them on
+    # threads of the bot process)
+    install_workers: int
+    # Port on localhost serving metrics to Prometheus (None to not serve
+    # them; /stats works either way)
+    metrics_port: Optional[int]
 
     def from_env() -> Optional[Self]:
         logger = logging.getLogger(__class__.__name__)
@@ -48,4 +74,21 @@ class ItgCliCogConfig:
             ),
             Path(env_bindings["ITGMANIA_CACHE_PATH"]),
             int(env_bindings["ADD_SONG_CHANNEL_ID"]),
+            Path(os.getenv("DATA_PATH") or Path.home().joinpath(".itg-buddy")),
+            int(
+                os.getenv("DOWNLOAD_CONCURRENCY")
+                or DEFAULT_DOWNLOAD_CONCURRENCY
+            ),
+            int(os.getenv("DOWNLOAD_CACHE_MB") or DEFAULT_DOWNLOAD_CACHE_MB)
+            * 1_000_000,
+            int(os.getenv("JOB_CONCURRENCY") or DEFAULT_JOB_CONCURRENCY),
+            int(os.getenv("DOWNLOAD_SEGMENTS") or DEFAULT_DOWNLOAD_SEGMENTS),
+            int(os.getenv("THUMBNAIL_CACHE_MB") or DEFAULT_THUMBNAIL_CACHE_MB)
+            * 1_000_000,
+            int(os.getenv("INSTALL_WORKERS") or DEFAULT_INSTALL_WORKERS),
+            (
+                int(os.getenv("METRICS_PORT"))
+                if os.getenv("METRICS_PORT")
+                else None
+            ),
         )
@@ -0,0 +1,201 @@
+import logging
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import closing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import NamedTuple, Optional
+import requests
+
+from itg_buddy.extensions.itg_cli.downloader import Downloader
+from itg_buddy.extensions.itg_cli.pipeline import sha256sum
+from itg_buddy.extensions.itg_cli.singleflight import normalize_url
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    validator TEXT NOT NULL,
+    sha256 TEXT NOT NULL REFERENCES blobs(sha256) ON DELETE CASCADE
+);
+"""
+
+# Seconds to wait on the HEAD request used to validate a cached URL
+VALIDATE_TIMEOUT = 10
+
+
+class CachedDownload(NamedTuple):
+    path: Path
+    sha256: str
+
+
+class DownloadCache:
+    """
+    Content-addressed cache of downloaded archives under `root`.
+
+    Archives are stored once per SHA-256 and looked up by normalized URL,
+    as long as the server's ETag/Content-Length/Last-Modified still match
+    what they were when it was downloaded. The least recently used archives
+    are evicted once the cache grows past `max_bytes`; archives handed out by
+    `fetch` are pinned until `release`d so they can't be evicted mid-job.
+    Misses are fetched with `downloader`.
+    All methods block, so call them off the event loop.
+    """
+
+    logger: logging.Logger
+    root: Path
+    max_bytes: int
+    downloader: Downloader
+
+    def __init__(self, root: Path, max_bytes: int, downloader: Downloader):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.downloader = downloader
+        self._lock = threading.Lock()
+        self._pins: Counter[str] = Counter()
+        root.joinpath("blobs").mkdir(parents=True, exist_ok=True)
+        # Leftovers of downloads interrupted by a restart
+        shutil.rmtree(root.joinpath("partial"), ignore_errors=True)
+        root.joinpath("partial").mkdir()
+        with closing(self._connect()) as db, db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != (
+                SCHEMA_VERSION
+            ):
+                for table in ("urls", "blobs"):
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.root.joinpath("index.db"), timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    def _blob_path(self, sha256: str, name: str) -> Path:
+        return self.root.joinpath("blobs", sha256, name)
+
+    def fetch(self, url: str) -> CachedDownload:
+        """
+        Returns the cached archive for `url`, downloading it (with progress
+        on stderr) if it isn't cached or has changed upstream. The archive is
+        pinned until `release` is called with its digest.
+        """
+        key = normalize_url(url)
+        validator = self._validator(url, key)
+        if validator is not None:
+            with self._lock, closing(self._connect()) as db, db:
+                row = db.execute(
+                    "SELECT blobs.sha256, name FROM urls JOIN blobs "
+                    + "USING (sha256) WHERE url = ? AND validator = ?",
+                    (key, validator),
+                ).fetchone()
+                if row is not None and self._blob_path(*row).is_file():
+                    db.execute(
+                        "UPDATE blobs SET last_used = ? WHERE sha256 = ?",
+                        (time.time(), row[0]),
+                    )
+                    self._pins[row[0]] += 1
+                    print("Using cached download...", file=sys.stderr)
+                    return CachedDownload(self._blob_path(*row), row[0])
+
+        with TemporaryDirectory(dir=self.root.joinpath("partial")) as temp:
+            downloaded, sha256 = self.downloader.download(url, Path(temp))
+            if sha256 is None:
+                sha256 = sha256sum(downloaded)
+            with self._lock, closing(self._connect()) as db:
+                with db:
+                    row = db.execute(
+                        "SELECT name FROM blobs WHERE sha256 = ?", (sha256,)
+                    ).fetchone()
+                    if (
+                        row is None
+                        or not self._blob_path(sha256, row[0]).is_file()
+                    ):
+                        name = downloaded.name
+                        dest = self._blob_path(sha256, name)
+                        dest.parent.mkdir(exist_ok=True)
+                        downloaded.replace(dest)
+                    else:
+                        name = row[0]
+                    db.execute(
+                        "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                        (
+                            sha256,
+                            name,
+                            self._blob_path(sha256, name).stat().st_size,
+                            time.time(),
+                        ),
+                    )
+                    if validator is not None:
+                        db.execute(
+                            "INSERT OR REPLACE INTO urls VALUES (?, ?, ?)",
+                            (key, validator, sha256),
+                        )
+                    self._pins[sha256] += 1
+                self._evict(db)
+        return CachedDownload(self._blob_path(sha256, name), sha256)
+
+    def release(self, sha256: str) -> None:
+        """Unpins an archive returned by `fetch`."""
+        with self._lock:
+            self._pins[sha256] -= 1
+            if self._pins[sha256] <= 0:
+                del self._pins[sha256]
+
+    def _validator(self, url: str, key: str) -> Optional[str]:
+        """
+        Identifies the current version of the file at `url`, or None if the
+        server gives us nothing to go on. Drive links always return None:
+        their share pages say nothing about the file behind them.
+        """
+        if key.startswith("gdrive:"):
+            return None
+        try:
+            response = requests.head(
+                url, allow_redirects=True, timeout=VALIDATE_TIMEOUT
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self.logger.info(f"Couldn't validate cached {url}: {e}")
+            return None
+        headers = [
+            response.headers.get(h)
+            for h in ("ETag", "Content-Length", "Last-Modified")
+        ]
+        if not any(headers):
+            return None
+        return "|".join(h or "" for h in headers)
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        """Deletes unpinned archives, oldest first, until under the cap."""
+        total = db.execute("SELECT SUM(size) FROM blobs").fetchone()[0] or 0
+        if total <= self.max_bytes:
+            return
+        rows = db.execute(
+            "SELECT sha256, name, size FROM blobs ORDER BY last_used"
+        ).fetchall()
+        for sha256, name, size in rows:
+            if total <= self.max_bytes:
+                break
+            if sha256 in self._pins:
+                continue
+            with db:
+                db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            shutil.rmtree(
+                self._blob_path(sha256, name).parent, ignore_errors=True
+            )
+            total -= size
+            self.logger.info(f"Evicted cached download {name} ({sha256})")
@@ -0,0 +1,462 @@
+# HTTP downloads for add-song/add-pack.
+# Replaces itg_cli's single-shot requests.get for everything but Google Drive
+# links (which still go through gdown): connections are pooled across jobs,
+# interrupted downloads are kept and resumed with range requests (within a
+# job, and by later jobs for the same link), large files can be fetched as
+# several byte ranges in parallel, and the result is checked against the
+# server's length and digest before use.
+import base64
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import NamedTuple, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from itg_cli._utils import download_file, get_download_filename
+from tqdm import tqdm
+
+from itg_buddy.extensions.itg_cli.progress import ProgressEvent, report
+from itg_buddy.extensions.itg_cli.singleflight import normalize_url
+
+DEFAULT_SEGMENTS = 4
+# Files smaller than this are always fetched over one connection
+SEGMENT_THRESHOLD = 32 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Connect and read timeouts in seconds
+TIMEOUT = (10, 30)
+# Attempts per download; each one resumes where the last left off
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled for each one after
+RETRY_DELAY = 1
+# Seconds between progress events (and saves of a partial download's state)
+REPORT_INTERVAL = 0.5
+# Partial downloads nobody has resumed for this many seconds are deleted
+PARTIAL_RETENTION = 7 * 24 * 60 * 60
+# Content types accepted, as in itg_cli
+VALID_CONTENT_TYPES = ["application/zip"]
+
+# Errors worth retrying: the connection dropped or stalled
+RETRYABLE = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class Download(NamedTuple):
+    path: Path
+    # Hex SHA-256 of the file, if it was computed along the way
+    sha256: Optional[str]
+
+
+class DownloadChanged(Exception):
+    """The file changed upstream while a partial download was kept."""
+
+
+@dataclass
+class PartialDownload:
+    """State of a resumable download, saved next to its .part file."""
+
+    # Final URL (after redirects) of the file
+    url: str
+    # ETag or Last-Modified; ranges are only requested If-Range this matches
+    validator: str
+    total: int
+    filename: str
+    # Inclusive byte range of each segment and the next byte it needs
+    segments: list[list[int]]
+    # Base64 SHA-256 the server gave for the whole file, if any
+    digest: Optional[str] = None
+
+    @property
+    def done(self) -> int:
+        return sum(next - start for start, _end, next in self.segments)
+
+
+def split(total: int, n: int) -> list[list[int]]:
+    """`n` segments covering `total` bytes, as [start, end, next] lists."""
+    size = -(-total // n)
+    return [
+        [start, min(start + size, total) - 1, start]
+        for start in range(0, total, size)
+    ]
+
+
+def response_validator(response: requests.Response) -> Optional[str]:
+    # Weak ETags aren't allowed in If-Range
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def response_digest(response: requests.Response) -> Optional[str]:
+    """The SHA-256 from a Repr-Digest or Digest header, base64 encoded."""
+    for header in ("Repr-Digest", "Digest"):
+        for item in response.headers.get(header, "").split(","):
+            algorithm, _, value = item.strip().partition("=")
+            if algorithm.lower() == "sha-256" and value:
+                return value.strip(":")
+    return None
+
+
+def check_response(response: requests.Response) -> None:
+    """itg_cli's validate_response, allowing partial content."""
+    if response.status_code not in (200, 206):
+        raise Exception(
+            f"Unsuccessful request to {response.url} "
+            + f"with status {response.status_code}"
+        )
+    if "Content-Type" not in response.headers:
+        raise Exception("No Content-Type header found")
+    if response.headers["Content-Type"] not in VALID_CONTENT_TYPES:
+        raise Exception(
+            "Invalid Content-Type:", response.headers["Content-Type"]
+        )
+
+
+class ProgressTracker:
+    """
+    Counts bytes written by a download's segment threads and reports them
+    as ProgressEvents (formatted like the tqdm bar itg_cli prints) every
+    REPORT_INTERVAL seconds. `on_tick` runs at the same pace.
+    """
+
+    def __init__(self, name: str, done: int, total: Optional[int], on_tick):
+        self.name = name
+        self.done = done
+        self.total = total
+        self.on_tick = on_tick
+        self._lock = threading.Lock()
+        self._resumed_from = done
+        self._started = time.monotonic()
+        self._last = 0.0
+
+    def update(self, n: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.done += n
+            if now - self._last < REPORT_INTERVAL:
+                return
+            self._last = now
+        self.on_tick()
+        self.report(now)
+
+    def report(self, now: Optional[float] = None) -> None:
+        elapsed = (now or time.monotonic()) - self._started
+        rate = (self.done - self._resumed_from) / elapsed if elapsed else None
+        eta = None
+        if self.total and rate:
+            eta = (self.total - self.done) / rate
+        report(
+            ProgressEvent(
+                text=tqdm.format_meter(
+                    self.done,
+                    self.total,
+                    elapsed,
+                    prefix=self.name,
+                    unit="B",
+                    unit_scale=True,
+                    rate=rate,
+                ),
+                description=self.name,
+                percent=(
+                    int(100 * self.done / self.total) if self.total else None
+                ),
+                done=self.done,
+                total=self.total,
+                rate=rate,
+                eta=eta,
+            )
+        )
+
+
+class Downloader:
+    """
+    Downloads files over a shared, pooled HTTP session.
+
+    Downloads that can be resumed (the server takes range requests and
+    identifies the file with an ETag or Last-Modified) are kept in
+    `partial_dir` until they complete, keyed by normalized URL, and are
+    retried up to MAX_ATTEMPTS times from where they stopped. Files of at
+    least SEGMENT_THRESHOLD bytes are fetched as `segments` parallel ranges.
+    `download` blocks; call it from a worker thread.
+    """
+
+    logger: logging.Logger
+    partial_dir: Path
+    segments: int
+    session: requests.Session
+
+    def __init__(
+        self,
+        partial_dir: Path,
+        segments: int = DEFAULT_SEGMENTS,
+        pool_size: int = 16,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.partial_dir = partial_dir
+        self.segments = max(segments, 1)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._locks: defaultdict[str, threading.Lock] = defaultdict(
+            threading.Lock
+        )
+        self._locks_lock = threading.Lock()
+        # Segment threads all save the same state through one temp file
+        self._state_lock = threading.Lock()
+        partial_dir.mkdir(parents=True, exist_ok=True)
+        cutoff = time.time() - PARTIAL_RETENTION
+        for path in partial_dir.iterdir():
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+
+    def download(self, url: str, downloads: Path) -> Download:
+        """
+        Downloads `url` into `downloads`, with progress on stderr (or
+        reported directly to the current job), returning the file and its
+        SHA-256 when known.
+        """
+        if normalize_url(url).startswith("gdrive:"):
+            return Download(download_file(url, downloads), None)
+        key = hashlib.sha256(normalize_url(url).encode()).hexdigest()[:32]
+        with self._locks_lock:
+            lock = self._locks[key]
+        with lock:
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    return self._attempt(url, key, downloads)
+                except (*RETRYABLE, DownloadChanged) as e:
+                    if attempt == MAX_ATTEMPTS:
+                        raise
+                    delay = RETRY_DELAY * 2 ** (attempt - 1)
+                    print(
+                        f"Download interrupted ({e.__class__.__name__}), "
+                        + f"retrying in {delay}s...",
+                        file=sys.stderr,
+                    )
+                    time.sleep(delay)
+
+    def _attempt(self, url: str, key: str, downloads: Path) -> Download:
+        part = self.partial_dir.joinpath(f"{key}.part")
+        state_path = self.partial_dir.joinpath(f"{key}.json")
+        print(f"Making request to {url}...", file=sys.stderr)
+        response = self.session.get(url, stream=True, timeout=TIMEOUT)
+        check_response(response)
+        validator = response_validator(response)
+        total = int(response.headers.get("Content-Length", 0)) or None
+        resumable = (
+            validator is not None
+            and total is not None
+            and response.headers.get("Accept-Ranges") == "bytes"
+        )
+        if not resumable:
+            # Nothing to resume from next time, so no state is kept
+            state_path.unlink(missing_ok=True)
+            part.unlink(missing_ok=True)
+            return self._stream(response, part, downloads, total)
+
+        state = self._load_state(state_path)
+        if (
+            state is None
+            or not part.is_file()
+            or (state.validator, state.total) != (validator, total)
+        ):
+            n = self.segments if total >= SEGMENT_THRESHOLD else 1
+            state = PartialDownload(
+                url=response.url,
+                validator=validator,
+                total=total,
+                filename=str(get_download_filename(response)),
+                segments=split(total, n),
+                digest=response_digest(response),
+            )
+            with part.open("wb") as f:
+                f.truncate(total)
+        else:
+            state.url = response.url
+            print(
+                f"Resuming {state.filename} from "
+                + f"{100 * state.done // state.total}%...",
+                file=sys.stderr,
+            )
+        self._save_state(state_path, state)
+
+        # The first segment can reuse the response if it starts at byte 0
+        first = state.segments[0]
+        if first[2] != 0:
+            response.close()
+            response = None
+        try:
+            self._fetch_segments(state, state_path, part, response)
+        finally:
+            self._save_state(state_path, state)
+
+        if part.stat().st_size != total or state.done != total:
+            raise Exception(f"Download of {state.filename} is incomplete")
+        sha256 = self._verify(part, state.digest, state_path)
+        dest = downloads.joinpath(state.filename)
+        dest.unlink(missing_ok=True)
+        shutil.move(part, dest)
+        state_path.unlink(missing_ok=True)
+        return Download(dest, sha256)
+
+    def _stream(
+        self,
+        response: requests.Response,
+        part: Path,
+        downloads: Path,
+        total: Optional[int],
+    ) -> Download:
+        """Plain single-connection download, hashed as it's written."""
+        filename = str(get_download_filename(response))
+        tracker = ProgressTracker(filename, 0, total, lambda: None)
+        digest = hashlib.sha256()
+        with response, part.open("wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                tracker.update(len(chunk))
+        tracker.report()
+        if total is not None and part.stat().st_size != total:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Got {part.stat().st_size} of {total} bytes"
+            )
+        dest = downloads.joinpath(filename)
+        dest.unlink(missing_ok=True)
+        shutil.move(part, dest)
+        return Download(dest, digest.hexdigest())
+
+    def _fetch_segments(
+        self,
+        state: PartialDownload,
+        state_path: Path,
+        part: Path,
+        response: Optional[requests.Response],
+    ) -> None:
+        tracker = ProgressTracker(
+            state.filename,
+            state.done,
+            state.total,
+            lambda: self._save_state(state_path, state),
+        )
+        stop = threading.Event()
+        pending = [s for s in state.segments if s[2] <= s[1]]
+        if len(pending) == 1 and pending[0] is state.segments[0]:
+            # One connection: stay on this thread (and its job context)
+            self._fetch_segment(
+                state, part, pending[0], tracker, stop, response
+            )
+        elif pending:
+            if response is not None:
+                response.close()
+            with ThreadPoolExecutor(
+                max_workers=len(pending), thread_name_prefix="segment"
+            ) as executor:
+                # Each thread gets a copy of this one's context, so progress
+                # and cancellation reach the job
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self._fetch_segment,
+                        state,
+                        part,
+                        segment,
+                        tracker,
+                        stop,
+                    )
+                    for segment in pending
+                ]
+                wait(futures, return_when=FIRST_EXCEPTION)
+                stop.set()
+            for future in futures:
+                future.result()
+        elif response is not None:
+            response.close()
+        tracker.report()
+
+    def _fetch_segment(
+        self,
+        state: PartialDownload,
+        part: Path,
+        segment: list[int],
+        tracker: ProgressTracker,
+        stop: threading.Event,
+        response: Optional[requests.Response] = None,
+    ) -> None:
+        _start, end, next = segment
+        if response is None:
+            response = self.session.get(
+                state.url,
+                headers={
+                    "Range": f"bytes={next}-{end}",
+                    "If-Range": state.validator,
+                },
+                stream=True,
+                timeout=TIMEOUT,
+            )
+            if response.status_code != 206:
+                response.close()
+                raise DownloadChanged(
+                    f"{state.filename} changed since it was partly downloaded"
+                )
+        # Unbuffered, so saved offsets never run ahead of the file
+        with response, part.open("r+b", buffering=0) as f:
+            f.seek(next)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if stop.is_set():
+                    return
+                chunk = chunk[: end + 1 - segment[2]]
+                f.write(chunk)
+                segment[2] += len(chunk)
+                tracker.update(len(chunk))
+                if segment[2] > end:
+                    return
+        if segment[2] <= end:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Connection closed at byte {segment[2]} of {end + 1}"
+            )
+
+    def _verify(
+        self, part: Path, digest: Optional[str], state_path: Path
+    ) -> str:
+        """Hashes the finished download, checking it against `digest`."""
+        print("Verifying download...", file=sys.stderr)
+        with part.open("rb") as f:
+            sha256 = hashlib.file_digest(f, "sha256")
+        if digest is not None and base64.b64encode(sha256.digest()) != (
+            digest.encode()
+        ):
+            # Start over next time
+            part.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            raise Exception("Download is corrupted (checksum mismatch)")
+        return sha256.hexdigest()
+
+    def _load_state(self, state_path: Path) -> Optional[PartialDownload]:
+        try:
+            return PartialDownload(**json.loads(state_path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _save_state(self, state_path: Path, state: PartialDownload) -> None:
+        # Segment offsets only ever trail what's been written, so a stale
+        # save just means refetching a little
+        temp = state_path.with_suffix(".tmp")
+        with self._state_lock:
+            temp.write_text(json.dumps(asdict(state)))
+            os.replace(temp, state_path)
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Hashable, Optional
+import discord
+
+from itg_buddy.extensions.itg_cli.metrics import DISCORD_SECONDS
+from itg_buddy.extensions.itg_cli.utils import edit_response
+
+Target = discord.Interaction | discord.Message
+Editor = Callable[..., Awaitable[None]]
+
+# Discord allows roughly 5 message edits per 5 seconds in a channel
+CHANNEL_RATE = 5
+CHANNEL_PER = 5.0
+# Fallback backoff when a 429 doesn't say how long to wait
+DEFAULT_RETRY_AFTER = 1.0
+
+
+@dataclass
+class EditStats:
+    submitted: int = 0
+    # Updates dropped because a newer one for the same message replaced them
+    coalesced: int = 0
+    sent: int = 0
+    failed: int = 0
+    rate_limited: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.sent} sent, {self.coalesced} coalesced, "
+            f"{self.failed} failed, {self.rate_limited} rate limited "
+            f"({self.submitted} submitted)"
+        )
+
+
+@dataclass
+class PendingEdit:
+    target: Target
+    channel: Optional[int]
+    kwargs: dict
+
+
+class ChannelBucket:
+    """Sliding window allowing `rate` edits per `per` seconds."""
+
+    rate: int
+    per: float
+    sent: deque[float]
+    blocked_until: float
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.sent = deque()
+        self.blocked_until = 0
+
+    def delay(self, now: float) -> float:
+        """Seconds until another edit may be sent."""
+        while self.sent and self.sent[0] <= now - self.per:
+            self.sent.popleft()
+        delay = self.blocked_until - now
+        if len(self.sent) >= self.rate:
+            delay = max(delay, self.sent[0] + self.per - now)
+        return max(delay, 0)
+
+    def record(self, now: float) -> None:
+        self.sent.append(now)
+
+
+class EditScheduler:
+    """
+    Central queue for Discord message edits.
+
+    Progress producers `submit` the latest state of a message; while an edit
+    is waiting, newer submissions for the same message replace it. Edits are
+    sent in order per message and throttled per channel, backing off when
+    Discord rate limits us. Final edits (prompts, results, errors) use
+    `edit`, which drops any stale progress for that message first.
+    """
+
+    logger: logging.Logger
+    editor: Editor
+    stats: EditStats
+
+    def __init__(
+        self,
+        editor: Editor = edit_response,
+        rate: int = CHANNEL_RATE,
+        per: float = CHANNEL_PER,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.editor = editor
+        self.stats = EditStats()
+        self._pending: dict[Hashable, PendingEdit] = {}
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self._buckets: defaultdict[Optional[int], ChannelBucket] = defaultdict(
+            lambda: ChannelBucket(rate, per)
+        )
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(target: Target) -> Hashable:
+        return (type(target).__name__, target.id)
+
+    @staticmethod
+    def _channel(target: Target) -> Optional[int]:
+        if isinstance(target, discord.Interaction):
+            return target.channel_id
+        return getattr(target.channel, "id", None)
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # Producer API
+
+    def submit(self, target: Target, **kwargs) -> None:
+        """Queues `target` to be edited with `kwargs`. Call on the loop."""
+        self._ensure_started()
+        key = self._key(target)
+        self.stats.submitted += 1
+        if key in self._pending:
+            self.stats.coalesced += 1
+        self._pending[key] = PendingEdit(target, self._channel(target), kwargs)
+        self._wakeup.set()
+
+    def submit_threadsafe(
+        self, loop: asyncio.AbstractEventLoop, target: Target, **kwargs
+    ) -> None:
+        """`submit`, for use from executor threads."""
+        loop.call_soon_threadsafe(lambda: self.submit(target, **kwargs))
+
+    async def edit(self, target: Target, **kwargs) -> None:
+        """
+        Edits `target` right away (subject to the channel's rate limit),
+        superseding any queued progress. Exceptions propagate to the caller.
+        """
+        self._ensure_started()
+        key = self._key(target)
+        self.discard(target)
+        await self._wait_in_flight(key)
+        # Again, for progress submitted while waiting; from here on the
+        # dispatcher leaves the message alone until the final edit is done
+        self.discard(target)
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            bucket = self._buckets[self._channel(target)]
+            while (delay := bucket.delay(time.monotonic())) > 0:
+                await asyncio.sleep(delay)
+            bucket.record(time.monotonic())
+            self.stats.submitted += 1
+            with DISCORD_SECONDS.time(call="edit"):
+                await self.editor(target, **kwargs)
+            self.stats.sent += 1
+        except Exception:
+            self.stats.failed += 1
+            raise
+        finally:
+            future.set_result(None)
+            del self._in_flight[key]
+            self._wakeup.set()
+
+    def discard(self, target: Target) -> None:
+        """Drops any queued edit for `target`."""
+        if self._pending.pop(self._key(target), None) is not None:
+            self.stats.coalesced += 1
+
+    async def close(self, target: Target) -> None:
+        """
+        Drops queued edits for `target` and waits for one in flight to
+        finish. Call before deleting a message that has been receiving
+        progress updates.
+        """
+        self.discard(target)
+        await self._wait_in_flight(self._key(target))
+        self.discard(target)
+
+    async def _wait_in_flight(self, key: Hashable) -> None:
+        while (future := self._in_flight.get(key)) is not None:
+            await asyncio.wait([future])
+
+    # Dispatcher
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                now = time.monotonic()
+                next_delay = None
+                for key, pending in list(self._pending.items()):
+                    if key in self._in_flight:
+                        continue  # woken up again once it finishes
+                    bucket = self._buckets[pending.channel]
+                    delay = bucket.delay(now)
+                    if delay > 0:
+                        next_delay = min(next_delay or delay, delay)
+                        continue
+                    del self._pending[key]
+                    bucket.record(now)
+                    self._in_flight[key] = asyncio.create_task(
+                        self._send(key, pending)
+                    )
+                if next_delay is None:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_delay)
+                except TimeoutError:
+                    pass
+                self._wakeup.clear()
+            if not self._pending and not self._in_flight:
+                self.logger.info(f"Edit queue drained: {self.stats}")
+
+    async def _send(self, key: Hashable, pending: PendingEdit) -> None:
+        retry_after = None
+        try:
+            with DISCORD_SECONDS.time(call="progress_edit"):
+                await self.editor(pending.target, **pending.kwargs)
+            self.stats.sent += 1
+        except discord.RateLimited as e:
+            retry_after = e.retry_after
+        except discord.HTTPException as e:
+            if e.status == 429:
+                retry_after = DEFAULT_RETRY_AFTER
+            else:
+                self.stats.failed += 1
+                self.logger.warning(f"Progress edit failed: {e}")
+        except Exception:
+            self.stats.failed += 1
+            self.logger.exception("Progress edit failed")
+        finally:
+            del self._in_flight[key]
+            if retry_after is not None:
+                self.stats.rate_limited += 1
+                bucket = self._buckets[pending.channel]
+                bucket.blocked_until = time.monotonic() + retry_after
+                # Retry unless something newer has been queued meanwhile
+                self._pending.setdefault(key, pending)
+            self._wakeup.set()
+
+
+# Shared by every progress producer so that rate limits are respected across
+# concurrent jobs
+EDIT_SCHEDULER = EditScheduler()
@@ -3,38 +3,291 @@ from typing import Optional
 import discord
 import datetime
 import time
-from simfile import Simfile
-from simfile.dir import SimfilePack
+
+from itg_buddy.extensions.itg_cli.analytics import ChartStats
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader
+from itg_buddy.extensions.itg_cli.jobs import Job, JobKind
+from itg_buddy.extensions.itg_cli.library import Duplicate, PackRecord
+from itg_buddy.extensions.itg_cli.metrics import (
+    FAMILIES,
+    STAGE_SECONDS,
+    WINDOW_SECONDS,
+    Family,
+    Summary,
+)
+from itg_buddy.extensions.itg_cli.progress import ProgressEvent
+from itg_buddy.extensions.itg_cli.search import SearchEntry
+from itg_buddy.extensions.itg_cli.singleflight import link_name
+from itg_buddy.extensions.itg_cli.song_cache import CacheSweep
+from itg_buddy.extensions.itg_cli.thumbnails import banner_thumbnail
+from itg_buddy.watchdog import StallStats
 
 BERKELEY_BLUE = discord.Color.from_str("#002676")
 CALIFORNIA_GOLD = discord.Color.from_str("#FDB515")
 
 
-def progress_embed(progress_text: str) -> discord.Embed:
+def format_duration(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1000:
+            break
+        size /= 1000
+    return f"{size:.1f} {unit}"
+
+
+def format_seconds(seconds: float) -> str:
+    """Like format_duration, but precise enough for short timings."""
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    if seconds < 60:
+        return f"{seconds:.1f} s"
+    return format_duration(seconds)
+
+
+def progress_embed(event: ProgressEvent) -> discord.Embed:
+    embed = discord.Embed(
+        title="Downloading..." if event.is_progress else "Processing...",
+        description=f"```{event.text}```",
+        color=CALIFORNIA_GOLD,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+    if event.is_progress:
+        done = format_bytes(event.done)
+        if event.total:
+            done += f" / {format_bytes(event.total)}"
+        embed.add_field(name="Progress", value=done)
+    if event.rate is not None:
+        embed.add_field(name="Speed", value=f"{format_bytes(event.rate)}/s")
+    if event.eta is not None:
+        embed.add_field(name="ETA", value=format_duration(event.eta))
+    return embed
+
+
+def batch_progress_embed(
+    title: str, rows: list[tuple[str, str]]
+) -> discord.Embed:
+    lines = []
+    length = 0
+    for i, (name, status) in enumerate(rows):
+        line = f"{name}: {status}"
+        if length + len(line) > 3900:  # Real limit is 4096
+            lines.append(f"And {len(rows) - i} more...")
+            break
+        lines.append(line)
+        length += len(line) + 1
     return discord.Embed(
-        title="Downloading...",
-        description=f"```{progress_text}```",
+        title=title,
+        description="```" + "\n".join(lines) + "```",
         color=CALIFORNIA_GOLD,
         timestamp=datetime.datetime.fromtimestamp(time.time()),
     )
 
 
+def format_chart_stats(stats: ChartStats) -> str:
+    line = f"{stats.steps} steps ({stats.jumps} jumps, {stats.holds} holds)"
+    line += f", {stats.average_nps:g} average / {stats.peak_nps:g} peak NPS"
+    if stats.stream_measures:
+        line += f", {stats.stream_measures} measures of stream"
+        line += f" ({stats.breakdown})"
+    return line
+
+
+def format_charts(
+    sf: SimfileHeader, stats: Optional[list[Optional[ChartStats]]] = None
+) -> str:
+    """One line per chart, with its stats (see analytics.py) if given."""
+    lines = []
+    for i, c in enumerate(sf.charts):
+        line = f"**[{c.meter}]** {c.description}"
+        if stats and i < len(stats) and stats[i] is not None:
+            line += f" - {format_chart_stats(stats[i])}"
+        lines.append(line)
+    return "\n".join(lines)[:1000]
+
+
+def format_most_stream(
+    simfiles: list[SimfileHeader],
+    stats: dict[Path, list[Optional[ChartStats]]],
+    limit: int = 5,
+) -> str:
+    """The `limit` songs with the most stream, by their streamiest chart."""
+    streamiest = []
+    for sf in simfiles:
+        charts = [
+            (s.stream_measures, c.meter, s)
+            for c, s in zip(sf.charts, stats.get(sf.dir, []))
+            if s is not None and s.stream_measures
+        ]
+        if charts:
+            streamiest.append((max(charts, key=lambda c: c[0]), sf))
+    streamiest.sort(key=lambda item: item[0][0], reverse=True)
+    return "\n".join(
+        f"**[{meter}]** {sf.title}: {measures} measures "
+        + f"({chart.stream_ratio:.0%} of the chart)"
+        for (measures, meter, chart), sf in streamiest[:limit]
+    )
+
+
 def overwrite_song_embed(
-    _new_simfile: Simfile, _old_simfile: Simfile
+    new: SimfileHeader, old: Optional[SimfileHeader]
 ) -> discord.Embed:
     embed = discord.Embed(
         title="Overwrite existing song?", color=CALIFORNIA_GOLD
     )
+    for name, sf in [("New", new), ("Existing", old)]:
+        if sf is None:
+            continue
+        embed.add_field(
+            name=name,
+            value=f"{sf.title} - {sf.artist}\n{format_charts(sf)}"[:1000],
+        )
+    return embed
+
+
+def overwrite_pack_embed(
+    name: str, new: list[SimfileHeader], old: list[SimfileHeader]
+) -> discord.Embed:
+    embed = discord.Embed(
+        title="Overwrite existing pack?",
+        description=f"**{name}** is already on the machine.",
+        color=CALIFORNIA_GOLD,
+    )
+    new_titles = {sf.title for sf in new}
+    old_titles = {sf.title for sf in old}
+    embed.add_field(
+        name=f"New ({len(new)} songs)",
+        value=format_simfile_list(new) or "No songs",
+    )
+    embed.add_field(
+        name=f"Existing ({len(old)} songs)",
+        value=format_simfile_list(old) or "No songs",
+    )
+    if removed := sorted(old_titles - new_titles):
+        embed.add_field(
+            name=f"{len(removed)} songs would be removed",
+            value="\n".join(removed)[:1000],
+            inline=False,
+        )
     return embed
 
 
-def overwrite_pack_embed(_new_pack, _old_pack) -> discord.Embed:
+def format_duplicates(duplicates: list[Duplicate]) -> str:
+    lines = []
+    for d in sorted(duplicates, key=lambda d: (d.new.title, not d.identical)):
+        match = (
+            "same charts as"
+            if d.identical
+            else f"{d.shared_charts} of {len(d.new.charts)} charts in"
+        )
+        lines.append(
+            f"**{d.new.title}**: {match} {d.existing.title} "
+            + f"({d.existing.dir.parent.name})"
+        )
+    text = ""
+    for i, line in enumerate(lines):
+        if len(text) + len(line) > 1000:  # Real limit is 1024
+            text += f"And {len(lines) - i} more..."
+            break
+        text += f"{line}\n"
+    return text
+
+
+def duplicates_embed(duplicates: list[Duplicate]) -> discord.Embed:
     embed = discord.Embed(
-        title="Overwrite existing pack?", color=CALIFORNIA_GOLD
+        title="Already on the machine",
+        description="These charts are already installed. Add anyway?",
+        color=CALIFORNIA_GOLD,
     )
+    embed.add_field(name="Duplicates", value=format_duplicates(duplicates))
     return embed
 
 
+def attached_embed() -> discord.Embed:
+    return discord.Embed(
+        title="Already In Progress",
+        description="Someone else is adding this already. "
+        + "Waiting for their result...",
+        color=CALIFORNIA_GOLD,
+    )
+
+
+def overwrite_packs_embed(names: list[str]) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"Overwrite {len(names)} existing packs?",
+        description="\n".join(names)[:4000],
+        color=CALIFORNIA_GOLD,
+    )
+    return embed
+
+
+def queued_embed(position: int, eta: float) -> discord.Embed:
+    return discord.Embed(
+        title="Queued",
+        description=f"Position {position} in the queue. "
+        + f"Starting in about {format_duration(eta)}.",
+        color=CALIFORNIA_GOLD,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+
+
+def job_line(job: Job) -> str:
+    if job.kind == JobKind.ADD_SONGS:
+        target = f"{len(job.links)} songs"
+    else:
+        target = f"[{link_name(job.link)}]({job.link})"
+    return f"`#{job.id}` {job.kind} {target} by <@{job.user_id}>"
+
+
+def queue_embed(
+    running: list[Job], queued: list[Job], etas: dict[int, float]
+) -> discord.Embed:
+    embed = discord.Embed(
+        title="Job Queue",
+        description=None if running or queued else "Nothing queued.",
+        color=CALIFORNIA_GOLD,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+    if running:
+        now = time.time()
+        embed.add_field(
+            name="Running",
+            value="\n".join(
+                f"{job_line(job)}, for {format_duration(now - job.started)}"
+                for job in running
+            )[:1000],
+            inline=False,
+        )
+    if queued:
+        embed.add_field(
+            name="Queued",
+            value="\n".join(
+                f"{job_line(job)}, in ~{format_duration(etas[job.id])}"
+                for job in queued
+            )[:1000],
+            inline=False,
+        )
+    return embed
+
+
+def resumed_embed(job: Job) -> discord.Embed:
+    return discord.Embed(
+        title="Resuming Interrupted Job",
+        description=job_line(job),
+        color=CALIFORNIA_GOLD,
+    )
+
+
+def job_cancelled_embed() -> discord.Embed:
+    return discord.Embed(
+        title="Job Cancelled",
+        description="Nothing was changed.",
+        color=discord.Color.red(),
+    )
+
+
 def cancelled_embed() -> discord.Embed:
     return discord.Embed(
         title="Overwrite Cancelled",
@@ -51,17 +304,58 @@ def error_embed(e: Exception) -> discord.Embed:
     )
 
 
+def unreadable_simfile_embed(
+    song_dir: Path, user: Optional[discord.User] = None
+) -> discord.Embed:
+    """
+    For a song whose simfile couldn't be read; with `user`, a song they just
+    added, which is installed all the same.
+    """
+    description = f"{song_dir.name} in {song_dir.parent.name}"
+    if user is not None:
+        description += f"\nadded by <@{user.id}>; it was installed anyway"
+    return discord.Embed(
+        title="Could Not Read Simfile",
+        description=description,
+        color=CALIFORNIA_GOLD,
+    )
+
+
+def attach_banner(
+    embed: discord.Embed, banner: Optional[Path]
+) -> Optional[discord.File]:
+    """
+    Shows `banner` as the embed's image. Returns the file to send with it,
+    a cached thumbnail where possible (see thumbnails.py).
+    """
+    if banner is None:
+        return None
+    with STAGE_SECONDS.time(stage="thumbnail"):
+        path = banner_thumbnail(banner)
+    filename = f"banner{path.suffix}"
+    embed.set_image(url=f"attachment://{filename}")
+    return discord.File(path, filename=filename)
+
+
+def song_banner(
+    sf: SimfileHeader, pack: Optional[PackRecord]
+) -> Optional[Path]:
+    """The song's banner, falling back to its pack's."""
+    if sf.banner and sf.dir.joinpath(sf.banner).is_file():
+        return sf.dir.joinpath(sf.banner)
+    return pack.banner if pack else None
+
+
 def add_song_success(
-    sf: Simfile, path: str, user: discord.User
+    sf: SimfileHeader,
+    pack: PackRecord,
+    user: discord.User,
+    duplicates: Optional[list[Duplicate]] = None,
+    stats: Optional[list[Optional[ChartStats]]] = None,
 ) -> tuple[discord.Embed, Optional[discord.File]]:
-    banner_path = None
-    singles_pack = SimfilePack(Path(path).parents[1])
-    if sf.banner:
-        banner_path = Path(path).parent.joinpath(sf.banner)
-    elif singles_pack.banner():
-        banner_path = singles_pack.banner()
+    banner_path = song_banner(sf, pack)
     embed = discord.Embed(
-        title=f"Added {sf.title} to {singles_pack.name}",
+        title=f"Added {sf.title} to {pack.name}",
         description=f"added by <@{user.id}>",
         color=BERKELEY_BLUE,
         timestamp=datetime.datetime.fromtimestamp(time.time()),
@@ -69,32 +363,22 @@ def add_song_success(
     embed.add_field(name="Title", value=sf.title)
     embed.add_field(name="Artist", value=sf.artist)
     embed.add_field(
-        name="Charts",
-        value="\n".join(
-            [f"**[{c.meter}]** {c.description}" for c in sf.charts]
-        ),
-        inline=False,
+        name="Charts", value=format_charts(sf, stats), inline=False
     )
-    if banner_path:
-        embed.set_image(url=f"attachment://{sf.banner}")
-        return (embed, discord.File(banner_path, filename=sf.banner))
-    else:
-        return (embed, None)
+    if duplicates:
+        embed.add_field(
+            name="Also on the machine",
+            value=format_duplicates(duplicates),
+            inline=False,
+        )
+    return (embed, attach_banner(embed, banner_path))
 
 
-def add_pack_success(
-    pack: SimfilePack, user: discord.User
-) -> tuple[discord.Embed, Optional[discord.File]]:
-    embed = discord.Embed(
-        title=f"Added {pack.name}",
-        description=f"added by <@{user.id}>",
-        color=BERKELEY_BLUE,
-        timestamp=datetime.datetime.fromtimestamp(time.time()),
-    )
+def format_simfile_list(simfiles: list[SimfileHeader]) -> str:
     simfile_strings = [
         f"**{[int(c.meter) for c in sf.charts]}** {sf.title}"
         for sf in sorted(
-            list(pack.simfiles(strict=False)),
+            simfiles,
             key=lambda sf: sf.titletranslit or sf.title,
         )
     ]
@@ -105,13 +389,205 @@ def add_pack_success(
             break
         else:
             simfile_list += f"{line}\n"
+    return simfile_list
+
+
+def add_songs_success(
+    simfiles: list[SimfileHeader],
+    pack: Optional[PackRecord],
+    skipped: list[tuple[str, str]],
+    user: discord.User,
+) -> tuple[discord.Embed, Optional[discord.File]]:
+    embed = discord.Embed(
+        title=(
+            f"Added {len(simfiles)} songs to {pack.name}"
+            if simfiles and pack
+            else "No songs added"
+        ),
+        description=f"added by <@{user.id}>",
+        color=BERKELEY_BLUE,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+    if simfiles:
+        embed.add_field(name="Songs", value=format_simfile_list(simfiles))
+    if skipped:
+        embed.add_field(
+            name=f"{len(skipped)} not added",
+            value="\n".join(
+                f"**{name}**: {reason}" for name, reason in skipped
+            )[:1000],
+            inline=False,
+        )
+    return (
+        embed,
+        attach_banner(embed, pack.banner if simfiles and pack else None),
+    )
+
+
+def add_pack_success(
+    pack: PackRecord,
+    simfiles: list[SimfileHeader],
+    user: discord.User,
+    duplicates: Optional[list[Duplicate]] = None,
+    stats: Optional[dict[Path, list[Optional[ChartStats]]]] = None,
+) -> tuple[discord.Embed, Optional[discord.File]]:
+    embed = discord.Embed(
+        title=f"Added {pack.name}",
+        description=f"added by <@{user.id}>",
+        color=BERKELEY_BLUE,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
     embed.add_field(
-        name=f"Contains {len(simfile_strings)} songs",
-        value=simfile_list,
+        name=f"Contains {len(simfiles)} songs",
+        value=format_simfile_list(simfiles),
     )
-    if pack.banner():
-        banner_name = Path(pack.banner()).name
-        embed.set_image(url=f"attachment://{banner_name}")
-        return (embed, discord.File(pack.banner(), filename=banner_name))
-    else:
-        return (embed, None)
+    if most_stream := format_most_stream(simfiles, stats or {}):
+        embed.add_field(name="Most stream", value=most_stream, inline=False)
+    if duplicates:
+        embed.add_field(
+            name=f"{len({d.new.dir for d in duplicates})} songs already "
+            + "on the machine",
+            value=format_duplicates(duplicates),
+            inline=False,
+        )
+    return (embed, attach_banner(embed, pack.banner))
+
+
+def bulk_add_report(
+    added: list[tuple[PackRecord, int]],
+    skipped: list[tuple[str, str]],
+    user: discord.User,
+) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"Added {len(added)} of {len(added) + len(skipped)} packs",
+        description=f"added by <@{user.id}>",
+        color=BERKELEY_BLUE if added else discord.Color.red(),
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+    if added:
+        embed.add_field(
+            name="Added",
+            value="\n".join(
+                f"**{pack.name}** ({num_songs} songs)"
+                for pack, num_songs in added
+            )[:1000],
+            inline=False,
+        )
+    if skipped:
+        embed.add_field(
+            name=f"{len(skipped)} not added",
+            value="\n".join(
+                f"**{name}**: {reason}" for name, reason in skipped
+            )[:1000],
+            inline=False,
+        )
+    return embed
+
+
+def format_summary(summary: Summary, unit: str) -> str:
+    fmt = format_bytes if unit == "bytes" else format_seconds
+    return (
+        f"{summary.count}x, p50 {fmt(summary.p50)}, p90 {fmt(summary.p90)}, "
+        + f"p99 {fmt(summary.p99)}, max {fmt(summary.max)}"
+    )
+
+
+def format_family(family: Family) -> Optional[str]:
+    lines = []
+    for labels, summary in family.summaries():
+        name = "/".join(labels.values()) or "all"
+        lines.append(f"**{name}**: {format_summary(summary, family.unit)}")
+    return "\n".join(lines)[:1000] if lines else None
+
+
+def stats_embed(
+    edits: str, stalls: Optional[StallStats] = None
+) -> discord.Embed:
+    """
+    Recent timings of every metric (see metrics.py), plus `edits`, the edit
+    scheduler's counters, and `stalls`, the event loop watchdog's, if it's
+    running.
+    """
+    embed = discord.Embed(
+        title="Stats",
+        description=f"Over the last {format_duration(WINDOW_SECONDS)}.",
+        color=BERKELEY_BLUE,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+    for family in FAMILIES:
+        value = format_family(family)
+        if value is not None:
+            embed.add_field(name=family.help, value=value, inline=False)
+    if len(embed.fields) == 0:
+        embed.description += " Nothing recorded yet."
+    embed.add_field(name="Progress edits", value=edits, inline=False)
+    if stalls is not None:
+        embed.add_field(name="Event loop", value=str(stalls), inline=False)
+    if stalls is not None and stalls.last_stack:
+        embed.add_field(
+            name="Last stall",
+            value=f"```{stalls.last_stack[-1000:]}```",
+            inline=False,
+        )
+    return embed
+
+
+def cache_sweep_embed(result: CacheSweep, elapsed: float) -> discord.Embed:
+    embed = discord.Embed(
+        title="Song Cache Updated",
+        description=f"Checked {result.songs} songs "
+        + f"in {format_duration(elapsed)}.",
+        color=BERKELEY_BLUE,
+        timestamp=datetime.datetime.fromtimestamp(time.time()),
+    )
+    embed.add_field(name="Up to date", value=result.fresh)
+    embed.add_field(name="Outdated, removed", value=result.stale)
+    embed.add_field(name="Orphaned, removed", value=result.orphaned)
+    embed.set_footer(
+        text=f"{result.missing + result.stale} songs will be parsed "
+        + "on the next boot."
+    )
+    return embed
+
+
+def format_meters(meters: frozenset[str]) -> str:
+    return ", ".join(sorted(meters, key=lambda m: (len(m), m)))
+
+
+def search_choice_name(entry: SearchEntry) -> str:
+    """One-line summary of a search result, for autocomplete (100 chars)."""
+    name = f"{entry.title} - {entry.artist} [{format_meters(entry.meters)}]"
+    return f"{name} ({entry.pack})"[:100]
+
+
+def search_embed(query: str, entries: list[SearchEntry]) -> discord.Embed:
+    embed = discord.Embed(
+        title=f"Search results for {query}"[:256],
+        description=None if entries else "Nothing on the machine matches.",
+        color=BERKELEY_BLUE if entries else discord.Color.red(),
+    )
+    if entries:
+        embed.description = "\n".join(
+            f"**[{format_meters(e.meters)}]** {e.title} - {e.artist} "
+            + f"(*{e.pack}*)"
+            for e in entries
+        )[:4000]
+    return embed
+
+
+def song_embed(
+    sf: SimfileHeader,
+    pack: Optional[PackRecord],
+    stats: Optional[list[Optional[ChartStats]]] = None,
+) -> tuple[discord.Embed, Optional[discord.File]]:
+    banner_path = song_banner(sf, pack)
+    embed = discord.Embed(
+        title=sf.title,
+        description=f"in {pack.name if pack else sf.dir.parent.name}",
+        color=BERKELEY_BLUE,
+    )
+    embed.add_field(name="Artist", value=sf.artist)
+    embed.add_field(
+        name="Charts", value=format_charts(sf, stats), inline=False
+    )
+    return (embed, attach_banner(embed, banner_path))
@@ -0,0 +1,320 @@
+import hashlib
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+from simfile import ENCODINGS
+
+# Parameters holding note data. Their payloads are skipped, never stored.
+NOTES_KEYS = frozenset({"NOTES", "NOTES2"})
+# Number of `:`-separated chart fields preceding the note data in an SM
+# file's #NOTES parameter (stepstype, description, difficulty, meter, radar)
+SM_CHART_FIELDS = 5
+
+
+@dataclass(slots=True)
+class ChartHeader:
+    stepstype: Optional[str]
+    difficulty: Optional[str]
+    meter: Optional[str]
+    description: Optional[str]
+    # See chart_fingerprint; only set when asked for
+    fingerprint: Optional[str] = None
+    # See timing_fingerprint; set along with `fingerprint`
+    timing: Optional[str] = None
+
+
+@dataclass(slots=True)
+class SimfileHeader:
+    """The parts of a simfile needed for summaries and listings."""
+
+    dir: Path
+    path: Path
+    title: str
+    titletranslit: Optional[str]
+    artist: Optional[str]
+    # Banner filename relative to `dir`, as written in the simfile
+    banner: Optional[str]
+    charts: list[ChartHeader] = field(default_factory=list)
+    # See simfile_fingerprint; only set when asked for
+    fingerprint: Optional[str] = None
+
+
+@dataclass(slots=True)
+class ChartData:
+    """A chart's note data and the timing that applies to it, unparsed."""
+
+    header: ChartHeader
+    notes: str
+    bpms: str
+    stops: str
+
+
+def read_headers(path: Path, fingerprints: bool = False) -> SimfileHeader:
+    """
+    Reads the song and chart headers of the SM or SSC file at `path`.
+
+    Unlike `simfile.open`, note data is skipped over without being parsed or
+    kept, so the cost of a summary doesn't grow with chart length, unless
+    `fingerprints` are asked for. Encodings are detected the same way as
+    `simfile.open`.
+    """
+    for encoding in ENCODINGS:
+        try:
+            text = path.read_text(encoding=encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(f"{path} has an unknown encoding")
+    return _read_headers(path, text, fingerprints)
+
+
+def read_chart_data(path: Path) -> tuple[SimfileHeader, list[ChartData]]:
+    """
+    `read_headers` (with fingerprints) that also returns each chart's note
+    data and timing, for analysis (see analytics.py).
+    """
+    for encoding in ENCODINGS:
+        try:
+            text = path.read_text(encoding=encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(f"{path} has an unknown encoding")
+    chart_data: list[ChartData] = []
+    return _read_headers(path, text, True, chart_data), chart_data
+
+
+def parse_headers(
+    path: Path, data: bytes, fingerprints: bool = False
+) -> SimfileHeader:
+    """
+    `read_headers` for a simfile that isn't on disk (e.g. one read out of an
+    archive). `path` is where it would be, and only determines the format,
+    `dir` and the fallback title.
+    """
+    for encoding in ENCODINGS:
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(f"{path} has an unknown encoding")
+    # Same newline translation as read_text
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return _read_headers(path, text, fingerprints)
+
+
+def _read_headers(
+    path: Path,
+    text: str,
+    fingerprints: bool = False,
+    chart_data: Optional[list[ChartData]] = None,
+) -> SimfileHeader:
+    is_ssc = path.suffix.lower() == ".ssc"
+    song: dict[str, str] = {}
+    charts: list[ChartHeader] = []
+    # SSC chart properties live in their own parameters after #NOTEDATA
+    chart: Optional[dict[str, str]] = None
+    notes_fields = 0 if is_ssc else SM_CHART_FIELDS
+    keep_notes = fingerprints or chart_data is not None
+    # Note data of each chart, for chart_data, and its chart properties
+    chart_notes: list[str] = []
+    chart_timing: list[dict[str, str]] = []
+    chart_properties: dict[str, str] = {}
+    for key, components in _parameters(text, notes_fields, keep_notes):
+        num_charts = len(charts)
+        if is_ssc:
+            if key == "NOTEDATA":
+                chart = {}
+            elif chart is None:
+                song[key] = components[0]
+            elif key in NOTES_KEYS:
+                charts.append(_ssc_chart(chart))
+                chart_properties = chart
+                chart = None
+            else:
+                chart[key] = components[0]
+        elif key in NOTES_KEYS:
+            fields = components + [""] * (SM_CHART_FIELDS - len(components))
+            charts.append(
+                ChartHeader(
+                    stepstype=fields[0],
+                    difficulty=fields[2],
+                    meter=fields[3],
+                    description=fields[1],
+                )
+            )
+        else:
+            song[key] = components[0]
+        if keep_notes and len(charts) > num_charts:
+            # The note data is the extra component _parameters kept
+            notes = (components[notes_fields : notes_fields + 1] or [""])[0]
+            if fingerprints:
+                charts[-1].fingerprint = chart_fingerprint(
+                    charts[-1].stepstype, notes
+                )
+            if chart_data is not None:
+                chart_notes.append(notes)
+            chart_timing.append(chart_properties)
+    # SSC charts may have timing of their own; SM charts never do
+    timing = [
+        (
+            properties.get("BPMS") or song.get("BPMS", ""),
+            properties.get("STOPS") or song.get("STOPS", ""),
+        )
+        for properties in chart_timing
+    ]
+    if fingerprints:
+        for header, (bpms, stops) in zip(charts, timing):
+            header.timing = timing_fingerprint(bpms, stops)
+    if chart_data is not None:
+        for header, notes, (bpms, stops) in zip(charts, chart_notes, timing):
+            chart_data.append(ChartData(header, notes, bpms, stops))
+    return SimfileHeader(
+        dir=path.parent,
+        path=path,
+        title=song.get("TITLE") or path.parent.name,
+        titletranslit=song.get("TITLETRANSLIT") or None,
+        artist=song.get("ARTIST"),
+        banner=song.get("BANNER") or None,
+        charts=charts,
+        fingerprint=simfile_fingerprint(charts) if fingerprints else None,
+    )
+
+
+def _ssc_chart(properties: dict[str, str]) -> ChartHeader:
+    return ChartHeader(
+        stepstype=properties.get("STEPSTYPE"),
+        difficulty=properties.get("DIFFICULTY"),
+        meter=properties.get("METER"),
+        description=properties.get("DESCRIPTION"),
+    )
+
+
+# Fingerprints
+# Note data is normalized before hashing, so the same chart matches whatever
+# the whitespace, comments and measure resolution it was saved with (e.g. a
+# measure of 8ths written out as 16ths) and however many blank measures it
+# ends with. Timing and metadata aren't included: a re-upload with a nudged
+# offset or a new meter is still the same chart.
+
+NOTES_COMMENT = re.compile(r"//[^\n]*")
+
+
+def _is_blank(rows: list[str]) -> bool:
+    return not any(row.strip("0") for row in rows)
+
+
+def chart_fingerprint(stepstype: Optional[str], notes: str) -> Optional[str]:
+    """Hash of a chart's normalized note data, or None if it's empty."""
+    measures = []
+    for measure in NOTES_COMMENT.sub("", notes).split(","):
+        rows = measure.split()
+        while len(rows) > 1 and len(rows) % 2 == 0 and _is_blank(rows[1::2]):
+            rows = rows[::2]
+        measures.append(",".join(rows))
+    while measures and _is_blank(measures[-1].split(",")):
+        measures.pop()
+    if not measures:
+        return None
+    data = f"{(stepstype or '').strip().lower()}\n" + ";".join(measures)
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def timing_fingerprint(bpms: str, stops: str) -> str:
+    """
+    Hash of the timing a chart is played with, which chart_fingerprint
+    leaves out but note counts per second depend on (see analytics.py).
+    """
+    data = f"{''.join(bpms.split())}\n{''.join(stops.split())}"
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def simfile_fingerprint(charts: list[ChartHeader]) -> Optional[str]:
+    """Hash of a simfile's chart fingerprints, regardless of their order."""
+    hashes = sorted(c.fingerprint for c in charts if c.fingerprint)
+    if not hashes:
+        return None
+    data = "\n".join(hashes).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# Tokens that end a run of plain text inside an MSD value: an escape, a
+# component or parameter delimiter, a comment, or a line starting with `#`
+# (which ends a parameter that is missing its `;`)
+SPECIAL_TOKENS = re.compile(r"\\|:|;|//|\n\s*#")
+# Tokens to look for between parameters: a parameter, or a comment (which
+# may hide one)
+PARAMETER_TOKENS = re.compile(r"#|//")
+
+
+def _parameters(
+    text: str, notes_fields: int, keep_notes: bool = False
+) -> Iterator[tuple[str, list]]:
+    """
+    Minimal MSD tokenizer yielding `(KEY, components)` pairs.
+
+    Follows msdparser's rules for escapes, comments and missing semicolons.
+    Repeated keys are all yielded; like StepMania, callers should let the
+    last one win. Only the first component of a parameter is kept, except
+    for note parameters, where the first `notes_fields` components are kept
+    and the note data itself is skipped with a single `str.find` (or, with
+    `keep_notes`, sliced out raw as one more component).
+    """
+    pos = 0
+    while (match := PARAMETER_TOKENS.search(text, pos)) is not None:
+        start = match.start()
+        if match.group() == "//":
+            end = text.find("\n", start)
+            if end < 0:
+                return
+            pos = end
+            continue
+        colon = text.find(":", start)
+        if colon < 0:
+            return
+        key = text[start + 1 : colon].strip().upper()
+        pos = colon + 1
+        wanted = notes_fields if key in NOTES_KEYS else 1
+        components = []
+        delimiter = ":"
+        while delimiter == ":" and len(components) < wanted:
+            value, pos, delimiter = _scan_component(text, pos)
+            components.append(value.strip())
+        if delimiter == ":":
+            # Skip the remaining components (or note data) unparsed
+            end = text.find(";", pos)
+            if end < 0:
+                end = len(text)
+            if keep_notes and key in NOTES_KEYS:
+                components.append(text[pos:end])
+            pos = end + 1
+        yield key, components or [""]
+
+
+def _scan_component(text: str, pos: int) -> tuple[str, int, str]:
+    """
+    Reads one component starting at `pos`. Returns its value, the position
+    to continue from, and the delimiter that ended it (`:`, `;`, `#` for a
+    missing semicolon, or "" at the end of the text).
+    """
+    parts = []
+    while (match := SPECIAL_TOKENS.search(text, pos)) is not None:
+        parts.append(text[pos : match.start()])
+        token = match.group()
+        if token == "\\":
+            parts.append(text[match.end() : match.end() + 1])
+            pos = match.end() + 1
+        elif token == "//":
+            end = text.find("\n", match.end())
+            pos = len(text) if end < 0 else end
+        elif token in (":", ";"):
+            return "".join(parts), match.end(), token
+        else:
+            return "".join(parts), match.end() - 1, "#"
+    parts.append(text[pos:])
+    return "".join(parts), len(text), ""
@@ -1,33 +1,146 @@
 import asyncio
+import io
 import sys
+import threading
+import time
+from contextlib import AbstractAsyncContextManager, nullcontext
+from pathlib import Path
+from typing import Callable, Optional
 import discord
 import itg_cli
 import logging
 from discord.ext import commands
 from discord import Interaction, app_commands
 
+from itg_buddy.extensions.itg_cli import pipeline, song_cache
+from itg_buddy.extensions.itg_cli.batch import Batch, BatchItem, parse_links
 from itg_buddy.extensions.itg_cli.config import ItgCliCogConfig
+from itg_buddy.extensions.itg_cli.download_cache import DownloadCache
+from itg_buddy.extensions.itg_cli.downloader import Downloader
+from itg_buddy.extensions.itg_cli.edits import EDIT_SCHEDULER
 from itg_buddy.extensions.itg_cli.embeds import (
     add_pack_success,
     add_song_success,
+    add_songs_success,
+    attached_embed,
+    bulk_add_report,
+    cache_sweep_embed,
     cancelled_embed,
     error_embed,
+    job_cancelled_embed,
+    queue_embed,
+    queued_embed,
+    resumed_embed,
+    search_choice_name,
+    search_embed,
+    song_banner,
+    song_embed,
+    stats_embed,
+    unreadable_simfile_embed,
+)
+from itg_buddy.extensions.itg_cli.jobs import (
+    Job,
+    JobCancelled,
+    JobKind,
+    JobQueue,
+    is_admin,
+    job_priority,
+)
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader
+from itg_buddy.extensions.itg_cli.library import LibraryIndex
+from itg_buddy.extensions.itg_cli.metrics import (
+    DISCORD_SECONDS,
+    STAGE_SECONDS,
+    UPLOAD_BYTES,
+    MetricsServer,
 )
 from itg_buddy.extensions.itg_cli.overwrite import (
-    get_add_pack_overwrite_handler,
-    get_add_song_overwrite_handler,
+    ask_add_duplicates,
+    ask_overwrite_packs,
+    ask_overwrite_pack,
+    ask_overwrite_song,
+    get_overwrite_handler,
+)
+from itg_buddy.extensions.itg_cli.search import SearchIndex
+from itg_buddy.extensions.itg_cli.analytics import ChartAnalytics, load_numpy
+from itg_buddy.extensions.itg_cli.thumbnails import (
+    ThumbnailCache,
+    load_pillow,
+    set_thumbnail_cache,
+)
+from itg_buddy.extensions.itg_cli.watcher import LibraryWatcher
+from itg_buddy.extensions.itg_cli.singleflight import (
+    SingleFlight,
+    link_name,
+    normalize_url,
 )
-from itg_buddy.extensions.itg_cli.utils import edit_response
+from itg_buddy.extensions.itg_cli.worker import WorkerPool
 from itg_buddy.extensions.itg_cli.wrappers import (
+    EXTRACT_EXECUTOR,
     add_pack_async,
     add_song_async,
+    install_pack_async,
+    install_song_async,
+    keep_existing,
+    prepare_pack,
+    prepare_song,
+    preview_stage,
+    replace_existing,
+    run_isolated_stage,
+    set_download_cache,
+    set_download_concurrency,
+    set_downloader,
+    set_worker_pool,
 )
 
+# Seconds a finished add_pack/add_song result is reused for repeat requests
+RECENT_JOB_TTL = 300
+# Most links accepted by one /bulk_add
+MAX_BULK_LINKS = 100
+# Most results listed by /search (autocomplete shows up to 25)
+MAX_SEARCH_RESULTS = 15
+# Seconds the watcher's events for a directory the bot just installed are
+# ignored; the install indexes it itself
+INSTALL_ECHO_SECONDS = 60
+
+
+def still_installed(result: tuple[Path, discord.User]) -> bool:
+    """Whether a pack or song a job installed is still on the machine."""
+    return result[0].is_dir()
+
+
+def file_size(file: discord.File) -> int:
+    """Size of an attachment, leaving its position alone."""
+    position = file.fp.tell()
+    size = file.fp.seek(0, io.SEEK_END)
+    file.fp.seek(position)
+    return size
+
 
 class ItgCliCog(commands.Cog):
     bot: commands.Bot
     logger: logging.Logger
     config: ItgCliCogConfig
+    library: LibraryIndex
+    # In-memory copy of the library for /search, kept in step with `library`
+    search_index: SearchIndex
+    # Keeps both indexes (and the song cache) in step with changes made
+    # outside the bot, e.g. packs copied over USB
+    watcher: LibraryWatcher
+    # Directories installs just renamed into place, and when, so the watcher
+    # seeing those renames doesn't index them a second time
+    installed: dict[Path, float]
+    thumbnails: Optional[ThumbnailCache]
+    # Processes that extract and install packs (see worker.py), if enabled
+    workers: Optional[WorkerPool]
+    analytics: ChartAnalytics
+    # Identical in-flight/recent jobs, keyed by normalized link and archive
+    # hash. Results are (installed directory, user who added it).
+    pack_jobs: SingleFlight[tuple[Path, discord.User]]
+    song_jobs: SingleFlight[tuple[Path, discord.User]]
+    job_queue: JobQueue
+    # Serves metrics to Prometheus, if METRICS_PORT is set
+    metrics_server: Optional[MetricsServer]
 
     def __init__(
         self,
@@ -41,6 +154,176 @@ class ItgCliCog(commands.Cog):
         self.logger = self.logger = logging.getLogger(
             f"{bot.__class__.__name__}.{self.__class__.__name__}"
         )
+        # Finish or clean up installs interrupted by the last shutdown before
+        # any job can touch the staging directory
+        self.staging = pipeline.staging_dir(self.config.packs)
+        for dest in pipeline.recover_installs(self.staging):
+            self.logger.info(f"Finished interrupted install of {dest}")
+        set_download_concurrency(self.config.download_concurrency)
+        downloader = Downloader(
+            self.config.data.joinpath("partial"),
+            self.config.download_segments,
+            pool_size=self.config.download_concurrency
+            * self.config.download_segments,
+        )
+        set_downloader(downloader)
+        # Started by _warm_up; until then, installs run on threads
+        self.workers = None
+        self._warm_up_task = None
+        # Resumes interrupted jobs once the bot is ready, then the jobs it
+        # resumed, until each finishes
+        self._resume_task: Optional[asyncio.Task] = None
+        self._resumed_jobs: set[asyncio.Task] = set()
+        if self.config.download_cache_size > 0:
+            set_download_cache(
+                DownloadCache(
+                    self.config.data.joinpath("downloads"),
+                    self.config.download_cache_size,
+                    downloader,
+                )
+            )
+        self.library = LibraryIndex(
+            self.config.data.joinpath("library.db"), self.config.packs
+        )
+        self.search_index = SearchIndex()
+        self.thumbnails = None
+        if self.config.thumbnail_cache_size > 0:
+            self.thumbnails = ThumbnailCache(
+                self.config.data.joinpath("thumbnails"),
+                self.config.thumbnail_cache_size,
+            )
+        set_thumbnail_cache(self.thumbnails)
+        self.analytics = ChartAnalytics(
+            self.config.data.joinpath("analytics.db")
+        )
+        self.installed = {}
+        self._installed_lock = threading.Lock()
+        self.watcher = LibraryWatcher(
+            self.config.packs, self._apply_library_changes
+        )
+        # A result is only reused while what it installed is still there
+        self.pack_jobs = SingleFlight(
+            RECENT_JOB_TTL, still_valid=still_installed
+        )
+        self.song_jobs = SingleFlight(
+            RECENT_JOB_TTL, still_valid=still_installed
+        )
+        self.job_queue = JobQueue(
+            self.config.data.joinpath("jobs.db"), self.config.job_concurrency
+        )
+        self.cache_sweep_lock = asyncio.Lock()
+        self.metrics_server = None
+        if self.config.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.config.metrics_port)
+
+    async def cog_load(self):
+        # Everything that can wait for the bot to be connected does, so it
+        # doesn't compete with logging in
+        self._warm_up_task = asyncio.create_task(self._warm_up_when_ready())
+        self._resume_task = asyncio.create_task(self._resume_jobs())
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError:
+                # e.g. the port is taken; the bot works fine without metrics
+                port = self.config.metrics_port
+                self.logger.exception(f"Could not serve metrics on {port}")
+                self.metrics_server = None
+
+    async def cog_unload(self):
+        if self._warm_up_task is not None and not self.bot.is_ready():
+            # Still waiting to warm up
+            self._warm_up_task.cancel()
+        if self._resume_task is not None:
+            self._resume_task.cancel()
+        for task in self._resumed_jobs:
+            task.cancel()
+        in_sync = self.watcher.in_sync
+        await asyncio.to_thread(self.watcher.stop)
+        if in_sync:
+            await asyncio.to_thread(self.library.save_snapshot)
+        if self.workers is not None:
+            set_worker_pool(None)
+            await asyncio.to_thread(self.workers.shutdown)
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+
+    async def _warm_up_when_ready(self):
+        await self.bot.wait_until_ready()
+        await self._warm_up()
+
+    async def _warm_up(self):
+        """
+        Starts the install workers, brings the library index up to date and
+        imports what chart embeds need. Lookups made before the refresh
+        finishes just see the previous snapshot.
+        """
+        start = time.perf_counter()
+        if self.config.install_workers > 0:
+            self.workers = WorkerPool(self.config.install_workers)
+            set_worker_pool(self.workers)
+        await self._refresh_library()
+        await asyncio.to_thread(load_numpy)
+        await asyncio.to_thread(load_pillow)
+        self.logger.info(f"Warmed up in {time.perf_counter() - start:.2f} s")
+
+    async def _refresh_library(self):
+        try:
+            # Start watching first, so nothing changed during the refresh is
+            # missed. Only the packs that changed since a clean shutdown need
+            # rescanning, if the watcher was running until then.
+            trust_snapshot = await asyncio.to_thread(
+                self.library.take_snapshot
+            )
+            await asyncio.to_thread(self.watcher.start)
+            await asyncio.to_thread(self.library.refresh, trust_snapshot)
+            self.logger.info(
+                "Library index refreshed"
+                + (" (from snapshot)" if trust_snapshot else "")
+            )
+            await asyncio.to_thread(
+                lambda: self.search_index.replace(self.library.simfiles())
+            )
+            self.logger.info(f"Search index built ({len(self.search_index)})")
+        except Exception:
+            self.logger.exception("Library index refresh failed")
+
+    async def _resume_jobs(self):
+        # Jobs that were queued or running when the bot stopped are rerun
+        # from scratch, reporting in the channel they were requested in
+        await self.bot.wait_until_ready()
+        for job in self.job_queue.interrupted():
+            task = asyncio.create_task(self._resume_job(job))
+            self._resumed_jobs.add(task)
+            task.add_done_callback(self._resumed_jobs.discard)
+
+    async def _resume_job(self, job: Job):
+        bot_response = None
+        try:
+            channel = self.bot.get_channel(
+                job.channel_id
+            ) or await self.bot.fetch_channel(job.channel_id)
+            user = await self.bot.fetch_user(job.user_id)
+            bot_response = await channel.send(embed=resumed_embed(job))
+        except Exception as e:
+            self.logger.exception(f"Could not resume job {job.id}")
+            self.job_queue.abandon(job, str(e))
+            return
+        self.logger.info(f"Resuming job {job.id} ({job.kind} {job.link})")
+        try:
+            if job.kind == JobKind.ADD_PACK:
+                await self._run_add_pack(bot_response, user, job.link, job)
+            elif job.kind == JobKind.ADD_SONGS:
+                await self._run_add_song_batch(
+                    bot_response, user, job.links, job
+                )
+            else:
+                await self._run_add_song(bot_response, user, job.link, job)
+        except Exception as e:
+            self.logger.exception(f"Resumed job {job.id} raised an exception")
+            await EDIT_SCHEDULER.edit(
+                bot_response, embed=error_embed(e), view=None
+            )
 
     @app_commands.command(description="Add a pack to the machine.")
     @app_commands.describe(link="Link to the pack to add")
@@ -51,38 +334,498 @@ class ItgCliCog(commands.Cog):
     ):
         self.logger.info(f"{inter.user} executed add_pack with link {link}")
 
-        await inter.response.defer(thinking=True)
+        with DISCORD_SECONDS.time(call="defer"):
+            await inter.response.defer(thinking=True)
+        await self._run_add_pack(inter, inter.user, link)
 
-        # Run add_pack and handle exceptions accordingly
-        try:
-            pack, _num_courses = await add_pack_async(
+    async def _run_add_pack(
+        self,
+        bot_response: discord.Interaction | discord.Message,
+        user: discord.User,
+        link: str,
+        job: Optional[Job] = None,
+    ):
+        async def add_pack(flight, queued: Job, confirmed: Optional[str]):
+            pack_dir, _num_courses = await add_pack_async(
                 link,
                 self.config.packs,
                 self.config.courses,
-                inter,
-                overwrite=get_add_pack_overwrite_handler(
-                    inter, asyncio.get_running_loop()
+                bot_response,
+                cache=self.config.cache,
+                overwrite=get_overwrite_handler(
+                    bot_response,
+                    user,
+                    confirmed,
+                    released=lambda: self._released(queued),
                 ),
                 delete_macos_files_flag=True,
+                on_download=lambda digest: flight.claim(("sha256", digest)),
+                on_extracted=lambda pack_path: self._confirm_duplicates(
+                    bot_response,
+                    user,
+                    [d for d in pack_path.iterdir() if d.is_dir()],
+                    self.config.packs.joinpath(pack_path.name),
+                    whole=True,
+                    job=queued,
+                ),
+            )
+            self._record_install(pack_dir)
+            return pack_dir, user
+
+        async def preview_and_run(flight):
+            # The overwrite question is settled before the job is queued, so
+            # a user thinking about it doesn't hold up the queue
+            confirmed = await self._preview_pack(bot_response, user, link)
+            return await self._run_job(
+                JobKind.ADD_PACK,
+                bot_response,
+                user,
+                link,
+                job,
+                lambda queued: add_pack(flight, queued, confirmed),
+            )
+
+        # Run add_pack through the job queue (or wait on an identical job)
+        # and handle exceptions accordingly
+        try:
+            pack_dir, added_by = await self.pack_jobs.run(
+                normalize_url(link),
+                preview_and_run,
+                on_wait=lambda: EDIT_SCHEDULER.edit(
+                    bot_response, embed=attached_embed()
+                ),
             )
         except itg_cli.OverwriteException:
-            await inter.edit_original_response(
-                embed=cancelled_embed(), view=None
+            await EDIT_SCHEDULER.edit(
+                bot_response, embed=cancelled_embed(), view=None
             )
             return
+        except JobCancelled:
+            await EDIT_SCHEDULER.edit(
+                bot_response, embed=job_cancelled_embed(), view=None
+            )
+            return
+
+        # Update the library index and send result message on success
+        embed, file = await asyncio.to_thread(
+            self._pack_success, pack_dir, added_by
+        )
+        await self._send_result(bot_response, embed, file)
+
+    async def _preview_pack(
+        self,
+        bot_response: discord.Interaction | discord.Message,
+        user: discord.User,
+        link: str,
+    ) -> Optional[str]:
+        """
+        Previews the pack at `link` and, if it would replace one on the
+        machine, asks about overwriting it before anything is downloaded.
+        Returns the name of the pack it's OK to replace, if any.
+        """
+        preview = await preview_stage(link, bot_response)
+        if preview is None or preview.pack_name is None:
+            return None
+        pack_dir = self.config.packs.joinpath(preview.pack_name)
+        if not pack_dir.is_dir():
+            return None
+        old = await asyncio.to_thread(self._existing_pack, pack_dir)
+        if not await ask_overwrite_pack(
+            bot_response, user, preview.pack_name, preview.simfiles, old
+        ):
+            raise itg_cli.OverwriteException("Pack already exists.")
+        # Clear the buttons before the download's progress takes over
+        await EDIT_SCHEDULER.edit(bot_response, view=None)
+        return preview.pack_name
+
+    async def _preview_song(
+        self,
+        bot_response: discord.Interaction | discord.Message,
+        user: discord.User,
+        link: str,
+    ) -> Optional[str]:
+        """`_preview_pack` for a song going into the singles pack."""
+        preview = await preview_stage(link, bot_response)
+        if preview is None or preview.song_name is None:
+            return None
+        song_dir = self.config.singles.joinpath(preview.song_name)
+        if not song_dir.is_dir() or len(preview.simfiles) != 1:
+            return None
+        old = await asyncio.to_thread(self._existing_song, song_dir)
+        if not await ask_overwrite_song(
+            bot_response, user, preview.simfiles[0], old
+        ):
+            raise itg_cli.OverwriteException("Simfile already exists.")
+        # Clear the buttons before the download's progress takes over
+        await EDIT_SCHEDULER.edit(bot_response, view=None)
+        return preview.song_name
+
+    async def _confirm_duplicates(
+        self,
+        bot_response: discord.Interaction | discord.Message,
+        user: discord.User,
+        song_dirs: list[Path],
+        dest: Path,
+        whole: bool,
+        job: Optional[Job] = None,
+    ) -> None:
+        """
+        Checks the extracted `song_dirs` against the library's chart
+        fingerprints and, if they're already on the machine somewhere other
+        than `dest` (which an overwrite would replace anyway), asks before
+        installing them again. With `whole`, only asks if every song is
+        already there, since a pack sharing a few songs is still worth adding.
+        `job`'s queue slot is freed while the user decides.
+        """
+        # Reading the simfiles is CPU-bound, so it runs off the bot process
+        simfiles = await run_isolated_stage(
+            EXTRACT_EXECUTOR,
+            lambda _event: None,
+            pipeline.read_simfiles,
+            song_dirs,
+        )
+        duplicates = await asyncio.to_thread(
+            self.library.duplicates, simfiles, exclude=dest
+        )
+        identical = {d.new.dir for d in duplicates if d.identical}
+        if not identical or (whole and len(identical) < len(song_dirs)):
+            return
+        async with self._released(job):
+            add_anyway = await ask_add_duplicates(
+                bot_response, user, [d for d in duplicates if d.identical]
+            )
+        if not add_anyway:
+            raise itg_cli.OverwriteException("Already on the machine.")
+        await EDIT_SCHEDULER.edit(bot_response, view=None)
 
-        # Send result message on success
-        embed, file = add_pack_success(pack, inter.user)
-        await inter.delete_original_response()
-        await inter.channel.send(embed=embed, file=file)
+    async def _run_job(
+        self,
+        kind: JobKind,
+        bot_response: discord.Interaction | discord.Message,
+        user: discord.User,
+        link: str,
+        job: Optional[Job],
+        func,
+        on_queued: Optional[Callable[[int, float], None]] = None,
+    ):
+        """
+        Runs `func(job)` as a queued job (a new one, unless resuming `job`),
+        showing its place in the queue on `bot_response` while it waits, or
+        passing it to `on_queued` instead.
+        """
+
+        def show_position(position: int, eta: float) -> None:
+            EDIT_SCHEDULER.submit(
+                bot_response, embed=queued_embed(position, eta)
+            )
+
+        if job is None:
+            job = await self.job_queue.create(
+                kind,
+                link,
+                user.id,
+                bot_response.channel.id,
+                job_priority(user, kind),
+            )
+        return await self.job_queue.run(
+            job, lambda: func(job), on_queued=on_queued or show_position
+        )
+
+    def _released(self, job: Optional[Job]) -> AbstractAsyncContextManager:
+        """Frees `job`'s queue slot, if it has one, while waiting on a user."""
+        return nullcontext() if job is None else self.job_queue.released(job)
+
+    async def _send_result(
+        self,
+        bot_response: discord.Interaction | discord.Message,
+        embed: discord.Embed,
+        file: Optional[discord.File],
+    ):
+        # Delete progress message and send success message
+        await EDIT_SCHEDULER.close(bot_response)
+        with DISCORD_SECONDS.time(call="delete"):
+            if isinstance(bot_response, discord.Interaction):
+                await bot_response.delete_original_response()
+            elif isinstance(bot_response, discord.Message):
+                await bot_response.delete()
+        if file is not None:
+            UPLOAD_BYTES.observe(file_size(file))
+        with DISCORD_SECONDS.time(call="send_result"):
+            await bot_response.channel.send(embed=embed, file=file)
 
     @add_pack.error
     async def add_pack_error(
         self, interaction: Interaction, error: commands.CommandError
     ):
         self.logger.exception(f"add_pack threw an exception")
-        await interaction.edit_original_response(
-            embed=error_embed(sys.exception()), view=None
+        await EDIT_SCHEDULER.edit(
+            interaction, embed=error_embed(sys.exception()), view=None
+        )
+
+    @app_commands.command(description="Add several packs to the machine.")
+    @app_commands.describe(
+        links="Links to the packs to add, separated by spaces",
+        file="Text file with one link per line",
+    )
+    async def bulk_add(
+        self,
+        inter: discord.Interaction,
+        links: Optional[str] = None,
+        file: Optional[discord.Attachment] = None,
+    ):
+        self.logger.info(f"{inter.user} executed bulk_add")
+
+        with DISCORD_SECONDS.time(call="defer"):
+            await inter.response.defer(thinking=True)
+
+        text = links or ""
+        if file is not None:
+            text += "\n" + (await file.read()).decode(errors="replace")
+        urls = parse_links(text)
+        if not urls:
+            raise ValueError("No links supplied.")
+        if len(urls) > MAX_BULK_LINKS:
+            raise ValueError(f"Too many links (at most {MAX_BULK_LINKS}).")
+
+        items = [BatchItem(link_name(url)) for url in urls]
+        batch = Batch(f"Adding {len(items)} packs...", items, inter)
+        batch.update()
+        pack_dirs: dict[int, Path] = {}
+        conflicts: list[int] = []
+
+        async def install(
+            flight, i: int, overwrite
+        ) -> tuple[Path, discord.User]:
+            item = items[i]
+            async with prepare_pack(
+                urls[i],
+                batch.reporter(item),
+                on_download=lambda digest: flight.claim(("sha256", digest)),
+                staging=self.staging,
+            ) as (pack_path, working_dir):
+                item.name = pack_path.name
+                batch.set_status(item, "Installing...")
+                pack_dir, _num_courses = await install_pack_async(
+                    pack_path,
+                    working_dir,
+                    self.config.packs,
+                    self.config.courses,
+                    lambda _event: None,
+                    overwrite=overwrite,
+                    delete_macos_files_flag=True,
+                    cache=self.config.cache,
+                )
+            self._record_install(pack_dir)
+            return pack_dir, inter.user
+
+        async def attached(item: BatchItem) -> None:
+            batch.set_status(item, "Already being added...")
+
+        async def add(i: int, overwrite) -> None:
+            # Each link is a job of its own, queued with everyone else's,
+            # unless the same pack is already being added
+            item = items[i]
+            try:
+                pack_dir, _added_by = await self.pack_jobs.run(
+                    normalize_url(urls[i]),
+                    lambda flight: self._run_job(
+                        JobKind.ADD_PACK,
+                        inter,
+                        inter.user,
+                        urls[i],
+                        None,
+                        lambda _queued: install(flight, i, overwrite),
+                        on_queued=batch.queue_reporter(item),
+                    ),
+                    on_wait=lambda: attached(item),
+                )
+            except itg_cli.OverwriteException:
+                conflicts.append(i)
+                batch.set_status(item, "Already exists")
+                return
+            except JobCancelled:
+                batch.finish(item, "Cancelled", "Cancelled")
+                return
+            except Exception as e:
+                self.logger.exception(f"bulk_add could not add {urls[i]}")
+                batch.finish(item, "Failed", str(e))
+                return
+            batch.set_status(item, "Indexing...")
+            await asyncio.to_thread(
+                lambda: self._warm_banners(self._index_pack(pack_dir))
+            )
+            pack_dirs[i] = pack_dir
+            batch.finish(item, "Installed")
+
+        # Existing packs are skipped on the first pass, then overwritten
+        # together if the user agrees to a single prompt. The download cache
+        # makes the second pass cheap.
+        await asyncio.gather(
+            *(add(i, keep_existing) for i in range(len(urls)))
+        )
+        if conflicts:
+            retry, conflicts = sorted(conflicts), []
+            names = [items[i].name for i in retry]
+            if await ask_overwrite_packs(inter, names):
+                for i in retry:
+                    batch.set_status(items[i], "Queued")
+                await asyncio.gather(
+                    *(add(i, replace_existing) for i in retry)
+                )
+            else:
+                for i in retry:
+                    batch.finish(items[i], "Kept existing", "Already exists")
+
+        skipped = [(item.name, item.error) for item in items if item.error]
+        report = await asyncio.to_thread(
+            self._bulk_report,
+            [pack_dirs[i] for i in sorted(pack_dirs)],
+            skipped,
+            inter.user,
+        )
+        await EDIT_SCHEDULER.edit(inter, embed=report, view=None)
+
+    @bulk_add.error
+    async def bulk_add_error(
+        self, interaction: Interaction, error: commands.CommandError
+    ):
+        self.logger.exception("bulk_add threw an exception")
+        await EDIT_SCHEDULER.edit(
+            interaction, embed=error_embed(sys.exception()), view=None
+        )
+
+    @app_commands.command(description="Show queued and running jobs.")
+    async def queue(self, inter: discord.Interaction):
+        await inter.response.send_message(
+            embed=queue_embed(
+                self.job_queue.running(),
+                self.job_queue.queued(),
+                self.job_queue.etas(),
+            )
+        )
+
+    @app_commands.command(description="Cancel a queued or running job.")
+    @app_commands.describe(job_id="Job number, as shown by /queue")
+    async def cancel(self, inter: discord.Interaction, job_id: int):
+        job = self.job_queue.get(job_id)
+        if job is None:
+            await inter.response.send_message(
+                f"There's no queued or running job #{job_id}.", ephemeral=True
+            )
+            return
+        if job.user_id != inter.user.id and not is_admin(inter.user):
+            await inter.response.send_message(
+                f"Job #{job_id} was started by <@{job.user_id}>.",
+                ephemeral=True,
+            )
+            return
+        self.logger.info(f"{inter.user} cancelled job {job_id}")
+        self.job_queue.cancel(job_id)
+        await inter.response.send_message(f"Cancelling job #{job_id}.")
+
+    @app_commands.command(description="Search the songs on the machine.")
+    @app_commands.describe(query="Title, artist, pack or chart meter")
+    async def search(self, inter: discord.Interaction, query: str):
+        self.logger.info(f"{inter.user} executed search with query {query}")
+        # Picking an autocomplete choice submits the song's path
+        song_dir = self.config.packs.joinpath(query)
+        if song_dir.parent.parent == self.config.packs and (
+            self.search_index.get(song_dir) is not None
+        ):
+            await inter.response.defer(thinking=True)
+            embed, file = await asyncio.to_thread(self._song_info, song_dir)
+            if file is None:
+                await inter.followup.send(embed=embed)
+            else:
+                await inter.followup.send(embed=embed, file=file)
+            return
+        results = self.search_index.search(query, MAX_SEARCH_RESULTS)
+        await inter.response.send_message(embed=search_embed(query, results))
+
+    @search.autocomplete("query")
+    async def search_autocomplete(
+        self, inter: discord.Interaction, current: str
+    ) -> list[app_commands.Choice[str]]:
+        # Answered straight from memory, well within Discord's deadline
+        choices = []
+        for entry in self.search_index.search(current):
+            value = entry.dir.relative_to(self.config.packs).as_posix()
+            if len(value) <= 100:
+                choices.append(
+                    app_commands.Choice(
+                        name=search_choice_name(entry), value=value
+                    )
+                )
+        return choices
+
+    @app_commands.command(
+        description="Clear outdated entries from ITGmania's song cache."
+    )
+    async def rebuild_cache(self, inter: discord.Interaction):
+        if not is_admin(inter.user):
+            await inter.response.send_message(
+                "Only admins can rebuild the song cache.", ephemeral=True
+            )
+            return
+        if self.config.cache is None:
+            await inter.response.send_message(
+                "No ITGmania cache is configured.", ephemeral=True
+            )
+            return
+        if self.cache_sweep_lock.locked():
+            await inter.response.send_message(
+                "The song cache is already being rebuilt.", ephemeral=True
+            )
+            return
+        self.logger.info(f"{inter.user} executed rebuild_cache")
+
+        await inter.response.defer(thinking=True)
+        async with self.cache_sweep_lock:
+            start = time.monotonic()
+            result = await asyncio.to_thread(
+                song_cache.sweep, self.config.cache, self.config.packs
+            )
+        self.logger.info(f"Song cache sweep: {result}")
+        await EDIT_SCHEDULER.edit(
+            inter, embed=cache_sweep_embed(result, time.monotonic() - start)
+        )
+
+    @rebuild_cache.error
+    async def rebuild_cache_error(
+        self, interaction: Interaction, error: commands.CommandError
+    ):
+        self.logger.exception("rebuild_cache threw an exception")
+        await EDIT_SCHEDULER.edit(
+            interaction, embed=error_embed(sys.exception()), view=None
+        )
+
+    @app_commands.command(
+        description="Show how long each stage of recent jobs took."
+    )
+    async def stats(self, inter: discord.Interaction):
+        if not is_admin(inter.user):
+            await inter.response.send_message(
+                "Only admins can view stats.", ephemeral=True
+            )
+            return
+        self.logger.info(f"{inter.user} executed stats")
+
+        # Set up by ItgBuddy (see server.py), if enabled
+        watchdog = getattr(self.bot, "watchdog", None)
+        await inter.response.send_message(
+            embed=stats_embed(
+                str(EDIT_SCHEDULER.stats), watchdog and watchdog.stats
+            ),
+            ephemeral=True,
+        )
+
+    @stats.error
+    async def stats_error(
+        self, interaction: Interaction, error: commands.CommandError
+    ):
+        self.logger.exception("stats threw an exception")
+        await EDIT_SCHEDULER.edit(
+            interaction, embed=error_embed(sys.exception()), view=None
         )
 
     @app_commands.command(description="Add a song to Berkeley Test Bench.")
@@ -101,8 +844,8 @@ class ItgCliCog(commands.Cog):
         self, interaction: Interaction, error: commands.CommandError
     ):
         self.logger.exception(f"add_song threw an exception")
-        await interaction.edit_original_response(
-            embed=error_embed(sys.exception()), view=None
+        await EDIT_SCHEDULER.edit(
+            interaction, embed=error_embed(sys.exception()), view=None
         )
 
     @commands.Cog.listener()
@@ -110,14 +853,19 @@ class ItgCliCog(commands.Cog):
         try:
             if msg.channel.id != self.config.add_song_channel_id:
                 return
-            zips = filter(
-                lambda a: a.content_type == "application/zip", msg.attachments
-            )
+            zips = [
+                a
+                for a in msg.attachments
+                if a.content_type == "application/zip"
+            ]
             for zip in zips:
                 self.logger.info(
                     f"{msg.author} executed add_song with link {zip.url}"
                 )
-                await self._add_song_helper(msg, zip.url)
+            if len(zips) == 1:
+                await self._add_song_helper(msg, zips[0].url)
+            elif len(zips) > 1:
+                await self._add_song_batch(msg, zips)
         except Exception as e:
             channel = self.bot.get_channel(self.config.add_song_channel_id)
             await channel.send(embed=error_embed(e))
@@ -130,35 +878,342 @@ class ItgCliCog(commands.Cog):
         # with updates
         if isinstance(inter_or_msg, discord.Interaction):
             user = inter_or_msg.user
-            await inter_or_msg.response.defer(thinking=True)
+            with DISCORD_SECONDS.time(call="defer"):
+                await inter_or_msg.response.defer(thinking=True)
         elif isinstance(inter_or_msg, discord.Message):
             user = inter_or_msg.author
             inter_or_msg = await inter_or_msg.reply("Processing command...")
 
-        # Run add_song and handle exceptions accordingly
-        try:
-            sf, path = await add_song_async(
+        await self._run_add_song(inter_or_msg, user, link)
+
+    async def _run_add_song(
+        self,
+        bot_response: discord.Interaction | discord.Message,
+        user: discord.User,
+        link: str,
+        job: Optional[Job] = None,
+    ):
+        async def add_song(flight, queued: Job, confirmed: Optional[str]):
+            song_dir = await add_song_async(
                 link,
                 self.config.singles,
-                inter_or_msg,
+                bot_response,
                 cache=self.config.cache,
-                overwrite=get_add_song_overwrite_handler(
-                    inter_or_msg, user, asyncio.get_running_loop()
+                overwrite=get_overwrite_handler(
+                    bot_response,
+                    user,
+                    confirmed,
+                    released=lambda: self._released(queued),
                 ),
                 delete_macos_files_flag=True,
+                on_download=lambda digest: flight.claim(("sha256", digest)),
+                on_extracted=lambda simfile_root: self._confirm_duplicates(
+                    bot_response,
+                    user,
+                    [simfile_root],
+                    self.config.singles.joinpath(simfile_root.name),
+                    whole=False,
+                    job=queued,
+                ),
+            )
+            self._record_install(song_dir)
+            return song_dir, user
+
+        async def preview_and_run(flight):
+            # See _run_add_pack
+            confirmed = await self._preview_song(bot_response, user, link)
+            return await self._run_job(
+                JobKind.ADD_SONG,
+                bot_response,
+                user,
+                link,
+                job,
+                lambda queued: add_song(flight, queued, confirmed),
+            )
+
+        # Run add_song through the job queue (or wait on an identical job)
+        # and handle exceptions accordingly
+        try:
+            song_dir, added_by = await self.song_jobs.run(
+                normalize_url(link),
+                preview_and_run,
+                on_wait=lambda: EDIT_SCHEDULER.edit(
+                    bot_response, embed=attached_embed()
+                ),
             )
         except itg_cli.OverwriteException:
-            await edit_response(
-                inter_or_msg, embed=cancelled_embed(), view=None
+            await EDIT_SCHEDULER.edit(
+                bot_response, embed=cancelled_embed(), view=None
+            )
+            return
+        except JobCancelled:
+            await EDIT_SCHEDULER.edit(
+                bot_response, embed=job_cancelled_embed(), view=None
             )
             return
 
-        embed, file = add_song_success(sf, path, user)
-        channel = inter_or_msg.channel
-        # Delete progress message and send success message
-        if isinstance(inter_or_msg, discord.Interaction):
-            await inter_or_msg.delete_original_response()
-            await inter_or_msg.channel.send(embed=embed, file=file)
-        elif isinstance(inter_or_msg, discord.Message):
-            await inter_or_msg.delete()
-            await channel.send(embed=embed, file=file)
+        embed, file = await asyncio.to_thread(
+            self._song_success, song_dir, added_by
+        )
+        await self._send_result(bot_response, embed, file)
+
+    async def _add_song_batch(
+        self, msg: discord.Message, zips: list[discord.Attachment]
+    ):
+        """Adds every zip attached to `msg` as one job."""
+        bot_response = await msg.reply("Processing command...")
+        await self._run_add_song_batch(
+            bot_response, msg.author, [zip.url for zip in zips]
+        )
+
+    async def _run_add_song_batch(
+        self,
+        bot_response: discord.Message,
+        user: discord.User,
+        urls: list[str],
+        job: Optional[Job] = None,
+    ):
+        """
+        Adds the songs at `urls` as one queued job: downloads and extracts
+        them concurrently, installs them one after another, and reports on
+        a single message and summary embed.
+        """
+        items = [BatchItem(link_name(url)) for url in urls]
+        batch = Batch(f"Adding {len(items)} songs...", items, bot_response)
+        batch.update()
+        # Installs go one at a time, so overwrite prompts do too
+        install_lock = asyncio.Lock()
+
+        async def install(
+            flight, item: BatchItem, url: str, overwrite
+        ) -> tuple[Path, discord.User]:
+            async with prepare_song(
+                url,
+                batch.reporter(item),
+                on_download=lambda digest: flight.claim(("sha256", digest)),
+                staging=self.staging,
+            ) as simfile_root:
+                item.name = simfile_root.name
+                batch.set_status(item, "Waiting to install...")
+                async with install_lock:
+                    batch.set_status(item, "Installing...")
+                    song_dir = await install_song_async(
+                        simfile_root,
+                        self.config.singles,
+                        lambda _event: None,
+                        cache=self.config.cache,
+                        overwrite=overwrite,
+                        delete_macos_files_flag=True,
+                    )
+            self._record_install(song_dir)
+            return song_dir, user
+
+        async def attached(item: BatchItem) -> None:
+            batch.set_status(item, "Already being added...")
+
+        async def add(item: BatchItem, url: str, overwrite) -> Optional[Path]:
+            # Songs someone else is already adding are shared, not redone
+            try:
+                song_dir, _added_by = await self.song_jobs.run(
+                    normalize_url(url),
+                    lambda flight: install(flight, item, url, overwrite),
+                    on_wait=lambda: attached(item),
+                )
+            except itg_cli.OverwriteException:
+                batch.finish(item, "Kept existing", "Already exists")
+                return None
+            except Exception as e:
+                self.logger.exception(f"Could not add {item.name}")
+                batch.finish(item, "Failed", str(e))
+                return None
+            batch.finish(item, "Installed")
+            return song_dir
+
+        async def add_all(queued: Job) -> list[Optional[Path]]:
+            # Replaces the queue position shown while waiting
+            batch.update()
+            overwrite = get_overwrite_handler(
+                bot_response, user, released=lambda: self._released(queued)
+            )
+            return await asyncio.gather(
+                *(add(item, url, overwrite) for item, url in zip(items, urls))
+            )
+
+        try:
+            song_dirs = await self._run_job(
+                JobKind.ADD_SONGS,
+                bot_response,
+                user,
+                "\n".join(urls),
+                job,
+                add_all,
+            )
+        except JobCancelled:
+            await EDIT_SCHEDULER.edit(
+                bot_response, embed=job_cancelled_embed(), view=None
+            )
+            return
+
+        skipped = [(item.name, item.error) for item in items if item.error]
+        embed, file = await asyncio.to_thread(
+            self._songs_success,
+            [song_dir for song_dir in song_dirs if song_dir is not None],
+            skipped,
+            user,
+        )
+        await self._send_result(bot_response, embed, file)
+
+    # Post-install summaries. These refresh the library index (which parses
+    # in a process pool) and build the success embeds, so they block and must
+    # run in a worker thread rather than on the event loop.
+
+    @STAGE_SECONDS.time(stage="index")
+    def _index_pack(self, pack_dir: Path) -> list[SimfileHeader]:
+        """Refreshes `pack_dir` in both indexes, returning its simfiles."""
+        self.library.refresh_pack(pack_dir)
+        simfiles = self.library.simfiles(pack_dir)
+        self.search_index.replace(simfiles, pack_dirs=[pack_dir])
+        return simfiles
+
+    @STAGE_SECONDS.time(stage="index")
+    def _index_songs(self, song_dirs: list[Path]) -> list[SimfileHeader]:
+        """`_index_pack` for song directories."""
+        self.library.refresh_songs(song_dirs)
+        simfiles = self.library.simfiles_in(song_dirs)
+        self.search_index.replace(simfiles, song_dirs=song_dirs)
+        return simfiles
+
+    def _apply_library_changes(
+        self, pack_dirs: set[Path], song_dirs: set[Path]
+    ) -> None:
+        """Called by the watcher (on its thread) with out-of-band changes."""
+        installed = self._take_installed(pack_dirs | song_dirs)
+        pack_dirs, song_dirs = pack_dirs - installed, song_dirs - installed
+        if not (pack_dirs or song_dirs):
+            return
+        self.logger.info(
+            f"Library changed on disk: {len(pack_dirs)} packs, "
+            + f"{len(song_dirs)} songs"
+        )
+        # Songs of a pack that's gone are dropped with the pack
+        pack_dirs |= {d.parent for d in song_dirs if not d.parent.is_dir()}
+        song_dirs = [d for d in song_dirs if d.parent not in pack_dirs]
+        for pack_dir in pack_dirs:
+            self._index_pack(pack_dir)
+        if song_dirs:
+            self._index_songs(song_dirs)
+        if self.config.cache is not None:
+            song_cache.invalidate_songs(self.config.cache, song_dirs)
+            for pack_dir in pack_dirs:
+                song_cache.invalidate_pack(self.config.cache, pack_dir)
+
+    def _record_install(self, path: Path) -> None:
+        with self._installed_lock:
+            self.installed[path] = time.monotonic()
+
+    def _take_installed(self, paths: set[Path]) -> set[Path]:
+        """
+        Which of `paths` installs just promoted, forgetting them (and any
+        recorded too long ago to still be waiting for their events).
+        """
+        cutoff = time.monotonic() - INSTALL_ECHO_SECONDS
+        with self._installed_lock:
+            taken = {
+                p for p in paths if self.installed.pop(p, cutoff) > cutoff
+            }
+            for path, recorded in list(self.installed.items()):
+                if recorded <= cutoff:
+                    del self.installed[path]
+        return taken
+
+    def _warm_banners(self, simfiles: list[SimfileHeader]) -> None:
+        """
+        Thumbnails the banners of newly installed songs in the background,
+        so later embeds showing them (e.g. /search) upload a cached one.
+        """
+        if self.thumbnails is None:
+            return
+        packs = {
+            pack_dir: self.library.pack(pack_dir)
+            for pack_dir in {sf.dir.parent for sf in simfiles}
+        }
+        banners = {song_banner(sf, packs[sf.dir.parent]) for sf in simfiles}
+        banners |= {pack.banner for pack in packs.values() if pack}
+        self.thumbnails.warm(b for b in banners if b is not None)
+
+    def _existing_pack(self, pack_dir: Path) -> list[SimfileHeader]:
+        return self._index_pack(pack_dir)
+
+    def _existing_song(self, song_dir: Path) -> Optional[SimfileHeader]:
+        simfiles = self._index_songs([song_dir])
+        return simfiles[0] if simfiles else None
+
+    def _pack_success(
+        self, pack_dir: Path, user: discord.User
+    ) -> tuple[discord.Embed, Optional[discord.File]]:
+        simfiles = self._index_pack(pack_dir)
+        self._warm_banners(simfiles)
+        return add_pack_success(
+            self.library.pack(pack_dir),
+            simfiles,
+            user,
+            self.library.duplicates(simfiles, exclude=pack_dir),
+            self.analytics.stats(simfiles),
+        )
+
+    def _song_success(
+        self, song_dir: Path, user: discord.User
+    ) -> tuple[discord.Embed, Optional[discord.File]]:
+        simfile = self._existing_song(song_dir)
+        if simfile is None:
+            return (unreadable_simfile_embed(song_dir, user), None)
+        self._warm_banners([simfile])
+        return add_song_success(
+            simfile,
+            self.library.pack(song_dir.parent),
+            user,
+            self.library.duplicates([simfile], exclude=song_dir),
+            self.analytics.stats([simfile]).get(song_dir),
+        )
+
+    def _song_info(
+        self, song_dir: Path
+    ) -> tuple[discord.Embed, Optional[discord.File]]:
+        simfile = self.library.simfile(song_dir)
+        if simfile is None:
+            return (unreadable_simfile_embed(song_dir), None)
+        return song_embed(
+            simfile,
+            self.library.pack(song_dir.parent),
+            self.analytics.stats([simfile]).get(song_dir),
+        )
+
+    def _songs_success(
+        self,
+        song_dirs: list[Path],
+        skipped: list[tuple[str, str]],
+        user: discord.User,
+    ) -> tuple[discord.Embed, Optional[discord.File]]:
+        simfiles = self._index_songs(song_dirs)
+        self._warm_banners(simfiles)
+        return add_songs_success(
+            simfiles,
+            self.library.pack(self.config.singles),
+            skipped,
+            user,
+        )
+
+    def _bulk_report(
+        self,
+        pack_dirs: list[Path],
+        skipped: list[tuple[str, str]],
+        user: discord.User,
+    ) -> discord.Embed:
+        return bulk_add_report(
+            [
+                (self.library.pack(d), len(self.library.simfiles(d)))
+                for d in pack_dirs
+            ],
+            skipped,
+            user,
+        )
@@ -0,0 +1,433 @@
+import asyncio
+import heapq
+import logging
+import sqlite3
+import statistics
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
+from dataclasses import dataclass, field
+from enum import StrEnum
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+import discord
+
+from itg_buddy.extensions.itg_cli.metrics import (
+    JOB_SECONDS,
+    QUEUE_WAIT_SECONDS,
+)
+from itg_buddy.extensions.itg_cli.singleflight import FlightRedirect
+
+T = TypeVar("T")
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    link TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state);
+"""
+
+
+class JobKind(StrEnum):
+    ADD_PACK = "add_pack"
+    ADD_SONG = "add_song"
+    # Several songs posted in one message; the link is their URLs, one per
+    # line
+    ADD_SONGS = "add_songs"
+
+
+class JobState(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+# Lower runs first; jobs with equal priority run in submission order
+PRIORITY_ADMIN = 0
+PRIORITY_SONG = 1
+PRIORITY_PACK = 2
+# Duration guesses (in seconds) until a kind of job has some history
+DEFAULT_DURATIONS = {
+    JobKind.ADD_PACK: 120.0,
+    JobKind.ADD_SONG: 15.0,
+    JobKind.ADD_SONGS: 60.0,
+}
+# Number of past durations per kind used for estimates
+HISTORY_LENGTH = 20
+# Finished jobs are dropped from the journal after this many seconds
+JOURNAL_RETENTION = 30 * 24 * 60 * 60
+
+# Journal writes run here, one at a time and in order, off the event loop
+JOURNAL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="journal"
+)
+
+
+class JobCancelled(Exception):
+    def __init__(self):
+        super().__init__("Job cancelled.")
+
+
+def is_admin(user: discord.User | discord.Member) -> bool:
+    permissions = getattr(user, "guild_permissions", None)
+    return permissions is not None and permissions.manage_guild
+
+
+def job_priority(user: discord.User | discord.Member, kind: JobKind) -> int:
+    """Admins first, then singles, then full packs."""
+    if is_admin(user):
+        return PRIORITY_ADMIN
+    if kind in (JobKind.ADD_SONG, JobKind.ADD_SONGS):
+        return PRIORITY_SONG
+    return PRIORITY_PACK
+
+
+@dataclass
+class Job:
+    id: int
+    kind: JobKind
+    link: str
+    user_id: int
+    channel_id: int
+    priority: int
+    created: float
+    state: JobState = JobState.QUEUED
+    started: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def links(self) -> list[str]:
+        """Every link the job adds (see JobKind.ADD_SONGS)."""
+        return self.link.split()
+
+
+class JobQueue:
+    """
+    Priority queue for add-song/add-pack jobs, with at most `concurrency`
+    running at once.
+
+    Every job is journaled to SQLite as it moves through the queue, so jobs
+    that were queued or running when the bot stopped can be picked up again
+    (see `interrupted`), and past durations give wait time estimates.
+    Queued and running jobs can be cancelled. A running job can give up its
+    slot while it waits on its user (see `released`). Call everything on the
+    event loop except `__init__`.
+    """
+
+    logger: logging.Logger
+    db_path: Path
+    concurrency: int
+
+    def __init__(self, db_path: Path, concurrency: int):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.db_path = db_path
+        self.concurrency = concurrency
+        self._jobs: dict[int, Job] = {}
+        self._heap: list[tuple[int, int]] = []
+        self._running: dict[int, Job] = {}
+        # Running jobs that gave up their slot for now (see `released`)
+        self._released: dict[int, Job] = {}
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._on_queued: dict[int, Callable[[int, float], None]] = {}
+        # Jobs cancelled after being dispatched but before their task started
+        self._cancel_requested: set[int] = set()
+        self._history: defaultdict[JobKind, deque[float]] = defaultdict(
+            lambda: deque(maxlen=HISTORY_LENGTH)
+        )
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != (
+                SCHEMA_VERSION
+            ):
+                db.execute("DROP TABLE IF EXISTS jobs")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.executescript(SCHEMA)
+            db.execute(
+                "DELETE FROM jobs WHERE finished < ?",
+                (time.time() - JOURNAL_RETENTION,),
+            )
+            for kind, duration in db.execute(
+                "SELECT kind, finished - started FROM jobs "
+                "WHERE state = ? ORDER BY finished",
+                (JobState.DONE,),
+            ):
+                self._history[JobKind(kind)].append(duration)
+            self._interrupted = [
+                Job(*row[:7])
+                for row in db.execute(
+                    "SELECT id, kind, link, user_id, channel_id, priority, "
+                    "created FROM jobs WHERE state IN (?, ?) ORDER BY id",
+                    (JobState.QUEUED, JobState.RUNNING),
+                )
+            ]
+        for job in self._interrupted:
+            job.kind = JobKind(job.kind)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        return db
+
+    def _write(self, sql: str, params: tuple) -> asyncio.Future:
+        def write():
+            with closing(self._connect()) as db, db:
+                return db.execute(sql, params).lastrowid
+
+        future = asyncio.get_running_loop().run_in_executor(
+            JOURNAL_EXECUTOR, write
+        )
+        future.add_done_callback(
+            lambda f: f.exception()
+            and self.logger.error(f"Job journal write failed: {f.exception()}")
+        )
+        return future
+
+    # Submitting
+
+    async def create(
+        self,
+        kind: JobKind,
+        link: str,
+        user_id: int,
+        channel_id: int,
+        priority: int,
+    ) -> Job:
+        """Journals a new job. Pass it to `run` to queue it."""
+        created = time.time()
+        job_id = await self._write(
+            "INSERT INTO jobs (kind, link, user_id, channel_id, priority, "
+            "state, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                link,
+                user_id,
+                channel_id,
+                priority,
+                JobState.QUEUED,
+                created,
+            ),
+        )
+        return Job(job_id, kind, link, user_id, channel_id, priority, created)
+
+    def interrupted(self) -> list[Job]:
+        """
+        Jobs that were queued or running when the bot last stopped, in
+        submission order. Returned once; pass them to `run` to resume them.
+        """
+        jobs, self._interrupted = self._interrupted, []
+        return jobs
+
+    async def run(
+        self,
+        job: Job,
+        func: Callable[[], Awaitable[T]],
+        on_queued: Optional[Callable[[int, float], None]] = None,
+    ) -> T:
+        """
+        Waits for `job`'s turn, then runs `func` as its task and returns its
+        result. While waiting, `on_queued` is called with the job's position
+        and estimated wait whenever they change. Raises JobCancelled if the
+        job is cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        queued = time.monotonic()
+        job.state = JobState.QUEUED
+        self._jobs[job.id] = job
+        self._waiters[job.id] = waiter = loop.create_future()
+        if on_queued is not None:
+            self._on_queued[job.id] = on_queued
+        heapq.heappush(self._heap, (job.priority, job.id))
+        try:
+            self._dispatch()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self._cancel_queued(job)
+                raise
+            if job.id in self._cancel_requested:
+                self._cancel_requested.discard(job.id)
+                self._finish(job, JobState.CANCELLED)
+                raise JobCancelled()
+            job.started = time.time()
+            QUEUE_WAIT_SECONDS.observe(
+                time.monotonic() - queued, kind=job.kind
+            )
+            started = time.monotonic()
+            self._write(
+                "UPDATE jobs SET state = ?, started = ? WHERE id = ?",
+                (JobState.RUNNING, job.started, job.id),
+            )
+            job.task = loop.create_task(func())
+            try:
+                await asyncio.wait([job.task])
+            except asyncio.CancelledError:
+                job.task.cancel()
+                raise
+            finally:
+                JOB_SECONDS.observe(time.monotonic() - started, kind=job.kind)
+            if job.task.cancelled():
+                self._finish(job, JobState.CANCELLED)
+                raise JobCancelled()
+            if isinstance(e := job.task.exception(), FlightRedirect):
+                # Handed off to an identical job, whose result it shares
+                self._finish(job, JobState.DONE)
+                raise e
+            if e is not None:
+                self._finish(job, JobState.FAILED, str(e))
+                raise e
+            self._finish(job, JobState.DONE)
+            self._history[job.kind].append(time.time() - job.started)
+            return job.task.result()
+        finally:
+            if job.state in (JobState.QUEUED, JobState.RUNNING):
+                self._finish(job, JobState.CANCELLED)
+            self._jobs.pop(job.id, None)
+            # Still set if the job was waiting to get its slot back
+            self._waiters.pop(job.id).cancel()
+            self._on_queued.pop(job.id, None)
+            self._running.pop(job.id, None)
+            self._released.pop(job.id, None)
+            self._dispatch()
+
+    @asynccontextmanager
+    async def released(self, job: Job) -> AsyncIterator[None]:
+        """
+        Gives up running `job`'s slot for the duration of the block, e.g.
+        while its user answers a prompt, so other jobs can start meanwhile.
+        Afterwards, waits for a slot again, ahead of jobs of the same priority
+        submitted after it; not if the block raises, since the job is then
+        ending anyway.
+        """
+        if self._running.get(job.id) is not job:
+            # Not running, or already released
+            yield
+            return
+        del self._running[job.id]
+        self._released[job.id] = job
+        self._dispatch()
+        try:
+            yield
+        finally:
+            released = self._released.pop(job.id, None)
+        if released is None:
+            return  # the job finished meanwhile (it was cancelled)
+        job.state = JobState.QUEUED
+        loop = asyncio.get_running_loop()
+        self._waiters[job.id] = waiter = loop.create_future()
+        heapq.heappush(self._heap, (job.priority, job.id))
+        self._dispatch()
+        try:
+            await waiter
+        finally:
+            if job.state == JobState.QUEUED:
+                # Cancelled while waiting; its heap entry is skipped
+                job.state = JobState.RUNNING
+
+    def abandon(self, job: Job, error: str) -> None:
+        """Marks an interrupted job that can't be resumed as failed."""
+        self._finish(job, JobState.FAILED, error)
+
+    def _finish(
+        self, job: Job, state: JobState, error: Optional[str] = None
+    ) -> None:
+        job.state = state
+        self._write(
+            "UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+            (state, time.time(), error, job.id),
+        )
+
+    def _dispatch(self) -> None:
+        """Starts queued jobs while there are free slots."""
+        while self._heap and len(self._running) < self.concurrency:
+            _, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or job.state != JobState.QUEUED:
+                continue  # cancelled while queued
+            job.state = JobState.RUNNING
+            self._running[job_id] = job
+            self._waiters[job_id].set_result(None)
+        etas = self.etas()
+        for position, job in enumerate(self.queued(), start=1):
+            if (on_queued := self._on_queued.get(job.id)) is not None:
+                on_queued(position, etas[job.id])
+
+    # Cancelling
+
+    def cancel(self, job_id: int) -> Optional[Job]:
+        """
+        Cancels a queued or running job, returning it, or None if there's no
+        such job. Running jobs stop at the end of their current stage, except
+        installs, which are always seen through.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.task is not None:
+            # Running, or waiting to get its slot back
+            job.task.cancel()
+        elif job.state == JobState.QUEUED:
+            self._cancel_queued(job)
+            self._waiters[job_id].set_exception(JobCancelled())
+            self._dispatch()
+        else:
+            self._cancel_requested.add(job_id)
+        return job
+
+    def _cancel_queued(self, job: Job) -> None:
+        # Its heap entry is skipped when popped
+        self._finish(job, JobState.CANCELLED)
+
+    # Inspecting
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def running(self) -> list[Job]:
+        return sorted(
+            [*self._running.values(), *self._released.values()],
+            key=lambda job: job.started or 0,
+        )
+
+    def queued(self) -> list[Job]:
+        return sorted(
+            (j for j in self._jobs.values() if j.state == JobState.QUEUED),
+            key=lambda job: (job.priority, job.id),
+        )
+
+    def estimate(self, kind: JobKind) -> float:
+        """Expected duration of a job of `kind`, from recent history."""
+        history = self._history[kind]
+        if not history:
+            return DEFAULT_DURATIONS[kind]
+        return statistics.median(history)
+
+    def etas(self) -> dict[int, float]:
+        """Estimated seconds until each queued job starts."""
+        now = time.time()
+        slots = [
+            max(self.estimate(job.kind) - (now - (job.started or now)), 0)
+            for job in self._running.values()
+        ]
+        slots += [0.0] * max(self.concurrency - len(slots), 0)
+        heapq.heapify(slots)
+        etas = {}
+        for job in self.queued():
+            start = heapq.heappop(slots)
+            etas[job.id] = start
+            heapq.heappush(slots, start + self.estimate(job.kind))
+        return etas
@@ -0,0 +1,613 @@
+import logging
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+from simfile.dir import SimfilePack
+
+from itg_buddy.extensions.itg_cli.headers import (
+    ChartHeader,
+    SimfileHeader,
+    read_headers,
+)
+from itg_buddy.extensions.itg_cli.metrics import STAGE_SECONDS
+
+# Bump whenever the schema below changes; stale databases are rebuilt.
+SCHEMA_VERSION = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    banner TEXT,
+    mtime_ns INTEGER NOT NULL,
+    banner_mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS simfiles (
+    dir TEXT PRIMARY KEY,
+    pack TEXT NOT NULL REFERENCES packs(path) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    dir_mtime_ns INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    titletranslit TEXT,
+    artist TEXT,
+    banner TEXT,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS simfiles_pack ON simfiles(pack);
+CREATE INDEX IF NOT EXISTS simfiles_fingerprint ON simfiles(fingerprint);
+CREATE TABLE IF NOT EXISTS charts (
+    simfile TEXT NOT NULL REFERENCES simfiles(dir) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    stepstype TEXT,
+    difficulty TEXT,
+    meter TEXT,
+    description TEXT,
+    fingerprint TEXT,
+    timing TEXT,
+    PRIMARY KEY (simfile, idx)
+);
+CREATE INDEX IF NOT EXISTS charts_fingerprint ON charts(fingerprint);
+CREATE TABLE IF NOT EXISTS failures (
+    dir TEXT PRIMARY KEY,
+    pack TEXT NOT NULL REFERENCES packs(path) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    dir_mtime_ns INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS failures_pack ON failures(pack);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SIMFILE_SUFFIXES = (".ssc", ".sm")
+
+# Process pool for parsing simfiles in bulk. Parsing is pure-Python and
+# CPU-bound, so threads would just contend for the GIL (and the event loop).
+# Spawned rather than forked since the bot process has threads running.
+PARSE_EXECUTOR = ProcessPoolExecutor(
+    mp_context=multiprocessing.get_context("spawn")
+)
+# Below this many stale simfiles, parsing in-process beats the IPC overhead
+PARALLEL_PARSE_THRESHOLD = 64
+PARSE_CHUNKSIZE = 32
+# Most fingerprints per duplicate lookup query (SQLite's variable limit)
+MAX_QUERY_PARAMS = 500
+
+
+@dataclass
+class PackRecord:
+    """Indexed pack directory."""
+
+    path: Path
+    name: str
+    banner: Optional[Path]
+
+
+def find_simfile(song_dir: Path) -> Optional[Path]:
+    """
+    Returns the path to the simfile in `song_dir`, preferring SSC over SM
+    like StepMania does, or None if there isn't one.
+    """
+    try:
+        names = os.listdir(song_dir)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    for suffix in SIMFILE_SUFFIXES:
+        for name in sorted(names):
+            if name.lower().endswith(suffix) and not name.startswith("."):
+                return song_dir.joinpath(name)
+    return None
+
+
+def banner_mtime_ns(banner: Optional[str]) -> Optional[int]:
+    """mtime of a pack's banner file, or None if it has none (any more)."""
+    if banner is None:
+        return None
+    try:
+        return os.stat(banner).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Duplicate(NamedTuple):
+    """An indexed simfile sharing charts with a new one."""
+
+    new: SimfileHeader
+    existing: SimfileHeader
+    # Number of the new simfile's charts the existing one also has
+    shared_charts: int
+    # Whether the two have exactly the same charts
+    identical: bool
+
+
+class StaleSimfile(NamedTuple):
+    """A simfile whose index entry is missing or out of date."""
+
+    pack_dir: Path
+    path: Path
+    dir_mtime_ns: int
+    mtime_ns: int
+    size: int
+
+
+def try_parse_simfile(
+    path: Path,
+) -> tuple[Optional[SimfileHeader], Optional[str]]:
+    """
+    Process pool entry point: returns the parsed record, or None and an
+    error message (exceptions from simfile/msdparser don't always pickle).
+    """
+    try:
+        return read_headers(path, fingerprints=True), None
+    except Exception as e:
+        return None, f"{e.__class__.__name__}: {e}"
+
+
+class LibraryIndex:
+    """
+    Persistent SQLite index of the packs, simfiles and chart headers under
+    `packs`, with the chart fingerprints (see headers.chart_fingerprint)
+    used to spot duplicates.
+
+    Refreshes are incremental: song directories are only relisted when their
+    mtime changes, and simfiles are only reparsed when their mtime or size
+    changes. That includes simfiles that failed to parse, which are recorded
+    in `failures` instead of `simfiles`. All methods block on disk I/O, so
+    call them off the event loop.
+    """
+
+    logger: logging.Logger
+    db_path: Path
+    packs: Path
+
+    def __init__(self, db_path: Path, packs: Path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.db_path = db_path
+        self.packs = packs
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != (
+                SCHEMA_VERSION
+            ):
+                for table in (
+                    "charts",
+                    "failures",
+                    "simfiles",
+                    "packs",
+                    "state",
+                ):
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    # Refreshing
+    # Each refresh first scans the filesystem for stale simfiles (cheap stat
+    # calls), then parses them outside of any write transaction, fanning out
+    # across PARSE_EXECUTOR when there are enough of them.
+
+    def refresh(self, trust_snapshot: bool = False) -> None:
+        """
+        Incrementally rescans every pack under `packs`. With
+        `trust_snapshot`, packs whose mtime matches the index only have
+        their songs' directory mtimes checked (see take_snapshot).
+        """
+        pack_dirs = {
+            p: p.stat().st_mtime_ns
+            for p in self.packs.iterdir()
+            if p.is_dir() and not p.name.startswith(".")
+        }
+        with closing(self._connect()) as db:
+            with db:
+                known = {
+                    Path(path): mtime_ns
+                    for path, mtime_ns in db.execute(
+                        "SELECT path, mtime_ns FROM packs"
+                    )
+                }
+                for gone in known.keys() - pack_dirs.keys():
+                    db.execute(
+                        "DELETE FROM packs WHERE path = ?", (str(gone),)
+                    )
+                stale = []
+                for pack_dir, mtime_ns in sorted(pack_dirs.items()):
+                    if trust_snapshot and known.get(pack_dir) == mtime_ns:
+                        stale += self._scan_changed_songs(db, pack_dir)
+                    else:
+                        stale += self._scan_pack(db, pack_dir)
+            self._parse_and_store(db, stale)
+
+    def refresh_pack(self, pack_dir: Path) -> None:
+        """Incrementally rescans a single pack directory."""
+        with closing(self._connect()) as db:
+            with db:
+                stale = self._scan_pack(db, pack_dir)
+            self._parse_and_store(db, stale)
+
+    def refresh_song(self, song_dir: Path) -> None:
+        """
+        Rescans a single song directory (and its pack's row) without
+        walking the rest of the pack. Used after adding a single.
+        """
+        self.refresh_songs([song_dir])
+
+    def refresh_songs(self, song_dirs: Iterable[Path]) -> None:
+        """`refresh_song` for several songs at once, in one parse pass."""
+        song_dirs = list(song_dirs)
+        with closing(self._connect()) as db:
+            with db:
+                for pack_dir in {song_dir.parent for song_dir in song_dirs}:
+                    self._upsert_pack(db, pack_dir)
+                stale = []
+                for song_dir in song_dirs:
+                    stale += self._scan_song(db, song_dir.parent, song_dir)
+            self._parse_and_store(db, stale)
+
+    # Snapshots
+    # While a LibraryWatcher keeps the index in sync with the disk, the
+    # index is a faithful snapshot of the library, which a clean shutdown
+    # records. The next start then only rescans packs whose mtime changed
+    # since, and songs whose directory's mtime did (a simfile swapped for
+    # another doesn't touch the pack's). Without a recorded snapshot (a
+    # crash, or no watcher), every pack is rescanned.
+
+    def save_snapshot(self) -> None:
+        """Records that the index is in sync with the disk."""
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT OR REPLACE INTO state (key, value) "
+                "VALUES ('snapshot', '1')"
+            )
+
+    def take_snapshot(self) -> bool:
+        """
+        Whether a snapshot was recorded, clearing it: from here on, changes
+        can happen that it doesn't reflect until it's saved again.
+        """
+        with closing(self._connect()) as db, db:
+            row = db.execute(
+                "DELETE FROM state WHERE key = 'snapshot' RETURNING value"
+            ).fetchone()
+        return row is not None
+
+    def _upsert_pack(self, db: sqlite3.Connection, pack_dir: Path) -> None:
+        """
+        Updates the pack's row if its mtime changed, or its banner's did
+        (e.g. a banner replaced by a copy that kept the pack's mtime).
+        """
+        mtime_ns = pack_dir.stat().st_mtime_ns
+        row = db.execute(
+            "SELECT mtime_ns, banner, banner_mtime_ns FROM packs "
+            "WHERE path = ?",
+            (str(pack_dir),),
+        ).fetchone()
+        if (
+            row is not None
+            and row[0] == mtime_ns
+            and row[2] == banner_mtime_ns(row[1])
+        ):
+            return
+        banner = SimfilePack(str(pack_dir)).banner()
+        db.execute(
+            "INSERT INTO packs (path, name, banner, mtime_ns, "
+            "banner_mtime_ns) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET name = excluded.name, "
+            "banner = excluded.banner, mtime_ns = excluded.mtime_ns, "
+            "banner_mtime_ns = excluded.banner_mtime_ns",
+            (
+                str(pack_dir),
+                pack_dir.name,
+                banner,
+                mtime_ns,
+                banner_mtime_ns(banner),
+            ),
+        )
+
+    def _scan_pack(
+        self, db: sqlite3.Connection, pack_dir: Path
+    ) -> list[StaleSimfile]:
+        if not pack_dir.is_dir():
+            db.execute("DELETE FROM packs WHERE path = ?", (str(pack_dir),))
+            return []
+        self._upsert_pack(db, pack_dir)
+        # Listing a pack is cheap next to statting and parsing its songs, so
+        # always relist it; a song dir can gain a simfile without the pack
+        # directory's mtime changing.
+        song_dirs = {Path(e.path) for e in os.scandir(pack_dir) if e.is_dir()}
+        known = {
+            Path(r[0])
+            for r in db.execute(
+                "SELECT dir FROM simfiles WHERE pack = ? "
+                "UNION ALL SELECT dir FROM failures WHERE pack = ?",
+                (str(pack_dir), str(pack_dir)),
+            )
+        }
+        for gone in known - song_dirs:
+            self._forget_song(db, gone)
+        stale = []
+        for song_dir in sorted(song_dirs):
+            stale += self._scan_song(db, pack_dir, song_dir)
+        return stale
+
+    def _scan_changed_songs(
+        self, db: sqlite3.Connection, pack_dir: Path
+    ) -> list[StaleSimfile]:
+        """
+        Scans the songs in `pack_dir` whose directory mtime isn't the
+        indexed one, finding them with a single scandir of the pack.
+        """
+        known = dict(
+            db.execute(
+                "SELECT dir, dir_mtime_ns FROM simfiles WHERE pack = ? "
+                "UNION ALL SELECT dir, dir_mtime_ns FROM failures "
+                "WHERE pack = ?",
+                (str(pack_dir), str(pack_dir)),
+            )
+        )
+        stale = []
+        with os.scandir(pack_dir) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_dir():
+                        continue
+                    dir_mtime_ns = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                song_dir = Path(entry.path)
+                if known.get(str(song_dir)) != dir_mtime_ns:
+                    stale += self._scan_song(db, pack_dir, song_dir)
+        return stale
+
+    def _scan_song(
+        self, db: sqlite3.Connection, pack_dir: Path, song_dir: Path
+    ) -> list[StaleSimfile]:
+        # A song is in at most one of the two tables
+        row = db.execute(
+            "SELECT path, dir_mtime_ns, mtime_ns, size FROM simfiles "
+            "WHERE dir = ? UNION ALL "
+            "SELECT path, dir_mtime_ns, mtime_ns, size FROM failures "
+            "WHERE dir = ?",
+            (str(song_dir), str(song_dir)),
+        ).fetchone()
+        try:
+            dir_mtime_ns = song_dir.stat().st_mtime_ns
+            if row is not None and row[1] == dir_mtime_ns:
+                path = Path(row[0])
+            else:
+                path = find_simfile(song_dir)
+            stat = path.stat() if path is not None else None
+        except FileNotFoundError:
+            stat = None
+        if stat is None:
+            self._forget_song(db, song_dir)
+            return []
+        if row == (
+            str(path),
+            dir_mtime_ns,
+            stat.st_mtime_ns,
+            stat.st_size,
+        ):
+            return []
+        return [
+            StaleSimfile(
+                pack_dir, path, dir_mtime_ns, stat.st_mtime_ns, stat.st_size
+            )
+        ]
+
+    def _parse_and_store(
+        self, db: sqlite3.Connection, stale: list[StaleSimfile]
+    ) -> None:
+        paths = [s.path for s in stale]
+        if len(paths) >= PARALLEL_PARSE_THRESHOLD:
+            results = PARSE_EXECUTOR.map(
+                try_parse_simfile, paths, chunksize=PARSE_CHUNKSIZE
+            )
+        else:
+            results = map(try_parse_simfile, paths)
+        # Collect every result before writing, so the write transaction isn't
+        # held open while parsing
+        results = list(results)
+        with db:
+            for entry, (record, error) in zip(stale, results):
+                if record is None:
+                    self.logger.warning(
+                        f"Could not parse {entry.path}: {error}"
+                    )
+                    self._store_failure(db, entry)
+                else:
+                    self._store(db, entry, record)
+
+    def _forget_song(self, db: sqlite3.Connection, song_dir: Path) -> None:
+        db.execute("DELETE FROM simfiles WHERE dir = ?", (str(song_dir),))
+        db.execute("DELETE FROM failures WHERE dir = ?", (str(song_dir),))
+
+    def _store_failure(
+        self, db: sqlite3.Connection, entry: StaleSimfile
+    ) -> None:
+        """
+        Records that `entry` couldn't be parsed, so it isn't retried until
+        it changes.
+        """
+        self._forget_song(db, entry.path.parent)
+        db.execute(
+            "INSERT INTO failures (dir, pack, path, dir_mtime_ns, mtime_ns, "
+            "size) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                str(entry.path.parent),
+                str(entry.pack_dir),
+                str(entry.path),
+                entry.dir_mtime_ns,
+                entry.mtime_ns,
+                entry.size,
+            ),
+        )
+
+    def _store(
+        self,
+        db: sqlite3.Connection,
+        entry: StaleSimfile,
+        record: SimfileHeader,
+    ) -> None:
+        self._forget_song(db, record.dir)
+        db.execute(
+            "INSERT INTO simfiles (dir, pack, path, dir_mtime_ns, mtime_ns, "
+            "size, title, titletranslit, artist, banner, fingerprint) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(record.dir),
+                str(entry.pack_dir),
+                str(record.path),
+                entry.dir_mtime_ns,
+                entry.mtime_ns,
+                entry.size,
+                record.title,
+                record.titletranslit,
+                record.artist,
+                record.banner,
+                record.fingerprint,
+            ),
+        )
+        db.executemany(
+            "INSERT INTO charts (simfile, idx, stepstype, difficulty, meter, "
+            "description, fingerprint, timing) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    str(record.dir),
+                    i,
+                    c.stepstype,
+                    c.difficulty,
+                    c.meter,
+                    c.description,
+                    c.fingerprint,
+                    c.timing,
+                )
+                for i, c in enumerate(record.charts)
+            ],
+        )
+
+    # Lookups
+
+    def pack(self, pack_dir: Path) -> Optional[PackRecord]:
+        with closing(self._connect()) as db:
+            row = db.execute(
+                "SELECT path, name, banner FROM packs WHERE path = ?",
+                (str(pack_dir),),
+            ).fetchone()
+        if row is None:
+            return None
+        return PackRecord(Path(row[0]), row[1], row[2] and Path(row[2]))
+
+    def packs_list(self) -> list[PackRecord]:
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                "SELECT path, name, banner FROM packs ORDER BY name"
+            ).fetchall()
+        return [PackRecord(Path(p), n, b and Path(b)) for p, n, b in rows]
+
+    def simfile(self, song_dir: Path) -> Optional[SimfileHeader]:
+        records = self._simfiles("WHERE s.dir = ?", (str(song_dir),))
+        return records[0] if records else None
+
+    def simfiles_in(self, song_dirs: Iterable[Path]) -> list[SimfileHeader]:
+        """Simfiles in the given song directories that are indexed."""
+        dirs = [str(song_dir) for song_dir in song_dirs]
+        if not dirs:
+            return []
+        placeholders = ", ".join("?" * len(dirs))
+        return self._simfiles(f"WHERE s.dir IN ({placeholders})", dirs)
+
+    def simfiles(self, pack_dir: Optional[Path] = None) -> list[SimfileHeader]:
+        """Simfiles in `pack_dir`, or in the whole library if omitted."""
+        if pack_dir is None:
+            return self._simfiles("", ())
+        return self._simfiles("WHERE s.pack = ?", (str(pack_dir),))
+
+    def _simfiles(self, where: str, params: Iterable) -> list[SimfileHeader]:
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                "SELECT s.dir, s.path, s.title, s.titletranslit, s.artist, "
+                "s.banner, s.fingerprint, c.stepstype, c.difficulty, "
+                "c.meter, c.description, c.fingerprint, c.timing "
+                f"FROM simfiles s LEFT JOIN charts c ON c.simfile = s.dir "
+                f"{where} ORDER BY s.dir, c.idx",
+                tuple(params),
+            ).fetchall()
+        records: dict[str, SimfileHeader] = {}
+        for row in rows:
+            record = records.get(row[0])
+            if record is None:
+                record = records[row[0]] = SimfileHeader(
+                    Path(row[0]), Path(row[1]), *row[2:6], fingerprint=row[6]
+                )
+            if any(value is not None for value in row[7:]):
+                record.charts.append(ChartHeader(*row[7:]))
+        return list(records.values())
+
+    @STAGE_SECONDS.time(stage="duplicates")
+    def duplicates(
+        self, simfiles: list[SimfileHeader], exclude: Optional[Path] = None
+    ) -> list[Duplicate]:
+        """
+        Indexed simfiles sharing charts with `simfiles` (which need their
+        fingerprints), ignoring any in or under `exclude`, e.g. the
+        directory they're being installed into. A single indexed lookup per
+        batch of chart fingerprints.
+        """
+        by_fingerprint: dict[str, list[SimfileHeader]] = {}
+        for sf in simfiles:
+            for chart in sf.charts:
+                if chart.fingerprint:
+                    by_fingerprint.setdefault(chart.fingerprint, []).append(sf)
+        fingerprints = list(by_fingerprint)
+        shared: dict[tuple[Path, Path], set[str]] = {}
+        with closing(self._connect()) as db:
+            for i in range(0, len(fingerprints), MAX_QUERY_PARAMS):
+                batch = fingerprints[i : i + MAX_QUERY_PARAMS]
+                placeholders = ", ".join("?" * len(batch))
+                for fingerprint, existing in db.execute(
+                    "SELECT fingerprint, simfile FROM charts "
+                    f"WHERE fingerprint IN ({placeholders})",
+                    batch,
+                ):
+                    existing = Path(existing)
+                    if exclude is not None and existing.is_relative_to(
+                        exclude
+                    ):
+                        continue
+                    for sf in by_fingerprint[fingerprint]:
+                        key = (sf.dir, existing)
+                        shared.setdefault(key, set()).add(fingerprint)
+        if not shared:
+            return []
+        new = {sf.dir: sf for sf in simfiles}
+        existing = {
+            sf.dir: sf for sf in self.simfiles_in({dir for _, dir in shared})
+        }
+        return [
+            Duplicate(
+                new[new_dir],
+                existing[existing_dir],
+                len(charts),
+                new[new_dir].fingerprint is not None
+                and new[new_dir].fingerprint
+                == existing[existing_dir].fingerprint,
+            )
+            for (new_dir, existing_dir), charts in shared.items()
+            if existing_dir in existing
+        ]
@@ -0,0 +1,274 @@
+# Timing metrics.
+# Histograms of how long each stage of an add job takes, how much it moves,
+# how long jobs wait in the queue and how long Discord takes to answer, so
+# it's clear whether the network, the disk or the bot is the bottleneck.
+#
+# Each histogram keeps Prometheus-style cumulative bucket counts since
+# startup, served in Prometheus' text format when METRICS_PORT is set (see
+# MetricsServer), and a rolling window of recent samples, which /stats
+# summarizes as percentiles.
+import asyncio
+import bisect
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+# Seconds
+DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+)
+# Bytes: 1 KB to 16 GB in factors of 4
+SIZE_BUCKETS = tuple(float(1000 * 4**i) for i in range(13))
+# Samples older than this are left out of /stats
+WINDOW_SECONDS = 60 * 60
+# Most samples kept per series for /stats
+MAX_SAMPLES = 1000
+
+
+@dataclass
+class Summary:
+    """Percentiles of a series' recent samples (see Histogram.summary)."""
+
+    count: int
+    p50: float
+    p90: float
+    p99: float
+    max: float
+
+
+class Histogram:
+    """One labelled series of a Family."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # counts[i] is the number of samples <= buckets[i], not cumulative;
+        # the last slot is for samples above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.samples: deque[tuple[float, float]] = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, value: float, now: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.samples.append((now, value))
+
+    def summary(self, since: float) -> Optional[Summary]:
+        values = sorted(v for t, v in self.samples if t >= since)
+        if not values:
+            return None
+
+        def percentile(p: float) -> float:
+            return values[min(len(values) - 1, math.ceil(p * len(values)) - 1)]
+
+        return Summary(
+            len(values),
+            percentile(0.5),
+            percentile(0.9),
+            percentile(0.99),
+            values[-1],
+        )
+
+
+class Family:
+    """
+    A histogram metric with labels, e.g. stage durations by stage. Safe to
+    observe from any thread.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        unit: str,
+        buckets: tuple[float, ...],
+    ):
+        self.name = name
+        self.help = help
+        # "seconds" or "bytes", for display
+        self.unit = unit
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: dict[tuple[tuple[str, str], ...], Histogram] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = Histogram(self.buckets)
+            series.observe(value, time.monotonic())
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes how long the block takes, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summaries(
+        self, window: float = WINDOW_SECONDS
+    ) -> list[tuple[dict[str, str], Summary]]:
+        """Each series' labels and recent percentiles, busiest first."""
+        since = time.monotonic() - window
+        with self._lock:
+            summaries = [
+                (dict(key), summary)
+                for key, series in self._series.items()
+                if (summary := series.summary(since)) is not None
+            ]
+        return sorted(summaries, key=lambda s: s[1].count, reverse=True)
+
+    def exposition(self) -> list[str]:
+        """The family in Prometheus' text format."""
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = [f'{k}="{_escape(v)}"' for k, v in key]
+                cumulative = 0
+                for bound, count in zip(
+                    (*self.buckets, math.inf), series.counts
+                ):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else f"{bound:g}"
+                    bucket_labels = ",".join([*labels, f'le="{le}"'])
+                    lines.append(
+                        f"{self.name}_bucket{{{bucket_labels}}} {cumulative}"
+                    )
+                suffix = "{" + ",".join(labels) + "}" if labels else ""
+                lines.append(f"{self.name}_sum{suffix} {series.sum:g}")
+                lines.append(f"{self.name}_count{suffix} {series.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+STAGE_SECONDS = Family(
+    "itg_buddy_stage_seconds",
+    "Time spent in each stage of add_pack/add_song jobs.",
+    "seconds",
+    DURATION_BUCKETS,
+)
+DOWNLOAD_BYTES = Family(
+    "itg_buddy_download_bytes",
+    "Size of downloaded archives.",
+    "bytes",
+    SIZE_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = Family(
+    "itg_buddy_queue_wait_seconds",
+    "Time jobs spend in the job queue before they start.",
+    "seconds",
+    DURATION_BUCKETS,
+)
+JOB_SECONDS = Family(
+    "itg_buddy_job_seconds",
+    "Time jobs take once started, including prompts.",
+    "seconds",
+    DURATION_BUCKETS,
+)
+DISCORD_SECONDS = Family(
+    "itg_buddy_discord_seconds",
+    "Latency of Discord API calls, by call.",
+    "seconds",
+    DURATION_BUCKETS,
+)
+UPLOAD_BYTES = Family(
+    "itg_buddy_upload_bytes",
+    "Size of files attached to result messages.",
+    "bytes",
+    SIZE_BUCKETS,
+)
+FAMILIES = (
+    STAGE_SECONDS,
+    DOWNLOAD_BYTES,
+    QUEUE_WAIT_SECONDS,
+    JOB_SECONDS,
+    DISCORD_SECONDS,
+    UPLOAD_BYTES,
+)
+
+
+def exposition() -> str:
+    """Every metric, in Prometheus' text format."""
+    return "\n".join(line for f in FAMILIES for line in f.exposition()) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves `exposition()` over HTTP on `host`:`port`, for Prometheus to
+    scrape. Only meant for local use: there's no authentication.
+    """
+
+    logger: logging.Logger
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port
+        )
+        self.logger.info(f"Serving metrics on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the headers
+            end = (b"\r\n", b"\n", b"")
+            while await asyncio.wait_for(reader.readline(), 10) not in end:
+                pass
+            method, path, *_ = request.decode("latin-1").split() or [""]
+            if method != "GET" or path.split("?")[0] not in ("/", "/metrics"):
+                status, body = "404 Not Found", b"Not found\n"
+            else:
+                status, body = "200 OK", exposition().encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (TimeoutError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -1,15 +1,21 @@
 # Overwrite Button View
 import asyncio
+from contextlib import AbstractAsyncContextManager, nullcontext
+from typing import Callable, Optional
 
 import discord
 
-from simfile.types import Simfile
-from simfile.dir import SimfilePack
+from itg_buddy.extensions.itg_cli.edits import EDIT_SCHEDULER
 from itg_buddy.extensions.itg_cli.embeds import (
+    duplicates_embed,
     overwrite_pack_embed,
+    overwrite_packs_embed,
     overwrite_song_embed,
 )
-from itg_buddy.extensions.itg_cli.utils import edit_response
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader
+from itg_buddy.extensions.itg_cli.library import Duplicate
+from itg_buddy.extensions.itg_cli.pipeline import OverwriteQuestion
+from itg_buddy.extensions.itg_cli.wrappers import OverwriteHandler
 
 
 class OverwriteView(discord.ui.View):
@@ -22,12 +28,14 @@ class OverwriteView(discord.ui.View):
         user: discord.User,
         parent: discord.Interaction | discord.Message,
         *args,
+        confirm_label: str = "Overwrite",
         **kwargs,
     ):
         super().__init__(*args, timeout=60, **kwargs)
         self.choice = asyncio.get_running_loop().create_future()
         self.parent = parent
         self.user = user
+        self.overwrite.label = confirm_label
 
     async def interaction_check(
         self, interaction: discord.Interaction
@@ -42,7 +50,7 @@ class OverwriteView(discord.ui.View):
     async def on_timeout(self):
         self.choice.set_result(False)
         self.stop()
-        await edit_response(self.parent, view=None)
+        await EDIT_SCHEDULER.edit(self.parent, view=None)
 
     @discord.ui.button(
         label="Overwrite",
@@ -67,51 +75,88 @@ class OverwriteView(discord.ui.View):
         await interaction.response.defer()
 
 
-def get_add_pack_overwrite_handler(
-    command_interaction: discord.Interaction,
-    loop: asyncio.AbstractEventLoop,
-):
-    async def async_helper(
-        new: SimfilePack, old: SimfilePack, interaction: discord.Interaction
-    ):
-        view = OverwriteView(interaction.user, parent=command_interaction)
-        await interaction.edit_original_response(
-            embed=overwrite_pack_embed(new, old),
-            view=view,
-        )
-        return await view.choice
+async def ask_overwrite_pack(
+    inter_or_msg: discord.Interaction | discord.Message,
+    user: discord.User,
+    name: str,
+    new: list[SimfileHeader],
+    old: list[SimfileHeader],
+) -> bool:
+    view = OverwriteView(user, parent=inter_or_msg)
+    await EDIT_SCHEDULER.edit(
+        inter_or_msg, embed=overwrite_pack_embed(name, new, old), view=view
+    )
+    return await view.choice
 
-    def pack_overwrite_handler(new: SimfilePack, old: SimfilePack) -> bool:
-        return asyncio.run_coroutine_threadsafe(
-            async_helper(new, old, command_interaction), loop
-        ).result()
 
-    return pack_overwrite_handler
+async def ask_overwrite_song(
+    inter_or_msg: discord.Interaction | discord.Message,
+    user: discord.User,
+    new: SimfileHeader,
+    old: Optional[SimfileHeader],
+) -> bool:
+    view = OverwriteView(user, parent=inter_or_msg)
+    await EDIT_SCHEDULER.edit(
+        inter_or_msg, embed=overwrite_song_embed(new, old), view=view
+    )
+    return await view.choice
 
 
-def get_add_song_overwrite_handler(
+async def ask_add_duplicates(
     inter_or_msg: discord.Interaction | discord.Message,
     user: discord.User,
-    loop: asyncio.AbstractEventLoop,
-):
-    async def async_helper(
-        new: Simfile,
-        old: Simfile,
-        inter_or_msg: discord.Interaction | discord.Message,
-    ):
-        view = OverwriteView(user, parent=inter_or_msg)
-        await edit_response(
-            inter_or_msg,
-            embed=overwrite_song_embed(new, old),
-            view=view,
-        )
-        return await view.choice
+    duplicates: list[Duplicate],
+) -> bool:
+    view = OverwriteView(user, parent=inter_or_msg, confirm_label="Add anyway")
+    await EDIT_SCHEDULER.edit(
+        inter_or_msg, embed=duplicates_embed(duplicates), view=view
+    )
+    return await view.choice
 
-    def song_overwrite_handler(
-        new: tuple[Simfile, str], old: tuple[Simfile, str]
-    ) -> bool:
-        return asyncio.run_coroutine_threadsafe(
-            async_helper(new[0], old[0], inter_or_msg), loop
-        ).result()
 
-    return song_overwrite_handler
+def get_overwrite_handler(
+    inter_or_msg: discord.Interaction | discord.Message,
+    user: discord.User,
+    confirmed: Optional[str] = None,
+    released: Callable[[], AbstractAsyncContextManager] = nullcontext,
+) -> OverwriteHandler:
+    """
+    Handler for the install stage's overwrite questions, which come from a
+    worker thread or process (see wrappers.run_isolated_stage) and are asked
+    here on the event loop. A conflict with the pack or song named
+    `confirmed` counts as already approved: it was asked about before the
+    download (see preview.py). Questions are asked inside `released()`, e.g.
+    to free the job's queue slot while the user decides.
+    """
+
+    async def overwrite_handler(question: OverwriteQuestion) -> bool:
+        if question.name == confirmed:
+            return True
+        async with released():
+            if question.is_pack:
+                return await ask_overwrite_pack(
+                    inter_or_msg,
+                    user,
+                    question.name,
+                    question.new,
+                    question.old,
+                )
+            return await ask_overwrite_song(
+                inter_or_msg,
+                user,
+                question.new[0],
+                question.old[0] if question.old else None,
+            )
+
+    return overwrite_handler
+
+
+async def ask_overwrite_packs(
+    inter: discord.Interaction, names: list[str]
+) -> bool:
+    """Asks once whether to overwrite all of the existing packs `names`."""
+    view = OverwriteView(inter.user, parent=inter)
+    await EDIT_SCHEDULER.edit(
+        inter, embed=overwrite_packs_embed(names), view=view
+    )
+    return await view.choice
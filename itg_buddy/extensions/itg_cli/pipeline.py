@@ -0,0 +1,382 @@
+# Blocking stages of an add-song/add-pack operation.
+# itg_cli.add_song/add_pack run download, extraction and installation as one
+# call; these split them apart (reusing itg_cli's helpers and semantics) so
+# that only the install stage has to be serialized. See wrappers.py for how
+# they are scheduled.
+#
+# Every function here is module-level and takes and returns plain data, so it
+# can run in an install worker process (see worker.py) as well as a thread.
+#
+# Installs are transactional: archives are extracted into a staging directory
+# on the same filesystem as the packs (see staging_dir), and the finished pack
+# or song is swapped into place with renames, under a journal that
+# recover_installs uses to finish the swap if the bot dies partway through.
+import hashlib
+import json
+import os
+import shutil
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+from itg_cli import OverwriteException
+from itg_cli._utils import delete_macos_files, download_file, simfile_paths
+from tempfile import mkdtemp
+
+from itg_buddy.extensions.itg_cli.downloader import Downloader
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader, read_headers
+from itg_buddy.extensions.itg_cli.library import find_simfile
+
+# Hidden, so neither the library index nor ITGmania treat it as a pack
+STAGING_DIR_NAME = ".itg-buddy-staging"
+TRANSACTION_PREFIX = "txn-"
+
+
+def download(
+    path_or_url: str,
+    downloads: Path,
+    downloader: Optional[Downloader] = None,
+) -> tuple[Path, Optional[str]]:
+    """
+    Downloads `path_or_url` into `downloads` (with `downloader`, if given)
+    if it is a URL, returning the path to the downloaded file and its SHA-256
+    if that was computed along the way. Local paths are returned as is.
+    """
+    if path_or_url.startswith("http"):
+        if downloader is not None:
+            return downloader.download(path_or_url, downloads)
+        return download_file(path_or_url, downloads), None
+    path = Path(path_or_url).absolute()
+    if not path.exists():
+        raise FileNotFoundError("File does not exist:", str(path))
+    return path, None
+
+
+def sha256sum(path: Path) -> str:
+    """Hex SHA-256 digest of the file at `path`."""
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def extract(path: Path, work: Path) -> Path:
+    """
+    Extracts the archive at `path` (or copies the directory at `path`) into
+    `work`, returning the directory to search for simfiles. Supplied local
+    files are left untouched.
+    """
+    dest = work.joinpath(path.stem if path.is_file() else path.name)
+    if path.is_dir():
+        shutil.copytree(path, dest)
+    else:
+        print("Extracting archive...", file=sys.stderr)
+        dest.mkdir()
+        shutil.unpack_archive(path, dest)
+    return dest
+
+
+def find_pack(working_dir: Path) -> Path:
+    """
+    Returns the pack directory in `working_dir`. If there are several, warns
+    and picks the one containing the most songs, like itg_cli.add_pack.
+    """
+    # 2nd parent of a simfile path is a valid pack directory
+    pack_dir_counts = Counter(p.parents[1] for p in simfile_paths(working_dir))
+    if len(pack_dir_counts) == 0:
+        raise Exception("No packs found.")
+    elif len(pack_dir_counts) > 1:
+        print("Warning | Multiple pack directories found:", file=sys.stderr)
+        packs_by_frequency = pack_dir_counts.most_common()
+        for pack, count in packs_by_frequency:
+            print(
+                f"{pack.relative_to(working_dir)} ({count} songs)",
+                file=sys.stderr,
+            )
+        pack_path, _ = packs_by_frequency[0]
+        rel_path = pack_path.relative_to(working_dir)
+        print(
+            f"Selecting pack with the most songs: {rel_path}", file=sys.stderr
+        )
+        return pack_path
+    return pack_dir_counts.popitem()[0]
+
+
+def extract_song(path: Path, work: Path) -> Path:
+    """`extract`, then `find_song` in what was extracted."""
+    return find_song(extract(path, work))
+
+
+def read_simfiles(song_dirs: Iterable[Path]) -> list[SimfileHeader]:
+    """
+    Headers (with fingerprints) of the simfiles in `song_dirs`, skipping
+    directories without a readable one.
+    """
+    simfiles = []
+    for song_dir in song_dirs:
+        path = find_simfile(song_dir)
+        if path is None:
+            continue
+        try:
+            simfiles.append(read_headers(path, fingerprints=True))
+        except Exception:
+            # Installing reports unreadable simfiles properly
+            continue
+    return simfiles
+
+
+def find_song(working_dir: Path) -> Path:
+    """Returns the only simfile directory in `working_dir`."""
+    simfile_dirs = {p.parent for p in simfile_paths(working_dir)}
+    if len(simfile_dirs) == 1:
+        return simfile_dirs.pop()
+    elif len(simfile_dirs) == 0:
+        raise Exception("No simfiles found.")
+    raise Exception(
+        "More than one simfile in supplied link/directory\n"
+        + "Supply songs individually or use add-pack instead."
+    )
+
+
+def staging_dir(packs: Path) -> Path:
+    """
+    Directory for downloads and extractions on their way into `packs`. It
+    lives on the same filesystem, so finished installs can be renamed into
+    place.
+    """
+    staging = packs.joinpath(STAGING_DIR_NAME)
+    staging.mkdir(exist_ok=True)
+    return staging
+
+
+# Overwrite questions
+# Replacing a pack or song on the machine needs the user's go-ahead. The
+# question carries the simfiles on both sides, read where the install runs,
+# so whoever answers it (the bot, on its event loop) doesn't parse anything.
+
+
+@dataclass
+class OverwriteQuestion:
+    # Name of the pack or song directory that would be replaced
+    name: str
+    is_pack: bool
+    # Simfiles of the new and existing pack (or song)
+    new: list[SimfileHeader]
+    old: list[SimfileHeader]
+
+
+# Answers an OverwriteQuestion, blocking until it's answered: True to replace
+OverwritePrompt = Callable[[OverwriteQuestion], bool]
+
+
+def pack_headers(pack_dir: Path) -> list[SimfileHeader]:
+    paths = (find_simfile(d) for d in sorted(pack_dir.iterdir()) if d.is_dir())
+    return [read_headers(p) for p in paths if p is not None]
+
+
+def confirm_pack_overwrite(
+    pack_path: Path,
+    dest: Path,
+    overwrite: OverwritePrompt,
+    delete_macos_files_flag: bool,
+) -> bool:
+    """
+    Asks `overwrite` whether the existing pack at `dest` may be replaced by
+    the extracted pack at `pack_path`, raising OverwriteException if not.
+    Returns whether `dest` existed.
+    """
+    if not dest.exists():
+        return False
+    if delete_macos_files_flag:
+        delete_macos_files(dest)
+    question = OverwriteQuestion(
+        dest.name, True, pack_headers(pack_path), pack_headers(dest)
+    )
+    if not overwrite(question):
+        raise OverwriteException("Pack already exists.")
+    return True
+
+
+def confirm_song_overwrite(
+    simfile_root: Path,
+    dest: Path,
+    overwrite: OverwritePrompt,
+    delete_macos_files_flag: bool,
+) -> bool:
+    """`confirm_pack_overwrite` for a song directory."""
+    if not dest.exists():
+        return False
+    if delete_macos_files_flag:
+        delete_macos_files(dest)
+    new, old = find_simfile(simfile_root), find_simfile(dest)
+    question = OverwriteQuestion(
+        dest.name,
+        False,
+        [read_headers(new)] if new else [],
+        [read_headers(old)] if old else [],
+    )
+    if not overwrite(question):
+        raise OverwriteException("Simfile already exists.")
+    return True
+
+
+def install_pack(
+    pack_path: Path,
+    working_dir: Path,
+    packs: Path,
+    courses: Path,
+    overwrite: OverwritePrompt,
+    delete_macos_files_flag: bool,
+    confirmed: bool = False,
+) -> tuple[Path, int]:
+    """
+    Moves the extracted pack at `pack_path` into `packs` (and any courses
+    found in `working_dir` into `courses`), asking `overwrite` first if the
+    pack already exists, unless `confirmed`. Returns the installed pack
+    directory and the number of courses added.
+
+    The pack's courses folder belongs to it: it's replaced along with the
+    pack, in the same transaction, unless `courses` is on another
+    filesystem, in which case the courses are moved in afterwards.
+    """
+    if delete_macos_files_flag:
+        delete_macos_files(pack_path)
+    dest = packs.joinpath(pack_path.name)
+    if not confirmed:
+        confirm_pack_overwrite(
+            pack_path, dest, overwrite, delete_macos_files_flag
+        )
+
+    # look for a Courses folder containing .crs files
+    num_courses = 0
+    crs_parent_dirs = {p.parent for p in working_dir.rglob("*.crs")}
+    staged_courses = Path(mkdtemp(prefix=".courses-", dir=working_dir))
+    for crs_parent_dir in crs_parent_dirs:
+        for file in filter(Path.is_file, crs_parent_dir.iterdir()):
+            shutil.move(file, staged_courses.joinpath(file.name))
+            if file.suffix == ".crs":
+                num_courses += 1
+
+    courses_subfolder = courses.joinpath(pack_path.name)
+    staging = staging_dir(packs)
+    if courses.stat().st_dev == staging.stat().st_dev:
+        promote(
+            pack_path,
+            dest,
+            staging,
+            extra=[(staged_courses, courses_subfolder)],
+        )
+    else:
+        promote(pack_path, dest, staging)
+        shutil.rmtree(courses_subfolder, ignore_errors=True)
+        shutil.move(staged_courses, courses_subfolder)
+    return dest, num_courses
+
+
+def install_song(
+    simfile_root: Path,
+    singles: Path,
+    overwrite: OverwritePrompt,
+    delete_macos_files_flag: bool,
+    confirmed: bool = False,
+) -> Path:
+    """
+    Moves the extracted song at `simfile_root` into `singles`, asking
+    `overwrite` first if it already exists, unless `confirmed`. Returns the
+    installed song directory.
+    """
+    if delete_macos_files_flag:
+        delete_macos_files(simfile_root)
+    dest = singles.joinpath(simfile_root.name)
+    if not confirmed:
+        confirm_song_overwrite(
+            simfile_root, dest, overwrite, delete_macos_files_flag
+        )
+
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    promote(simfile_root, dest, staging_dir(singles.parent))
+    return dest
+
+
+# Transactions
+# A transaction directory in the staging area holds a journal and, during the
+# swap, the replaced directory. Once the journal is written the swap is
+# committed to: recovery finishes it rather than rolling it back, since the
+# replaced directory may already have been moved aside.
+
+
+def _write_journal(journal: Path, entry: dict) -> None:
+    temp = journal.with_suffix(".tmp")
+    with temp.open("w") as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    temp.replace(journal)
+
+
+def promote(
+    staged: Path,
+    dest: Path,
+    staging: Path,
+    extra: Iterable[tuple[Path, Path]] = (),
+) -> None:
+    """
+    Replaces `dest` (if it exists) with the directory `staged`, atomically
+    as far as other readers are concerned: each step is a rename within
+    one filesystem. `staged` is moved into `staging` first if it's on
+    another filesystem. `extra` (staged, dest) pairs are swapped in the
+    same transaction, after `dest`; their destinations must be on the same
+    filesystem as `staging`.
+    """
+    txn = Path(mkdtemp(prefix=TRANSACTION_PREFIX, dir=staging))
+    swaps = []
+    for i, (staged, dest) in enumerate([(staged, dest), *extra]):
+        if staged.stat().st_dev != txn.stat().st_dev:
+            staged = Path(shutil.move(staged, txn.joinpath(f"staged-{i}")))
+        swaps.append(
+            {
+                "staged": str(staged),
+                "dest": str(dest),
+                "backup": str(txn.joinpath(f"backup-{i}")),
+            }
+        )
+    _write_journal(txn.joinpath("journal.json"), {"swaps": swaps})
+    for swap in swaps:
+        _swap(Path(swap["staged"]), Path(swap["dest"]), Path(swap["backup"]))
+    shutil.rmtree(txn)
+
+
+def _swap(staged: Path, dest: Path, backup: Path) -> None:
+    # Idempotent, so recovery can rerun it from any point
+    if staged.exists():
+        if dest.exists():
+            dest.rename(backup)
+        staged.rename(dest)
+
+
+def recover_installs(staging: Path) -> list[Path]:
+    """
+    Finishes installs that were interrupted mid-swap and deletes everything
+    else left in `staging` (interrupted downloads and extractions, which
+    hadn't touched the library yet). Returns the recovered destinations.
+    Run before anything else uses `staging`.
+    """
+    if not staging.is_dir():
+        return []
+    recovered = []
+    for txn in sorted(staging.glob(f"{TRANSACTION_PREFIX}*")):
+        journal = txn.joinpath("journal.json")
+        if journal.is_file():
+            entry = json.loads(journal.read_text())
+            # Journals from before courses joined the transaction hold one
+            swaps = entry.get("swaps", [entry])
+            for swap in swaps:
+                dest = Path(swap["dest"])
+                _swap(Path(swap["staged"]), dest, Path(swap["backup"]))
+                recovered.append(dest)
+        shutil.rmtree(txn)
+    for leftover in staging.iterdir():
+        if leftover.is_dir():
+            shutil.rmtree(leftover, ignore_errors=True)
+        else:
+            leftover.unlink(missing_ok=True)
+    return recovered
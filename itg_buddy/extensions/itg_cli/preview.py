@@ -0,0 +1,226 @@
+# Archive previews.
+# Reads the listing of a remote zip and the simfiles in it with HTTP range
+# requests, so what an add would install (and whether it would replace
+# anything) is known before the archive is downloaded. Only the central
+# directory at the end of the archive and the .sm/.ssc members are fetched.
+import io
+import sys
+import zipfile
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import PurePosixPath, Path
+from typing import Optional
+import requests
+
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader, parse_headers
+from itg_buddy.extensions.itg_cli.library import SIMFILE_SUFFIXES
+from itg_buddy.extensions.itg_cli.singleflight import normalize_url
+
+# Range requests are rounded up to this many bytes; the first one fetches the
+# end of the archive, which usually covers the whole central directory
+BLOCK_SIZE = 64 * 1024
+# Give up on a preview that needs more than this many bytes, e.g. an archive
+# with huge simfiles or one stored in a way we'd have to read all of
+MAX_PREVIEW_BYTES = 32 * 1024 * 1024
+# Simfiles bigger than this (uncompressed) are left out of the preview
+MAX_SIMFILE_SIZE = 8 * 1024 * 1024
+REQUEST_TIMEOUT = 10
+
+
+class PreviewUnavailable(Exception):
+    """The archive can't be previewed; download it to find out what's in it."""
+
+
+@dataclass
+class ArchivePreview:
+    # Total size of the archive in bytes
+    size: int
+    # Bytes actually fetched to build the preview
+    fetched: int
+    # Simfiles in the archive, with paths relative to its root
+    simfiles: list[SimfileHeader]
+    # Name the extracted pack would be installed under (see
+    # pipeline.find_pack), if it doesn't depend on the archive's filename
+    pack_name: Optional[str]
+    # Same for a single song (see pipeline.find_song), if there is only one
+    song_name: Optional[str]
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read-only, seekable file over the resource at `url`, fetched in blocks
+    with range requests as it is read. Blocks are kept, so zipfile's
+    back-and-forth seeking only costs one request per new region.
+    """
+
+    def __init__(self, session: requests.Session, url: str):
+        super().__init__()
+        self.session = session
+        self.url = url
+        self.fetched = 0
+        self._blocks: dict[int, bytes] = {}
+        self._pos = 0
+        # Fetching the tail first also tells us the size (and the final URL,
+        # so redirects are only followed once)
+        response = self._get(f"bytes=-{BLOCK_SIZE}")
+        content_range = response.headers.get("Content-Range", "")
+        try:
+            self.size = int(content_range.rpartition("/")[2])
+        except ValueError as e:
+            raise PreviewUnavailable(
+                "Server didn't report the archive size"
+            ) from e
+        self.url = response.url
+        tail = response.content
+        self.fetched += len(tail)
+        start = self.size - len(tail)
+        # Only whole blocks are kept; the partial first one is refetched if
+        # it's ever needed
+        first = -(-start // BLOCK_SIZE)
+        for index in range(first, -(-self.size // BLOCK_SIZE)):
+            offset = index * BLOCK_SIZE - start
+            self._blocks[index] = tail[offset : offset + BLOCK_SIZE]
+
+    def _get(self, byte_range: str) -> requests.Response:
+        response = self.session.get(
+            self.url,
+            headers={"Range": byte_range},
+            timeout=REQUEST_TIMEOUT,
+            stream=True,
+        )
+        if response.status_code != 206:
+            # A 200 would be the whole archive
+            response.close()
+            raise PreviewUnavailable("Server doesn't support range requests")
+        return response
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        end = min(self._pos + len(buffer), self.size)
+        if end <= self._pos:
+            return 0
+        first, last = self._pos // BLOCK_SIZE, (end - 1) // BLOCK_SIZE
+        missing = [i for i in range(first, last + 1) if i not in self._blocks]
+        if missing:
+            self._fetch(missing[0], missing[-1])
+        data = b"".join(self._blocks[i] for i in range(first, last + 1))
+        offset = self._pos - first * BLOCK_SIZE
+        n = end - self._pos
+        buffer[:n] = data[offset : offset + n]
+        self._pos = end
+        return n
+
+    def _fetch(self, first: int, last: int) -> None:
+        start = first * BLOCK_SIZE
+        end = min((last + 1) * BLOCK_SIZE, self.size) - 1
+        if self.fetched + end - start + 1 > MAX_PREVIEW_BYTES:
+            raise PreviewUnavailable("Preview would read too much")
+        with self._get(f"bytes={start}-{end}") as response:
+            data = response.content
+        if len(data) != end - start + 1:
+            raise PreviewUnavailable("Server returned the wrong range")
+        self.fetched += len(data)
+        for index in range(first, last + 1):
+            offset = (index - first) * BLOCK_SIZE
+            self._blocks[index] = data[offset : offset + BLOCK_SIZE]
+
+
+def can_preview(path_or_url: str) -> bool:
+    """
+    Whether `path_or_url` may be previewable. Drive share links aren't: they
+    point at a web page, not the file.
+    """
+    return path_or_url.startswith(("http://", "https://")) and not (
+        normalize_url(path_or_url).startswith("gdrive:")
+    )
+
+
+def simfile_members(names: list[str]) -> list[str]:
+    """
+    The simfile in each directory of an archive listing, preferring SSC over
+    SM like StepMania does (see library.find_simfile). Skips macOS metadata.
+    """
+    by_dir: defaultdict[PurePosixPath, list[str]] = defaultdict(list)
+    for name in names:
+        path = PurePosixPath(name)
+        if "__MACOSX" in path.parts or path.name.startswith("."):
+            continue
+        if path.suffix.lower() in SIMFILE_SUFFIXES:
+            by_dir[path.parent].append(name)
+    members = []
+    for dir_names in by_dir.values():
+        for suffix in SIMFILE_SUFFIXES:
+            matches = sorted(
+                n for n in dir_names if n.lower().endswith(suffix)
+            )
+            if matches:
+                members.append(matches[0])
+                break
+    return members
+
+
+def install_names(members: list[str]) -> tuple[Optional[str], Optional[str]]:
+    """
+    The pack and song directory names pipeline.find_pack and find_song would
+    pick for an archive with these simfiles, where they don't depend on the
+    archive's filename (which the extraction directory is named after).
+    """
+    paths = [PurePosixPath(m) for m in members]
+    pack_counts = Counter(
+        p.parents[1] for p in paths if len(p.parents) > 2
+    ).most_common(1)
+    pack_name = pack_counts[0][0].name if pack_counts else None
+    song_dirs = {p.parent for p in paths}
+    song_name = None
+    if len(song_dirs) == 1 and len(paths[0].parents) > 1:
+        song_name = paths[0].parent.name
+    return pack_name, song_name
+
+
+def preview_archive(
+    url: str, session: Optional[requests.Session] = None
+) -> ArchivePreview:
+    """
+    Lists the simfiles in the zip at `url` without downloading it, raising
+    PreviewUnavailable if that can't be done cheaply. Requests go through
+    `session` (left open) if given, or a session of their own.
+    """
+    print("Previewing archive...", file=sys.stderr)
+    with nullcontext(session) if session else requests.Session() as session:
+        reader = RangeReader(session, url)
+        try:
+            archive = zipfile.ZipFile(reader)
+        except zipfile.BadZipFile as e:
+            raise PreviewUnavailable("Not a zip archive") from e
+        with archive:
+            members = simfile_members(archive.namelist())
+            simfiles = []
+            for member in members:
+                if archive.getinfo(member).file_size > MAX_SIMFILE_SIZE:
+                    continue
+                try:
+                    data = archive.read(member)
+                except (NotImplementedError, zipfile.BadZipFile) as e:
+                    # e.g. an unsupported compression method
+                    raise PreviewUnavailable(str(e)) from e
+                simfiles.append(parse_headers(Path(member), data))
+    return ArchivePreview(
+        reader.size, reader.fetched, simfiles, *install_names(members)
+    )
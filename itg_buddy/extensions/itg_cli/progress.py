@@ -0,0 +1,243 @@
+import logging
+import re
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from io import TextIOBase
+from typing import Callable, Iterator, Optional, override
+
+# Matches the counters of a tqdm bar, e.g.
+#   45%|████▌     | 1.23M/2.73M [00:01<00:02, 1.10MB/s]
+# or, when the total size is unknown,
+#   1.23MB [00:01, 1.10MB/s]
+TQDM_BAR = re.compile(
+    r"(?:(?P<percent>\d{1,3})%\|[^|]*\|\s*)?"
+    r"(?P<done>[\d.]+)(?P<done_unit>[kMGTPEZY]?)B?"
+    r"(?:/(?P<total>[\d.]+)(?P<total_unit>[kMGTPEZY]?)B?)?"
+    r"\s*\[(?P<elapsed>[\d:]+)(?:<(?P<eta>[\d:]+|\?))?,"
+    r"\s*(?P<rate>[\d.]+|\?)(?P<rate_unit>[kMGTPEZY]?)B/s\]"
+)
+# Cursor movement tqdm emits when several bars are open at once
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+# tqdm's unit_scale prefixes (powers of 1000)
+SI_PREFIXES = {"": 1, **{p: 1000 ** (i + 1) for i, p in enumerate("kMGTPEZY")}}
+
+
+class StageCancelled(Exception):
+    """Raised into a job's thread at its next write once it's cancelled."""
+
+    # The message is an argument so the exception survives pickling, on its
+    # way back from an install worker (see worker.py)
+    def __init__(self, message: str = "Stage cancelled."):
+        super().__init__(message)
+
+
+@dataclass
+class ProgressEvent:
+    """A progress update or status line written by itg_cli."""
+
+    text: str
+    description: Optional[str] = None
+    percent: Optional[int] = None
+    # Sizes in bytes, rate in bytes/second, eta in seconds
+    done: Optional[float] = None
+    total: Optional[float] = None
+    rate: Optional[float] = None
+    eta: Optional[float] = None
+
+    @property
+    def is_progress(self) -> bool:
+        return self.done is not None
+
+
+def _scaled(number: Optional[str], prefix: Optional[str]) -> Optional[float]:
+    if number is None or number == "?":
+        return None
+    return float(number) * SI_PREFIXES[prefix or ""]
+
+
+def _seconds(clock: Optional[str]) -> Optional[float]:
+    if clock is None or clock == "?":
+        return None
+    seconds = 0
+    for part in clock.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def parse_progress(line: str) -> ProgressEvent:
+    """
+    Parses a line written by itg_cli (or tqdm/gdown) into a ProgressEvent.
+    Lines that aren't progress bars become events with only `text` set.
+    """
+    line = line.strip()
+    match = TQDM_BAR.search(line)
+    if match is None:
+        return ProgressEvent(text=line)
+    return ProgressEvent(
+        text=line,
+        description=line[: match.start()].rstrip(": ") or None,
+        percent=match["percent"] and int(match["percent"]),
+        done=_scaled(match["done"], match["done_unit"]),
+        total=_scaled(match["total"], match["total_unit"]),
+        rate=_scaled(match["rate"], match["rate_unit"]),
+        eta=_seconds(match["eta"]),
+    )
+
+
+class ProgressStream(TextIOBase):
+    """
+    File-like sink for a single job's stderr. Splits tqdm's carriage-return
+    updates and printed lines into ProgressEvents and hands each one to
+    `on_event` (from the writing thread). Status lines are also logged so
+    warnings and errors aren't lost.
+
+    Once `cancelled` is set, writes raise StageCancelled, which stops
+    downloads (and anything else reporting progress) at their next update.
+    """
+
+    logger: logging.Logger
+    on_event: Callable[[ProgressEvent], None]
+    cancelled: Optional[threading.Event]
+    buffer: str
+
+    def __init__(
+        self,
+        on_event: Callable[[ProgressEvent], None],
+        cancelled: Optional[threading.Event] = None,
+    ):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.on_event = on_event
+        self.cancelled = cancelled
+        self.buffer = ""
+
+    @property
+    def encoding(self):
+        return sys.__stderr__.encoding
+
+    @override
+    def write(self, text: str):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise StageCancelled()
+        self.buffer += text
+        if "\r" in text or "\n" in text:
+            *lines, self.buffer = re.split(r"[\r\n]", self.buffer)
+            for line in lines:
+                self._emit(line)
+        return len(text)
+
+    @override
+    def flush(self):
+        # tqdm flushes after every redraw without a trailing newline
+        line, self.buffer = self.buffer, ""
+        self._emit(line)
+
+    def _emit(self, line: str) -> None:
+        line = ANSI_ESCAPE.sub("", line)
+        if not line.strip():
+            return
+        event = parse_progress(line)
+        if not event.is_progress:
+            self.logger.info(event.text)
+        self._dispatch(event)
+
+    def report(self, event: ProgressEvent) -> None:
+        """Hands an already structured event to `on_event`."""
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise StageCancelled()
+        self._dispatch(event)
+
+    def _dispatch(self, event: ProgressEvent) -> None:
+        try:
+            self.on_event(event)
+        except Exception:
+            self.logger.exception("Progress handler raised an exception")
+
+
+# The ProgressStream for the job running in the current context, if any.
+# Executor threads set this for the duration of a job, so concurrent jobs
+# each see only their own output.
+CURRENT_STREAM: ContextVar[Optional[ProgressStream]] = ContextVar(
+    "CURRENT_STREAM", default=None
+)
+
+
+class StderrRouter(TextIOBase):
+    """
+    Replacement for sys.stderr that forwards writes to the current context's
+    ProgressStream, falling back to the real stderr everywhere else.
+    """
+
+    fallback: TextIOBase
+
+    def __init__(self, fallback: TextIOBase):
+        super().__init__()
+        self.fallback = fallback
+
+    def _target(self) -> TextIOBase:
+        return CURRENT_STREAM.get() or self.fallback
+
+    @property
+    def encoding(self):
+        return self.fallback.encoding
+
+    @override
+    def write(self, text: str):
+        return self._target().write(text)
+
+    @override
+    def flush(self):
+        self._target().flush()
+
+    @override
+    def isatty(self):
+        return CURRENT_STREAM.get() is None and self.fallback.isatty()
+
+    @override
+    def fileno(self):
+        return self.fallback.fileno()
+
+
+_install_lock = threading.Lock()
+
+
+def install_stderr_router() -> None:
+    """Swaps sys.stderr for a StderrRouter, once per process."""
+    with _install_lock:
+        if not isinstance(sys.stderr, StderrRouter):
+            sys.stderr = StderrRouter(sys.stderr)
+
+
+@contextmanager
+def capture_progress(
+    on_event: Callable[[ProgressEvent], None],
+    cancelled: Optional[threading.Event] = None,
+) -> Iterator[ProgressStream]:
+    """
+    Routes everything written to sys.stderr from the current context (i.e.
+    the current thread, when run in an executor) to a new ProgressStream.
+    """
+    install_stderr_router()
+    stream = ProgressStream(on_event, cancelled)
+    token = CURRENT_STREAM.set(stream)
+    try:
+        yield stream
+    finally:
+        stream.flush()
+        CURRENT_STREAM.reset(token)
+
+
+def report(event: ProgressEvent) -> None:
+    """
+    Reports `event` to the job running in the current context, skipping the
+    round trip through text. Outside of a job, its text goes to stderr.
+    Raises StageCancelled once the job is cancelled, like writes do.
+    """
+    stream = CURRENT_STREAM.get()
+    if stream is None:
+        print(event.text, file=sys.stderr)
+    else:
+        stream.report(event)
@@ -0,0 +1,252 @@
+import bisect
+import heapq
+import itertools
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader
+
+# Most results a search returns (Discord shows at most 25 autocomplete
+# choices)
+DEFAULT_LIMIT = 25
+
+NON_WORD = re.compile(r"[^\w]+")
+# Updates changing up to this many entries edit the title order in place;
+# bigger ones merge their new entries into it in one pass
+MAX_INPLACE_UPDATES = 32
+
+
+def normalize(text: str) -> str:
+    """
+    Casefolded `text` with accents stripped and punctuation collapsed to
+    single spaces, so "Café☆Dance!" and "cafe dance" match.
+    """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return NON_WORD.sub(" ", stripped).strip()
+
+
+def trigrams(text: str) -> set[str]:
+    """The trigrams of each word of normalized `text`."""
+    return {
+        word[i : i + 3] for word in text.split() for i in range(len(word) - 2)
+    }
+
+
+@dataclass(slots=True)
+class SearchEntry:
+    dir: Path
+    title: str
+    titletranslit: Optional[str]
+    artist: Optional[str]
+    pack: str
+    meters: frozenset[str]
+    # Normalized title, translit, artist and pack, space-separated, that
+    # query words are matched against
+    text: str
+    # Normalized title, for ranking
+    key: str
+
+
+def search_entry(sf: SimfileHeader) -> SearchEntry:
+    fields = [sf.title, sf.titletranslit, sf.artist, sf.dir.parent.name]
+    return SearchEntry(
+        dir=sf.dir,
+        title=sf.title,
+        titletranslit=sf.titletranslit,
+        artist=sf.artist,
+        pack=sf.dir.parent.name,
+        meters=frozenset(
+            c.meter.strip() for c in sf.charts if c.meter and c.meter.strip()
+        ),
+        text=f" {' '.join(normalize(f) for f in fields if f)} ",
+        key=normalize(sf.titletranslit or sf.title),
+    )
+
+
+class SearchIndex:
+    """
+    In-memory index of the library's songs for /search and its autocomplete,
+    which has to answer within Discord's 3 second deadline however big the
+    library is.
+
+    Words of three or more characters are looked up through a trigram index,
+    shorter ones through a word-prefix index, and numbers also match chart
+    meters. Every query word must match; candidates are checked against the
+    entry's text, so trigrams spread across the text don't give false hits.
+    Updates (`replace`) and searches may come from different threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[int, SearchEntry] = {}
+        self._ids: dict[Path, int] = {}
+        self._next_id = 0
+        self._trigrams: dict[str, set[int]] = {}
+        # Word prefixes of one or two characters
+        self._prefixes: dict[str, set[int]] = {}
+        self._meters: dict[str, set[int]] = {}
+        # (key, id) of every entry, in title order
+        self._sorted: list[tuple[str, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # Updating
+
+    def replace(
+        self,
+        simfiles: Iterable[SimfileHeader],
+        pack_dirs: Iterable[Path] = (),
+        song_dirs: Iterable[Path] = (),
+    ) -> None:
+        """
+        Drops every entry in `pack_dirs` and `song_dirs`, then indexes
+        `simfiles` (replacing any entry for the same directory), so
+        refreshed packs lose the songs that aren't in them anymore.
+        """
+        # One entry per directory, the last given
+        entries = list({sf.dir: search_entry(sf) for sf in simfiles}.values())
+        pack_dirs = set(pack_dirs)
+        song_dirs = set(song_dirs) | {entry.dir for entry in entries}
+        with self._lock:
+            stale = [
+                id
+                for dir, id in self._ids.items()
+                if dir in song_dirs or dir.parent in pack_dirs
+            ]
+            removed = {(self._remove(id), id) for id in stale}
+            added = sorted((entry.key, self._add(entry)) for entry in entries)
+            if len(removed) + len(added) <= MAX_INPLACE_UPDATES:
+                for item in removed:
+                    del self._sorted[bisect.bisect_left(self._sorted, item)]
+                for item in added:
+                    bisect.insort(self._sorted, item)
+            else:
+                kept = (item for item in self._sorted if item not in removed)
+                self._sorted = list(heapq.merge(kept, added))
+
+    def _add(self, entry: SearchEntry) -> int:
+        id = self._next_id
+        self._next_id += 1
+        self._entries[id] = entry
+        self._ids[entry.dir] = id
+        for trigram in trigrams(entry.text):
+            self._trigrams.setdefault(trigram, set()).add(id)
+        for prefix in self._word_prefixes(entry.text):
+            self._prefixes.setdefault(prefix, set()).add(id)
+        for meter in entry.meters:
+            self._meters.setdefault(meter, set()).add(id)
+        return id
+
+    def _remove(self, id: int) -> str:
+        """Drops entry `id`, returning its key."""
+        entry = self._entries.pop(id)
+        del self._ids[entry.dir]
+        for index, keys in (
+            (self._trigrams, trigrams(entry.text)),
+            (self._prefixes, self._word_prefixes(entry.text)),
+            (self._meters, entry.meters),
+        ):
+            for key in keys:
+                ids = index[key]
+                ids.discard(id)
+                if not ids:
+                    del index[key]
+        return entry.key
+
+    @staticmethod
+    def _word_prefixes(text: str) -> set[str]:
+        return {word[:n] for word in text.split() for n in (1, 2)}
+
+    # Searching
+    # Results are ordered by title, with titles starting with the query
+    # first. Those are a contiguous run of `_sorted`, found by bisection.
+    # The rest come from walking `_sorted` until enough candidates turn up
+    # when candidates are plentiful (the walk ends early), or from ranking
+    # the candidates themselves when they're few.
+
+    def search(
+        self, query: str, limit: int = DEFAULT_LIMIT
+    ) -> list[SearchEntry]:
+        """
+        Entries matching every word of `query`, those whose title starts
+        with the query first, then by title.
+        """
+        words = normalize(query).split()
+        if not words:
+            return []
+        with self._lock:
+            candidates = None
+            # Rarest words first, so the candidate set shrinks fastest
+            for ids in sorted(map(self._lookup, words), key=len):
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+            # Index hits are exact for short words; longer ones may have
+            # their trigrams spread over several words of the text
+            long_words = [w for w in words if len(w) > 3]
+
+            def matches(id: int) -> bool:
+                return id in candidates and all(
+                    self._matches(self._entries[id], w) for w in long_words
+                )
+
+            phrase = " ".join(words)
+            results = []
+            i = bisect.bisect_left(self._sorted, (phrase,))
+            while i < len(self._sorted) and len(results) < limit:
+                key, id = self._sorted[i]
+                if not key.startswith(phrase):
+                    break
+                if matches(id):
+                    results.append(id)
+                i += 1
+            if len(results) < limit:
+                seen = set(results)
+                needed = limit - len(results)
+                if len(candidates) ** 2 > limit * len(self._entries):
+                    rest = (
+                        id
+                        for _, id in self._sorted
+                        if id not in seen and matches(id)
+                    )
+                    results += itertools.islice(rest, needed)
+                else:
+                    results += heapq.nsmallest(
+                        needed,
+                        (id for id in candidates - seen if matches(id)),
+                        key=lambda id: self._entries[id].key,
+                    )
+            return [self._entries[id] for id in results]
+
+    def _lookup(self, word: str) -> set[int]:
+        """Ids of the entries that may match `word`."""
+        if len(word) < 3:
+            ids = self._prefixes.get(word, set())
+        else:
+            grams = sorted(
+                (self._trigrams.get(t, set()) for t in trigrams(word)),
+                key=len,
+            )
+            ids = grams[0].intersection(*grams[1:])
+        if word.isdigit():
+            ids = ids | self._meters.get(word, set())
+        return ids
+
+    @staticmethod
+    def _matches(entry: SearchEntry, word: str) -> bool:
+        if word in entry.meters:
+            return True
+        if len(word) < 3:
+            return f" {word}" in entry.text
+        return word in entry.text
+
+    def get(self, song_dir: Path) -> Optional[SearchEntry]:
+        with self._lock:
+            id = self._ids.get(song_dir)
+            return None if id is None else self._entries[id]
@@ -0,0 +1,162 @@
+import asyncio
+import re
+import time
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+V = TypeVar("V")
+
+# Discord attachment URLs carry signed, expiring query parameters
+DISCORD_CDN_HOSTS = {"cdn.discordapp.com", "media.discordapp.net"}
+GOOGLE_DRIVE_ID = re.compile(r"/(?:file/)?d/([\w-]+)")
+
+
+def normalize_url(url: str) -> str:
+    """
+    Returns a canonical form of `url` so that different spellings of the same
+    download (tracking parameters, fragments, Drive share links, ...) compare
+    equal. Non-URLs are returned stripped but otherwise unchanged.
+    """
+    url = url.strip()
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        return url
+    host = parts.netloc.lower()
+    if host in ("drive.google.com", "drive.usercontent.google.com"):
+        match = GOOGLE_DRIVE_ID.search(parts.path)
+        file_id = (
+            match and match[1] or parse_qs(parts.query).get("id", [""])[0]
+        )
+        if file_id:
+            return f"gdrive:{file_id}"
+    query = "" if host in DISCORD_CDN_HOSTS else parts.query
+    return urlunsplit(("https", host, parts.path, query, ""))
+
+
+def link_name(link: str) -> str:
+    """Short name for a link, for listings and status tables."""
+    normalized = normalize_url(link)
+    return normalized.rstrip("/").rsplit("/", 1)[-1][:60]
+
+
+class FlightRedirect(Exception):
+    """Raised inside a flight to hand it off to another flight's result."""
+
+    future: asyncio.Future
+
+    def __init__(self, future: asyncio.Future):
+        super().__init__("Identical job already in progress")
+        self.future = future
+
+
+class Flight:
+    """Handle given to the job running a SingleFlight call."""
+
+    group: "SingleFlight"
+    future: asyncio.Future
+    keys: list[Hashable]
+
+    def __init__(self, group: "SingleFlight", future: asyncio.Future):
+        self.group = group
+        self.future = future
+        self.keys = []
+
+    def claim(self, key: Hashable) -> None:
+        """
+        Registers another key (e.g. a content hash learned mid-job) for this
+        flight. If a different flight already holds it, raises FlightRedirect
+        so this job can stop and share that flight's result instead.
+        """
+        other = self.group.lookup(key)
+        if other is not None and other is not self.future:
+            raise FlightRedirect(other)
+        self.group._in_flight[key] = self.future
+        self.keys.append(key)
+
+
+class SingleFlight(Generic[V]):
+    """
+    Deduplicates identical concurrent jobs. Calls to `run` with a key that is
+    already in flight wait for that job's result instead of starting another,
+    and successful results are remembered for `ttl` seconds, as long as
+    `still_valid` (if given) says they are.
+    """
+
+    ttl: float
+    still_valid: Optional[Callable[[V], bool]]
+
+    def __init__(
+        self, ttl: float, still_valid: Optional[Callable[[V], bool]] = None
+    ):
+        self.ttl = ttl
+        self.still_valid = still_valid
+        self._in_flight: dict[Hashable, asyncio.Future[V]] = {}
+        self._recent: dict[Hashable, tuple[float, V]] = {}
+
+    def lookup(self, key: Hashable) -> Optional[asyncio.Future[V]]:
+        """An in-flight or recently completed job for `key`, if any."""
+        if key in self._in_flight:
+            return self._in_flight[key]
+        if key in self._recent:
+            completed_at, result = self._recent[key]
+            if time.monotonic() - completed_at < self.ttl and (
+                self.still_valid is None or self.still_valid(result)
+            ):
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(result)
+                return future
+            del self._recent[key]
+        return None
+
+    async def run(
+        self,
+        key: Hashable,
+        job: Callable[[Flight], Awaitable[V]],
+        on_wait: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> V:
+        """
+        Runs `job` unless a job for `key` is in flight or recently done, in
+        which case `on_wait` is awaited (if the job is still running) and
+        that job's result is returned (or its exception raised).
+        """
+        existing = self.lookup(key)
+        if existing is not None:
+            if not existing.done() and on_wait is not None:
+                await on_wait()
+            return await asyncio.shield(existing)
+
+        future = asyncio.get_running_loop().create_future()
+        # Don't warn about unretrieved exceptions when nobody else joined
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        flight = Flight(self, future)
+        flight.claim(key)
+        try:
+            try:
+                result = await job(flight)
+            except FlightRedirect as redirect:
+                if on_wait is not None:
+                    await on_wait()
+                result = await asyncio.shield(redirect.future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            now = time.monotonic()
+            for claimed in flight.keys:
+                self._recent[claimed] = (now, result)
+            return result
+        finally:
+            for claimed in flight.keys:
+                if self._in_flight.get(claimed) is future:
+                    del self._in_flight[claimed]
+            self._expire()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for key, (completed_at, _) in list(self._recent.items()):
+            if now - completed_at >= self.ttl:
+                del self._recent[key]
@@ -0,0 +1,200 @@
+# ITGmania song cache upkeep.
+# ITGmania keeps a parsed copy of every song in its cache directory, one file
+# per song directory under Songs/, named after the song's path (Songs/Pack/Song
+# becomes Songs_Pack_Song). With the FastLoad preference on, entries are used
+# without looking at the song's files again, so an entry left over from a
+# replaced song shows its old charts until the whole cache is rebuilt.
+#
+# Entries can't be generated here: they hold data only the game computes
+# (music length, directory hashes, ...), and a wrong entry is worse than none.
+# Instead, exactly the entries that no longer match their songs are removed,
+# so the next boot parses just those songs rather than rebuilding everything.
+import glob
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+SONGS_SUBDIR = "Songs"
+
+# Invalidations after installs run here, off the install path; there are only
+# a few files to remove per install
+INVALIDATE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="song-cache"
+)
+# Song directories checked per task during a sweep
+SWEEP_CHUNKSIZE = 64
+
+
+@dataclass
+class CacheSweep:
+    # Song directories in the library
+    songs: int = 0
+    # Entries that still match their song and were kept
+    fresh: int = 0
+    # Entries older than their song's files, removed
+    stale: int = 0
+    # Entries for songs that aren't in the library anymore, removed
+    orphaned: int = 0
+
+    @property
+    def missing(self) -> int:
+        """Songs without an entry, which the game parses on its next boot."""
+        return self.songs - self.fresh - self.stale
+
+
+def entry_name(song_dir: Path) -> str:
+    """Name of the cache entry for the song in `song_dir`."""
+    return "_".join(
+        [song_dir.parent.parent.name, song_dir.parent.name, song_dir.name]
+    )
+
+
+def song_mtime_ns(song_dir: Path) -> int:
+    """
+    Latest modification time of `song_dir` and the files directly in it,
+    which is what the game's own staleness check looks at.
+    """
+    mtime = song_dir.stat().st_mtime_ns
+    with os.scandir(song_dir) as entries:
+        for entry in entries:
+            try:
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+            except FileNotFoundError:
+                continue
+    return mtime
+
+
+def invalidate_songs(cache: Path, song_dirs: Iterable[Path]) -> int:
+    """Removes the entries for `song_dirs`. Returns how many there were."""
+    removed = 0
+    for song_dir in song_dirs:
+        try:
+            cache.joinpath(SONGS_SUBDIR, entry_name(song_dir)).unlink()
+            removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def invalidate_pack(cache: Path, pack_dir: Path) -> int:
+    """
+    Removes the entries for every song in `pack_dir`, including songs a
+    replaced version of the pack had and the new one doesn't.
+    """
+    prefix = f"{pack_dir.parent.name}_{pack_dir.name}_"
+    # Entry names are ambiguous: "Songs_A_B_C" may be song "B_C" of pack "A"
+    # or song "C" of pack "A_B", so keep those of packs like the latter
+    others = {
+        entry_name(song_dir)
+        for other in pack_dir.parent.glob(f"{glob.escape(pack_dir.name)}_*")
+        if other.is_dir()
+        for song_dir in other.iterdir()
+    }
+    removed = 0
+    try:
+        entries = os.scandir(cache.joinpath(SONGS_SUBDIR))
+    except FileNotFoundError:
+        return 0
+    with entries:
+        for entry in entries:
+            if entry.name.startswith(prefix) and entry.name not in others:
+                try:
+                    os.unlink(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    continue
+    return removed
+
+
+def invalidate_later(
+    cache: Path,
+    song_dirs: Iterable[Path] = (),
+    pack_dir: Optional[Path] = None,
+) -> None:
+    """
+    Removes the entries for `song_dirs` (or all of `pack_dir`) in the
+    background. Failures are logged; the game just keeps the old entries.
+    """
+
+    def invalidate() -> int:
+        removed = invalidate_songs(cache, song_dirs)
+        if pack_dir is not None:
+            removed += invalidate_pack(cache, pack_dir)
+        return removed
+
+    def done(future: Future) -> None:
+        if (e := future.exception()) is not None:
+            LOGGER.error(f"Could not invalidate song cache entries: {e}")
+        elif future.result():
+            LOGGER.info(f"Invalidated {future.result()} song cache entries")
+
+    INVALIDATE_EXECUTOR.submit(invalidate).add_done_callback(done)
+
+
+def _check_songs(songs_cache: Path, song_dirs: list[Path]) -> tuple[int, int]:
+    """Removes the stale entries for `song_dirs`. Returns (fresh, stale)."""
+    fresh, stale = 0, 0
+    for song_dir in song_dirs:
+        entry = songs_cache.joinpath(entry_name(song_dir))
+        try:
+            entry_mtime = entry.stat().st_mtime_ns
+        except FileNotFoundError:
+            continue
+        try:
+            is_fresh = entry_mtime >= song_mtime_ns(song_dir)
+        except FileNotFoundError:
+            # Removed since listing; the orphan pass picks it up next time
+            continue
+        if is_fresh:
+            fresh += 1
+        else:
+            entry.unlink(missing_ok=True)
+            stale += 1
+    return fresh, stale
+
+
+def sweep(cache: Path, packs: Path, workers: int | None = None) -> CacheSweep:
+    """
+    Brings the whole cache in line with the library under `packs`: removes
+    entries that are older than their song's files or whose song is gone,
+    and leaves the rest alone. Songs are checked on `workers` threads (one
+    per core by default); the work is stat calls, which release the GIL.
+    """
+    songs_cache = cache.joinpath(SONGS_SUBDIR)
+    if not songs_cache.is_dir():
+        return CacheSweep()
+    song_dirs = [
+        song_dir
+        for pack_dir in packs.iterdir()
+        if pack_dir.is_dir() and not pack_dir.name.startswith(".")
+        for song_dir in pack_dir.iterdir()
+        if song_dir.is_dir()
+    ]
+    result = CacheSweep(songs=len(song_dirs))
+    chunks = [
+        song_dirs[i : i + SWEEP_CHUNKSIZE]
+        for i in range(0, len(song_dirs), SWEEP_CHUNKSIZE)
+    ]
+    with ThreadPoolExecutor(
+        max_workers=workers or os.cpu_count(), thread_name_prefix="cache-sweep"
+    ) as executor:
+        for fresh, stale in executor.map(
+            lambda chunk: _check_songs(songs_cache, chunk), chunks
+        ):
+            result.fresh += fresh
+            result.stale += stale
+    known = {entry_name(song_dir) for song_dir in song_dirs}
+    prefix = f"{packs.name}_"
+    with os.scandir(songs_cache) as entries:
+        for entry in entries:
+            # Entries for other song folders (e.g. AdditionalSongs) aren't
+            # ours to judge
+            if entry.name.startswith(prefix) and entry.name not in known:
+                os.unlink(entry.path)
+                result.orphaned += 1
+    return result
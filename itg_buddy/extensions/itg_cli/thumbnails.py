@@ -0,0 +1,281 @@
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Optional
+
+# Pillow is optional (banners are then sent as they are) and imported on
+# first use, see load_pillow
+Image = ImageOps = None
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thumbnails (
+    sha256 TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+# Thumbnails fit in this box; embeds show images at most about 400px wide,
+# and banners are usually 418x164 or a multiple of it
+MAX_DIMENSIONS = (836, 328)
+# Thumbnails are recompressed until they're at most this big
+MAX_THUMBNAIL_BYTES = 256 * 1024
+# Qualities tried, in order, when a PNG thumbnail would be too big
+JPEG_QUALITIES = (85, 70, 55)
+# Banners bigger than this are never read (they'd be sent as is)
+MAX_SOURCE_BYTES = 64 * 1024 * 1024
+
+# Thumbnails are rendered here: both when warming the cache after an install
+# and, for misses, on behalf of the embed being built. Pillow releases the
+# GIL while decoding and resizing.
+THUMBNAIL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="thumbnail"
+)
+
+
+def load_pillow() -> bool:
+    """
+    Imports Pillow's Image and ImageOps if they aren't yet. False if Pillow
+    isn't installed.
+    """
+    global Image, ImageOps
+    if Image is None:
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            return False
+    return True
+
+
+def render_thumbnail(data: bytes) -> tuple[bytes, str]:
+    """
+    Downscales the image in `data` to fit MAX_DIMENSIONS and recompresses it
+    to fit MAX_THUMBNAIL_BYTES if it can. Returns the encoded thumbnail and
+    its file suffix. Images that already fit are kept as they are; others
+    lose any animation.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        suffix = f".{(image.format or 'png').lower()}"
+        if (
+            len(data) <= MAX_THUMBNAIL_BYTES
+            and image.width <= MAX_DIMENSIONS[0]
+            and image.height <= MAX_DIMENSIONS[1]
+            and suffix in (".png", ".jpeg", ".gif", ".webp")
+        ):
+            return data, suffix
+        image.seek(0)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(MAX_DIMENSIONS, Image.Resampling.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        output = io.BytesIO()
+        image.save(output, "PNG", optimize=True)
+        if output.tell() <= MAX_THUMBNAIL_BYTES or has_alpha:
+            return output.getvalue(), ".png"
+        for quality in JPEG_QUALITIES:
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=quality, optimize=True)
+            if output.tell() <= MAX_THUMBNAIL_BYTES:
+                break
+        return output.getvalue(), ".jpg"
+
+
+class ThumbnailCache:
+    """
+    Content-addressed cache of banner thumbnails under `root`, small enough
+    to upload with every embed.
+
+    Thumbnails are keyed by the SHA-256 of the banner they were made from, so
+    packs sharing a banner share a thumbnail; banner paths are remembered with
+    their mtime and size so unchanged banners aren't rehashed. The least
+    recently used thumbnails are evicted once the cache grows past
+    `max_bytes`. Without Pillow, `thumbnail` just returns the banner itself.
+    All methods except `warm` block, so call them off the event loop.
+    """
+
+    logger: logging.Logger
+    root: Path
+    max_bytes: int
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Thumbnails being rendered, so a banner is only rendered once
+        self._rendering: dict[str, Future] = {}
+        root.joinpath("files").mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != (
+                SCHEMA_VERSION
+            ):
+                for table in ("sources", "thumbnails"):
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.executescript(SCHEMA)
+        if importlib.util.find_spec("PIL") is None:
+            self.logger.warning(
+                "Pillow isn't installed; banners are sent at full size"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.root.joinpath("index.db"), timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        return db
+
+    def _file_path(self, name: str) -> Path:
+        return self.root.joinpath("files", name)
+
+    def thumbnail(self, banner: Path) -> Path:
+        """
+        The thumbnail for `banner`, rendering it if needed, or `banner`
+        itself if it can't be thumbnailed.
+        """
+        if not load_pillow():
+            return banner
+        try:
+            stat = banner.stat()
+            if stat.st_size > MAX_SOURCE_BYTES:
+                return banner
+            sha256 = self._source_digest(banner, stat)
+            cached = self._lookup(sha256)
+            if cached is not None:
+                return cached
+            return self._render(banner, sha256)
+        except Exception as e:
+            self.logger.warning(f"Could not thumbnail {banner}: {e}")
+            return banner
+
+    def warm(self, banners: Iterable[Path]) -> None:
+        """Renders thumbnails for `banners` in the background."""
+        if not load_pillow():
+            return
+        for banner in set(banners):
+            THUMBNAIL_EXECUTOR.submit(self.thumbnail, banner)
+
+    def _source_digest(self, banner: Path, stat: os.stat_result) -> str:
+        with closing(self._connect()) as db:
+            row = db.execute(
+                "SELECT sha256 FROM sources WHERE path = ? AND mtime_ns = ? "
+                "AND size = ?",
+                (str(banner), stat.st_mtime_ns, stat.st_size),
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        sha256 = hashlib.sha256(banner.read_bytes()).hexdigest()
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (str(banner), stat.st_mtime_ns, stat.st_size, sha256),
+            )
+        return sha256
+
+    def _lookup(self, sha256: str) -> Optional[Path]:
+        with closing(self._connect()) as db, db:
+            row = db.execute(
+                "SELECT name FROM thumbnails WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row is None:
+                return None
+            path = self._file_path(row[0])
+            if not path.is_file():
+                db.execute(
+                    "DELETE FROM thumbnails WHERE sha256 = ?", (sha256,)
+                )
+                return None
+            db.execute(
+                "UPDATE thumbnails SET last_used = ? WHERE sha256 = ?",
+                (time.time(), sha256),
+            )
+        return path
+
+    def _render(self, banner: Path, sha256: str) -> Path:
+        with self._lock:
+            future = self._rendering.get(sha256)
+            owner = future is None
+            if owner:
+                future = self._rendering[sha256] = Future()
+        if not owner:
+            return future.result()
+        try:
+            data, suffix = render_thumbnail(banner.read_bytes())
+            name = f"{sha256}{suffix}"
+            path = self._file_path(name)
+            temp = path.with_name(f".{name}.tmp")
+            temp.write_bytes(data)
+            temp.replace(path)
+            with closing(self._connect()) as db:
+                with db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO thumbnails VALUES "
+                        "(?, ?, ?, ?)",
+                        (sha256, name, len(data), time.time()),
+                    )
+                self._evict(db, keep=sha256)
+            self.logger.info(
+                f"Thumbnailed {banner} ({banner.stat().st_size} bytes) "
+                + f"to {len(data)} bytes"
+            )
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._rendering[sha256]
+
+    def _evict(self, db: sqlite3.Connection, keep: str) -> None:
+        """Deletes thumbnails, oldest first, until under the cap."""
+        total = db.execute("SELECT SUM(size) FROM thumbnails").fetchone()[0]
+        if (total or 0) <= self.max_bytes:
+            return
+        rows = db.execute(
+            "SELECT sha256, name, size FROM thumbnails ORDER BY last_used"
+        ).fetchall()
+        for sha256, name, size in rows:
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            with db:
+                db.execute(
+                    "DELETE FROM thumbnails WHERE sha256 = ?", (sha256,)
+                )
+            self._file_path(name).unlink(missing_ok=True)
+            total -= size
+
+
+# Cache used for embed banners, if any (see set_thumbnail_cache)
+THUMBNAIL_CACHE: Optional[ThumbnailCache] = None
+
+
+def set_thumbnail_cache(cache: Optional[ThumbnailCache]) -> None:
+    global THUMBNAIL_CACHE
+    THUMBNAIL_CACHE = cache
+
+
+def banner_thumbnail(banner: Path) -> Path:
+    """The file to attach for `banner`: its thumbnail, if there's a cache."""
+    if THUMBNAIL_CACHE is None:
+        return banner
+    return THUMBNAIL_CACHE.thumbnail(banner)
@@ -0,0 +1,316 @@
+# Library watcher.
+# Packs are sometimes copied onto the cabinet by hand (USB, SMB), behind the
+# bot's back. The watcher turns filesystem events under the packs directory
+# into batches of changed pack and song directories, so the library index
+# (and anything derived from it) can be updated incrementally instead of
+# rescanned from scratch.
+#
+# On Linux it uses inotify through ctypes, watching the packs directory, each
+# pack and each song directory. Events are debounced: a batch is delivered
+# once things have been quiet for a moment, so a copy in progress is picked
+# up as a whole. Elsewhere, or when inotify runs out of watches, it falls
+# back to polling directory mtimes.
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+# Seconds without new events before a batch of changes is delivered
+DEBOUNCE_SECONDS = 2.0
+# A batch is delivered after this many seconds even if events keep coming
+MAX_DELAY_SECONDS = 30.0
+# Seconds between scans when polling
+POLL_INTERVAL = 60.0
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# Receives the pack directories and song directories that changed. Packs in
+# the first set may be gone, and should be rescanned as a whole.
+ChangeHandler = Callable[[set[Path], set[Path]], None]
+
+
+class Inotify:
+    """Minimal inotify binding: add watches and read raw events."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def read(self) -> list[tuple[int, int, str]]:
+        """Pending events as (watch descriptor, mask, name) tuples."""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """
+    Watches the packs directory on a background thread, calling `on_change`
+    (on that thread) with each debounced batch of changes.
+
+    `in_sync` tells whether every change since `start` has been seen, which
+    is what makes the library index's snapshot trustworthy at the next start
+    (see LibraryIndex.save_snapshot). Polling can miss edits made in place,
+    so it never is.
+    """
+
+    logger: logging.Logger
+    packs: Path
+
+    def __init__(
+        self,
+        packs: Path,
+        on_change: ChangeHandler,
+        debounce: float = DEBOUNCE_SECONDS,
+        poll_interval: float = POLL_INTERVAL,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.packs = packs
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._inotify: Optional[Inotify] = None
+        self._paths: dict[int, Path] = {}
+        self._pending_packs: set[Path] = set()
+        self._pending_songs: set[Path] = set()
+        self._first_event = 0.0
+        self._last_event = 0.0
+        self._mtimes: dict[Path, int] = {}
+
+    @property
+    def in_sync(self) -> bool:
+        return self._inotify is not None and self._thread is not None
+
+    def start(self) -> None:
+        """Sets up the watches (which walks the library) and starts."""
+        if sys.platform.startswith("linux"):
+            try:
+                self._inotify = Inotify()
+                self._watch_tree(self.packs, depth=0)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self.logger.warning(
+                        "Out of inotify watches, polling instead (raise "
+                        "fs.inotify.max_user_watches to fix)"
+                    )
+                else:
+                    self.logger.warning(f"Can't use inotify, polling: {e}")
+                self._close_inotify()
+        if self._inotify is None:
+            self._mtimes = self._scan_mtimes()
+        self._thread = threading.Thread(
+            target=self._run, name="library-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops watching, delivering any changes still being debounced."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush()
+        self._close_inotify()
+
+    def _close_inotify(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._paths.clear()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self._inotify is not None:
+                    self._read_events()
+                else:
+                    self._stop.wait(self.poll_interval)
+                    self._poll()
+            except Exception:
+                self.logger.exception("Library watcher failed")
+                self._stop.wait(self.debounce)
+
+    # inotify
+
+    def _watch_tree(self, path: Path, depth: int) -> None:
+        """Watches `path` (at `depth` below packs) and its subdirectories."""
+        if depth > 2 or (depth > 0 and path.name.startswith(".")):
+            return
+        try:
+            wd = self._inotify.add_watch(path, WATCH_MASK)
+        except FileNotFoundError:
+            return
+        self._paths[wd] = path
+        try:
+            subdirs = [e.path for e in os.scandir(path) if e.is_dir()]
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for subdir in subdirs:
+            self._watch_tree(Path(subdir), depth + 1)
+
+    def _read_events(self) -> None:
+        # Wake up regularly to notice stop() and the end of a debounce
+        ready, _, _ = select.select(
+            [self._inotify.fd], [], [], min(self.debounce, 1.0)
+        )
+        if ready:
+            for wd, mask, name in self._inotify.read():
+                self._handle_event(wd, mask, name)
+        now = time.monotonic()
+        if self._pending() and (
+            now - self._last_event >= self.debounce
+            or now - self._first_event >= MAX_DELAY_SECONDS
+        ):
+            self._flush()
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped: rescan everything we know of
+            self.logger.warning("inotify queue overflowed, rescanning")
+            self._mark_all()
+            return
+        if mask & IN_IGNORED:
+            self._paths.pop(wd, None)
+            return
+        parent = self._paths.get(wd)
+        if parent is None or not name:
+            # Events about a watched directory itself (deleted, moved) are
+            # also reported by its parent's watch
+            return
+        path = parent.joinpath(name)
+        depth = len(path.relative_to(self.packs).parts)
+        if depth == 0 or any(p.startswith(".") for p in path.parts[-depth:]):
+            return
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(path, depth)
+        self._mark(path, bool(mask & IN_ISDIR))
+
+    # Polling
+
+    def _scan_mtimes(self) -> dict[Path, int]:
+        """Mtimes of the packs and song directories under packs."""
+        mtimes = {}
+        for pack in os.scandir(self.packs):
+            if not pack.is_dir() or pack.name.startswith("."):
+                continue
+            try:
+                mtimes[Path(pack.path)] = pack.stat().st_mtime_ns
+                for song in os.scandir(pack.path):
+                    if song.is_dir():
+                        mtimes[Path(song.path)] = song.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+        return mtimes
+
+    def _poll(self) -> None:
+        mtimes = self._scan_mtimes()
+        for path in mtimes.keys() | self._mtimes.keys():
+            if mtimes.get(path) != self._mtimes.get(path):
+                self._mark(path, is_dir=True)
+        self._mtimes = mtimes
+        self._flush()
+
+    # Batching
+
+    def _mark(self, path: Path, is_dir: bool) -> None:
+        """Records a change at `path` under packs."""
+        parts = path.relative_to(self.packs).parts
+        if len(parts) == 1 or (len(parts) == 2 and not is_dir):
+            # A pack, or a file directly in one (e.g. its banner)
+            self._pending_packs.add(self.packs.joinpath(parts[0]))
+        else:
+            self._pending_songs.add(self.packs.joinpath(*parts[:2]))
+        self._touch()
+
+    def _mark_all(self) -> None:
+        """Records a change to every pack, including ones that are gone."""
+        self._pending_packs |= {
+            p for p in self._paths.values() if p.parent == self.packs
+        }
+        self._pending_packs |= {
+            p
+            for p in self.packs.iterdir()
+            if p.is_dir() and not p.name.startswith(".")
+        }
+        self._touch()
+
+    def _touch(self) -> None:
+        now = time.monotonic()
+        if not self._first_event:
+            self._first_event = now
+        self._last_event = now
+
+    def _pending(self) -> bool:
+        return bool(self._pending_packs or self._pending_songs)
+
+    def _flush(self) -> None:
+        if not self._pending():
+            return
+        packs, self._pending_packs = self._pending_packs, set()
+        songs = {s for s in self._pending_songs if s.parent not in packs}
+        self._pending_songs = set()
+        self._first_event = 0.0
+        try:
+            self.on_change(packs, songs)
+        except Exception:
+            self.logger.exception("Could not apply library changes")
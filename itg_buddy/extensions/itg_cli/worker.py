@@ -0,0 +1,372 @@
+# Install workers.
+# Extracting a big archive and reading its simfiles is mostly Python holding
+# the GIL. Run on a thread of the bot, it can hold off discord.py's heartbeats
+# and interaction acks for long enough to cause "application did not respond"
+# errors and gateway reconnects. Those stages run in worker processes
+# instead, spawned when the cog loads and kept for its lifetime.
+#
+# Each worker talks to the bot over a pipe. The bot sends calls (a
+# module-level function from pipeline.py and its arguments), cancellations
+# and answers to overwrite questions. The worker sends back progress events,
+# overwrite questions, and each call's result or exception. A worker runs
+# every call on a thread of its own, so it keeps reading cancellations and
+# answers while stages run, and several jobs can share a worker.
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Optional
+
+import discord
+
+from itg_buddy.extensions.itg_cli.pipeline import OverwriteQuestion
+from itg_buddy.extensions.itg_cli.progress import (
+    ProgressEvent,
+    StageCancelled,
+    capture_progress,
+)
+
+# Messages are tuples of a kind, the call's id and the kind's fields
+# Bot to worker: (CALL, id, func, args, kwargs, asks), (CANCEL, id),
+# (ANSWER, id, overwrite), (STOP, 0)
+CALL = "call"
+CANCEL = "cancel"
+ANSWER = "answer"
+STOP = "stop"
+# Worker to bot: (PROGRESS, id, event), (QUESTION, id, question),
+# (RESULT, id, value), (ERROR, id, exception)
+PROGRESS = "progress"
+QUESTION = "question"
+RESULT = "result"
+ERROR = "error"
+
+# Seconds a stopping worker gets to finish its calls before it's killed
+SHUTDOWN_TIMEOUT = 30.0
+# Seconds between checks for cancellation while waiting for an answer
+ANSWER_POLL_INTERVAL = 0.5
+
+
+class WorkerCrashed(Exception):
+    """The worker process running a call died before it finished."""
+
+
+def _picklable(e: BaseException) -> BaseException:
+    """`e` if it survives the trip back to the bot, else a stand-in."""
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return Exception(f"{e.__class__.__name__}: {e}")
+
+
+# Worker side
+
+
+class _Server:
+    """Serves calls from the bot in a worker process."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.cancelled: dict[int, threading.Event] = {}
+        self.answers: dict[int, Future] = {}
+        self.threads: list[threading.Thread] = []
+
+    def send(self, *message) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+    def serve(self) -> None:
+        while True:
+            try:
+                kind, id, *fields = self.conn.recv()
+            except EOFError:
+                # The bot is gone; nobody is waiting for results
+                return
+            if kind == CALL:
+                with self.lock:
+                    self.cancelled[id] = threading.Event()
+                thread = threading.Thread(
+                    target=self.run, args=(id, *fields), name=f"call-{id}"
+                )
+                thread.start()
+                self.threads = [t for t in self.threads if t.is_alive()]
+                self.threads.append(thread)
+            elif kind == CANCEL:
+                with self.lock:
+                    if id in self.cancelled:
+                        self.cancelled[id].set()
+            elif kind == ANSWER:
+                with self.lock:
+                    answer = self.answers.pop(id, None)
+                if answer is not None:
+                    answer.set_result(fields[0])
+            elif kind == STOP:
+                break
+        # Calls waiting on a question or reporting progress give up; the
+        # rest (e.g. installs halfway through their renames) are finished
+        with self.lock:
+            for cancelled in self.cancelled.values():
+                cancelled.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run(
+        self,
+        id: int,
+        func: Callable,
+        args: tuple,
+        kwargs: dict[str, Any],
+        asks: bool,
+    ) -> None:
+        cancelled = self.cancelled[id]
+        if asks:
+            kwargs = kwargs | {
+                "overwrite": lambda question: self.ask(id, question, cancelled)
+            }
+        try:
+            with capture_progress(
+                lambda event: self.send(PROGRESS, id, event), cancelled
+            ):
+                result = func(*args, **kwargs)
+            self.send(RESULT, id, result)
+        except BaseException as e:
+            self.send(ERROR, id, _picklable(e))
+        finally:
+            with self.lock:
+                del self.cancelled[id]
+
+    def ask(
+        self, id: int, question: OverwriteQuestion, cancelled: threading.Event
+    ) -> bool:
+        """Asks the bot `question` on behalf of call `id`."""
+        answer = Future()
+        with self.lock:
+            self.answers[id] = answer
+        self.send(QUESTION, id, question)
+        while True:
+            try:
+                return answer.result(timeout=ANSWER_POLL_INTERVAL)
+            except TimeoutError:
+                if cancelled.is_set():
+                    with self.lock:
+                        self.answers.pop(id, None)
+                    raise StageCancelled() from None
+
+
+def _serve(conn: Connection, log_level: int) -> None:
+    """Entry point of a worker process."""
+    discord.utils.setup_logging(level=log_level, root=True)
+    _Server(conn).serve()
+
+
+# Bot side
+
+
+@dataclass
+class WorkerCall:
+    """A call running in a worker. Its future resolves to the result."""
+
+    id: int
+    future: Future
+    on_event: Callable[[ProgressEvent], None]
+    # Answers the call's overwrite questions, if it asks any
+    on_question: Optional[Callable[[OverwriteQuestion], Future]]
+    worker: "_Worker"
+
+    def cancel(self) -> None:
+        """
+        Stops the call at its next progress update or while it waits for an
+        answer, like a cancelled stage in a thread (see wrappers.run_stage).
+        """
+        try:
+            self.worker.send(CANCEL, self.id)
+        except OSError:
+            pass
+
+
+class _Worker:
+    """A worker process, seen from the bot."""
+
+    logger: logging.Logger
+
+    def __init__(self, ctx: multiprocessing.context.SpawnContext, name: str):
+        self.logger = logging.getLogger(f"{__name__}.{name}")
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_serve,
+            args=(child, logging.getLogger().level),
+            name=name,
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.calls: dict[int, WorkerCall] = {}
+        self.alive = True
+        self.reader = threading.Thread(
+            target=self._read, name=f"{name}-reader", daemon=True
+        )
+        self.reader.start()
+
+    def send(self, *message) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+    def submit(
+        self,
+        id: int,
+        func: Callable,
+        args: tuple,
+        kwargs: dict[str, Any],
+        on_event: Callable[[ProgressEvent], None],
+        on_question: Optional[Callable[[OverwriteQuestion], Future]],
+    ) -> WorkerCall:
+        call = WorkerCall(id, Future(), on_event, on_question, self)
+        with self.lock:
+            if not self.alive:
+                raise WorkerCrashed("Install worker is not running.")
+            self.calls[id] = call
+        try:
+            self.send(CALL, id, func, args, kwargs, on_question is not None)
+        except BaseException:
+            with self.lock:
+                self.calls.pop(id, None)
+            raise
+        return call
+
+    def _read(self) -> None:
+        while True:
+            try:
+                kind, id, *fields = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                call = self.calls.get(id)
+            if call is None:
+                continue
+            if kind == PROGRESS:
+                try:
+                    call.on_event(fields[0])
+                except Exception:
+                    self.logger.exception("Progress handler raised")
+            elif kind == QUESTION:
+                self._ask(call, fields[0])
+            elif kind in (RESULT, ERROR):
+                with self.lock:
+                    del self.calls[id]
+                if kind == RESULT:
+                    call.future.set_result(fields[0])
+                else:
+                    call.future.set_exception(fields[0])
+        with self.lock:
+            self.alive = False
+            calls, self.calls = self.calls, {}
+        if calls:
+            self.process.join(SHUTDOWN_TIMEOUT)
+        for call in calls.values():
+            call.future.set_exception(
+                WorkerCrashed(
+                    "Install worker exited "
+                    + f"(exit code {self.process.exitcode})."
+                )
+            )
+
+    def _ask(self, call: WorkerCall, question: OverwriteQuestion) -> None:
+        # Answered from elsewhere (the event loop), so this thread keeps
+        # delivering other calls' progress meanwhile
+        def answer(future: Future) -> None:
+            overwrite = not future.cancelled() and (
+                future.exception() is None and bool(future.result())
+            )
+            try:
+                self.send(ANSWER, call.id, overwrite)
+            except OSError:
+                pass
+
+        if call.on_question is None:
+            self.send(ANSWER, call.id, False)
+            return
+        call.on_question(question).add_done_callback(answer)
+
+    def close(self) -> None:
+        """Cleans up after a worker that exited on its own."""
+        self.reader.join()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self) -> None:
+        try:
+            self.send(STOP, 0)
+        except OSError:
+            pass
+        self.process.join(SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            self.logger.warning("Install worker didn't stop, killing it")
+            self.process.kill()
+            self.process.join()
+        self.reader.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Install worker processes running blocking pipeline stages off the bot's
+    process (see the top of this file). A worker that dies is replaced on
+    the next call; the calls it was running fail with WorkerCrashed.
+    """
+
+    logger: logging.Logger
+    size: int
+
+    def __init__(self, size: int):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.size = size
+        # Spawned rather than forked since the bot process has threads running
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._workers = [self._spawn(i) for i in range(size)]
+
+    def _spawn(self, i: int) -> _Worker:
+        return _Worker(self._ctx, f"install-worker-{i}")
+
+    def submit(
+        self,
+        func: Callable,
+        args: tuple = (),
+        kwargs: Optional[dict[str, Any]] = None,
+        on_event: Callable[[ProgressEvent], None] = lambda _event: None,
+        on_question: Optional[Callable[[OverwriteQuestion], Future]] = None,
+    ) -> WorkerCall:
+        """
+        Runs `func(*args, **kwargs)` on the least busy worker, handing its
+        progress to `on_event` (on a reader thread). With `on_question`,
+        `func` also gets an `overwrite` handler whose questions are answered
+        by the futures `on_question` returns.
+        """
+        with self._lock:
+            for i, worker in enumerate(self._workers):
+                if not worker.alive:
+                    self.logger.warning(
+                        f"Install worker {i} exited, starting a new one"
+                    )
+                    worker.close()
+                    self._workers[i] = self._spawn(i)
+            worker = min(self._workers, key=lambda w: len(w.calls))
+        return worker.submit(
+            next(self._ids), func, args, kwargs or {}, on_event, on_question
+        )
+
+    def shutdown(self) -> None:
+        """Stops every worker once its calls are done. Blocks."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
@@ -1,137 +1,556 @@
 import asyncio
-from io import TextIOBase
-import re
-import time
-from typing import override
+import logging
+import os
+import shutil
+import threading
+from contextlib import asynccontextmanager
+from tempfile import mkdtemp
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+from weakref import WeakValueDictionary
 import discord
-import itg_cli
-import sys
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
-from contextlib import contextmanager
-from simfile.types import Simfile
 
+from itg_buddy.extensions.itg_cli import pipeline, preview, song_cache
+from itg_buddy.extensions.itg_cli.config import DEFAULT_DOWNLOAD_CONCURRENCY
+from itg_buddy.extensions.itg_cli.download_cache import DownloadCache
+from itg_buddy.extensions.itg_cli.downloader import Downloader
+from itg_buddy.extensions.itg_cli.edits import EDIT_SCHEDULER
 from itg_buddy.extensions.itg_cli.embeds import progress_embed
-from itg_buddy.extensions.itg_cli.utils import edit_response
+from itg_buddy.extensions.itg_cli.metrics import (
+    DOWNLOAD_BYTES,
+    STAGE_SECONDS,
+)
+from itg_buddy.extensions.itg_cli.pipeline import OverwriteQuestion
+from itg_buddy.extensions.itg_cli.preview import ArchivePreview
+from itg_buddy.extensions.itg_cli.progress import (
+    ProgressEvent,
+    capture_progress,
+)
+from itg_buddy.extensions.itg_cli.worker import WorkerPool
 
+T = TypeVar("T")
 
-# Thread pools for performing add-song and add-pack operations.
-# itg-cli wasn't built with concurrency in mind, so max_workers=1 (i.e. add_song
-# and add_pack operations are handled in a queue)
-ADD_SONG_EXECUTOR = ThreadPoolExecutor(max_workers=1)
-ADD_PACK_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+LOGGER = logging.getLogger(__name__)
 
+# Where a stage reports progress: a bot response to edit with progress embeds,
+# or a callback receiving the parsed events
+ProgressTarget = (
+    discord.Message | discord.Interaction | Callable[[ProgressEvent], None]
+)
 
-# Async wrapper around itg_cli.add_song
-# Takes an additional argument, bot_response, for posting updates from stderr
-async def add_song_async(
+# Answers the install stage's overwrite questions (see pipeline.py) on the
+# event loop: True to replace what's on the machine
+OverwriteHandler = Callable[[OverwriteQuestion], Awaitable[bool]]
+
+
+async def keep_existing(_question: OverwriteQuestion) -> bool:
+    return False
+
+
+async def replace_existing(_question: OverwriteQuestion) -> bool:
+    return True
+
+
+# Thread pools for the stages of add-song and add-pack operations (see
+# pipeline.py). Downloads are network-bound and run concurrently; archives are
+# extracted and validated in parallel; only installs into the same destination
+# have to wait on each other (see DESTINATION_LOCKS).
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=DEFAULT_DOWNLOAD_CONCURRENCY, thread_name_prefix="download"
+)
+EXTRACT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="extract"
+)
+# Installs are mostly renames; overwrite prompts are answered before one
+# starts, though a late conflict can still prompt from here
+INSTALL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="install"
+)
+# Installs into the same pack/song directory are serialized. A lock lives
+# only as long as an install holds or waits on it (see destination_lock).
+DESTINATION_LOCKS: WeakValueDictionary[Path, asyncio.Lock] = (
+    WeakValueDictionary()
+)
+
+
+def destination_lock(dest: Path) -> asyncio.Lock:
+    """The lock serializing installs into `dest`."""
+    lock = DESTINATION_LOCKS.get(dest)
+    if lock is None:
+        lock = DESTINATION_LOCKS[dest] = asyncio.Lock()
+    return lock
+
+
+def set_download_concurrency(n: int) -> None:
+    """Resizes DOWNLOAD_EXECUTOR; running downloads are left to finish."""
+    global DOWNLOAD_EXECUTOR
+    old = DOWNLOAD_EXECUTOR
+    DOWNLOAD_EXECUTOR = ThreadPoolExecutor(
+        max_workers=n, thread_name_prefix="download"
+    )
+    old.shutdown(wait=False)
+
+
+# Archive cache used for URL downloads when no `downloads` dir is given
+DOWNLOAD_CACHE: DownloadCache | None = None
+
+
+def set_download_cache(cache: DownloadCache | None) -> None:
+    global DOWNLOAD_CACHE
+    DOWNLOAD_CACHE = cache
+
+
+# Resumable, pooled downloader for URLs that don't go through DOWNLOAD_CACHE
+# (itg_cli's plain download is used if unset)
+DOWNLOADER: Downloader | None = None
+
+
+def set_downloader(downloader: Downloader | None) -> None:
+    global DOWNLOADER
+    DOWNLOADER = downloader
+
+
+# Install worker processes that extraction, simfile reading and installs run
+# in, away from the event loop's GIL (see worker.py). Without them, those
+# stages run on EXTRACT_EXECUTOR and INSTALL_EXECUTOR.
+WORKER_POOL: WorkerPool | None = None
+
+
+def set_worker_pool(pool: WorkerPool | None) -> None:
+    global WORKER_POOL
+    WORKER_POOL = pool
+
+
+# Async TemporaryDirectory; a failed job can leave a whole extracted pack
+# behind, so it is deleted off the event loop. Jobs create theirs in the
+# staging directory of the library they install into (see
+# pipeline.staging_dir), so installs are renames rather than copies.
+@asynccontextmanager
+async def temporary_directory(
+    dir: Path | None = None,
+) -> AsyncIterator[Path]:
+    temp = Path(await asyncio.to_thread(mkdtemp, dir=dir))
+    try:
+        yield temp
+    finally:
+        with STAGE_SECONDS.time(stage="cleanup"):
+            await asyncio.to_thread(shutil.rmtree, temp, ignore_errors=True)
+
+
+# Preview stage. Lists the simfiles in a remote zip without downloading it (see
+# preview.py), or returns None if that can't be done. Never fails the job: the
+# download stage will find out anything the preview couldn't.
+async def preview_stage(
+    path_or_url: str, progress: ProgressTarget
+) -> ArchivePreview | None:
+    if not preview.can_preview(path_or_url):
+        return None
+    # Shares the downloader's connection pool, so the download that follows
+    # can reuse the preview's connection
+    session = DOWNLOADER.session if DOWNLOADER is not None else None
+    try:
+        with STAGE_SECONDS.time(stage="preview"):
+            return await run_stage(
+                DOWNLOAD_EXECUTOR,
+                progress,
+                lambda: preview.preview_archive(path_or_url, session),
+            )
+    except Exception as e:
+        LOGGER.info(f"Couldn't preview {path_or_url}: {e}")
+        return None
+
+
+# Download stage. Yields the archive and its SHA-256 if already known. URLs go
+# through DOWNLOAD_CACHE (if set) unless a `downloads` dir is given, and the
+# cached archive stays pinned until the job is done with it.
+@asynccontextmanager
+async def download_stage(
+    path_or_url: str,
+    downloads: Path,
+    progress: ProgressTarget,
+    use_cache: bool,
+) -> AsyncIterator[tuple[Path, str | None]]:
+    cache = DOWNLOAD_CACHE
+    if not (use_cache and cache and path_or_url.startswith("http")):
+        with STAGE_SECONDS.time(stage="download"):
+            downloaded = await run_stage(
+                DOWNLOAD_EXECUTOR,
+                progress,
+                lambda: pipeline.download(path_or_url, downloads, DOWNLOADER),
+            )
+        observe_download_size(downloaded[0])
+        yield downloaded
+        return
+    with STAGE_SECONDS.time(stage="download"):
+        cached = await run_stage(
+            DOWNLOAD_EXECUTOR, progress, lambda: cache.fetch(path_or_url)
+        )
+    observe_download_size(cached.path)
+    try:
+        yield cached.path, cached.sha256
+    finally:
+        await asyncio.to_thread(cache.release, cached.sha256)
+
+
+def observe_download_size(archive: Path) -> None:
+    try:
+        if archive.is_file():
+            DOWNLOAD_BYTES.observe(archive.stat().st_size)
+    except OSError:
+        pass
+
+
+# Hands the archive's digest (hashing it if needed) to `on_download`, which may
+# raise (e.g. singleflight.FlightRedirect) to stop the job before extraction.
+# Local directories aren't hashed.
+async def report_download(
+    archive: Path,
+    digest: str | None,
+    on_download: Callable[[str], None] | None,
+) -> None:
+    if on_download is None or not archive.is_file():
+        return
+    if digest is None:
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(
+            DOWNLOAD_EXECUTOR, pipeline.sha256sum, archive
+        )
+    on_download(digest)
+
+
+# Runs `func` in `executor`, reporting its stderr progress to `progress`
+# Executor threads can't be interrupted, so when the calling task is cancelled
+# a cancellable stage is stopped at its next progress write (see
+# progress.StageCancelled) and waited for, keeping temporary directories and
+# locks intact until it has let go of them. Other stages (installs, which
+# would leave a half-written pack behind) are seen through, and the
+# cancellation is dropped.
+async def run_stage(
+    executor: ThreadPoolExecutor,
+    progress: ProgressTarget,
+    func: Callable[[], T],
+    cancellable: bool = True,
+) -> T:
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    future = loop.run_in_executor(
+        executor, run_with_progress(progress, loop, func, cancelled)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if cancellable:
+            cancelled.set()
+            await asyncio.wait([future])
+            raise
+        asyncio.current_task().uncancel()
+        return await future
+
+
+# Runs `func(*args, **kwargs)`, a function from pipeline.py, in WORKER_POOL,
+# or like run_stage in `executor` (a plain thread if None, which isn't waited
+# for when cancelled) without one. With `overwrite`, `func` also gets an
+# `overwrite` argument: a blocking pipeline.OverwritePrompt whose questions
+# `overwrite` answers on the event loop.
+async def run_isolated_stage(
+    executor: ThreadPoolExecutor | None,
+    progress: ProgressTarget,
+    func: Callable[..., T],
+    *args,
+    overwrite: OverwriteHandler | None = None,
+    cancellable: bool = True,
+    **kwargs,
+) -> T:
+    loop = asyncio.get_running_loop()
+    pool = WORKER_POOL
+    if pool is None:
+        if overwrite is not None:
+            kwargs["overwrite"] = lambda question: (
+                asyncio.run_coroutine_threadsafe(
+                    overwrite(question), loop
+                ).result()
+            )
+        if executor is None:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        return await run_stage(
+            executor, progress, lambda: func(*args, **kwargs), cancellable
+        )
+    call = pool.submit(
+        func,
+        args,
+        kwargs,
+        progress if callable(progress) else progress_updater(progress, loop),
+        overwrite
+        and (
+            lambda question: asyncio.run_coroutine_threadsafe(
+                overwrite(question), loop
+            )
+        ),
+    )
+    future = asyncio.wrap_future(call.future)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if cancellable or executor is None:
+            call.cancel()
+            await asyncio.wait([future])
+            # Usually StageCancelled, which nobody is waiting for anymore
+            future.exception()
+            raise
+        asyncio.current_task().uncancel()
+        return await future
+
+
+# Download and extract stages of add_song_async
+# Yields the extracted simfile directory, which is deleted on exit
+@asynccontextmanager
+async def prepare_song(
     path_or_url: str,
+    progress: ProgressTarget,
+    downloads: Path | None = None,
+    on_download: Callable[[str], None] | None = None,
+    staging: Path | None = None,
+) -> AsyncIterator[Path]:
+    async with (
+        temporary_directory(staging) as temp,
+        download_stage(
+            path_or_url, downloads or temp, progress, downloads is None
+        ) as (archive, digest),
+    ):
+        await report_download(archive, digest, on_download)
+        with STAGE_SECONDS.time(stage="extract"):
+            simfile_root = await run_isolated_stage(
+                EXTRACT_EXECUTOR,
+                progress,
+                pipeline.extract_song,
+                archive,
+                temp,
+            )
+        yield simfile_root
+
+
+# Install stage of add_song_async
+# Returns the installed song directory
+async def install_song_async(
+    simfile_root: Path,
     singles: Path,
-    bot_response: discord.Message | discord.Interaction,
+    progress: ProgressTarget,
     cache: Path | None = None,
-    downloads: Path | None = None,
-    overwrite=lambda _new, _old: False,
+    overwrite: OverwriteHandler = keep_existing,
     delete_macos_files_flag: bool = False,
-) -> tuple[Simfile, str]:
-    loop = asyncio.get_running_loop()
-    with edit_response_with_stderr(bot_response, loop):
-        return await loop.run_in_executor(
-            ADD_SONG_EXECUTOR,
-            lambda: itg_cli.add_song(
-                path_or_url,
+) -> Path:
+    dest = singles.joinpath(simfile_root.name)
+    # Ask before taking the lock and an install thread, so a pending prompt
+    # holds up neither. If dest shows up in the meantime, install_song asks.
+    confirmed = await run_isolated_stage(
+        None,
+        progress,
+        pipeline.confirm_song_overwrite,
+        simfile_root,
+        dest,
+        overwrite=overwrite,
+        delete_macos_files_flag=delete_macos_files_flag,
+    )
+    async with destination_lock(dest):
+        with STAGE_SECONDS.time(stage="install"):
+            song_dir = await run_isolated_stage(
+                INSTALL_EXECUTOR,
+                progress,
+                pipeline.install_song,
+                simfile_root,
                 singles,
-                cache,
-                downloads=downloads,
                 overwrite=overwrite,
                 delete_macos_files_flag=delete_macos_files_flag,
-            ),
+                confirmed=confirmed,
+                cancellable=False,
+            )
+    # The game re-parses the song on its next boot instead of showing a
+    # cached older version (see song_cache.py)
+    if cache is not None:
+        song_cache.invalidate_later(cache, [song_dir])
+    return song_dir
+
+
+# Async replacement for itg_cli.add_song, run as a pipeline of stages
+# Takes an additional argument, bot_response, for posting progress updates, an
+# optional on_download callback receiving the archive's SHA-256, and an
+# optional on_extracted callback receiving the extracted song directory, which
+# may raise to stop the job before anything is installed
+# Returns the installed song directory
+async def add_song_async(
+    path_or_url: str,
+    singles: Path,
+    bot_response: discord.Message | discord.Interaction,
+    cache: Path | None = None,
+    downloads: Path | None = None,
+    overwrite: OverwriteHandler = keep_existing,
+    delete_macos_files_flag: bool = False,
+    on_download: Callable[[str], None] | None = None,
+    on_extracted: Callable[[Path], Awaitable[None]] | None = None,
+) -> Path:
+    async with prepare_song(
+        path_or_url,
+        bot_response,
+        downloads,
+        on_download,
+        pipeline.staging_dir(singles.parent),
+    ) as simfile_root:
+        if on_extracted is not None:
+            await on_extracted(simfile_root)
+        return await install_song_async(
+            simfile_root,
+            singles,
+            bot_response,
+            cache,
+            overwrite,
+            delete_macos_files_flag,
         )
 
 
-# Async wrapper around itg_cli.add_pack
-# Takes an additional argument, bot_response, for posting updates from stderr
-async def add_pack_async(
+# Download and extract stages of add_pack_async
+# Yields the extracted pack directory and the working directory it was found
+# in (which may also hold courses); both are deleted on exit
+@asynccontextmanager
+async def prepare_pack(
     path_or_url: str,
+    progress: ProgressTarget,
+    downloads: Path | None = None,
+    on_download: Callable[[str], None] | None = None,
+    staging: Path | None = None,
+) -> AsyncIterator[tuple[Path, Path]]:
+    async with (
+        temporary_directory(staging) as temp,
+        download_stage(
+            path_or_url, downloads or temp, progress, downloads is None
+        ) as (archive, digest),
+    ):
+        await report_download(archive, digest, on_download)
+        with STAGE_SECONDS.time(stage="extract"):
+            working_dir = await run_isolated_stage(
+                EXTRACT_EXECUTOR, progress, pipeline.extract, archive, temp
+            )
+            pack_path = await run_isolated_stage(
+                EXTRACT_EXECUTOR, progress, pipeline.find_pack, working_dir
+            )
+        yield pack_path, working_dir
+
+
+# Install stage of add_pack_async
+# Returns the installed pack directory and the number of courses added
+async def install_pack_async(
+    pack_path: Path,
+    working_dir: Path,
     packs: Path,
     courses: Path,
-    bot_response: discord.Message | discord.Interaction,
-    downloads: Path | None = None,
-    overwrite=lambda _new, _old: False,
+    progress: ProgressTarget,
+    overwrite: OverwriteHandler = keep_existing,
     delete_macos_files_flag: bool = False,
-):
-    loop = asyncio.get_running_loop()
-    with edit_response_with_stderr(bot_response, loop):
-        return await loop.run_in_executor(
-            ADD_PACK_EXECUTOR,
-            lambda: itg_cli.add_pack(
-                path_or_url,
+    cache: Path | None = None,
+) -> tuple[Path, int]:
+    dest = packs.joinpath(pack_path.name)
+    # See install_song_async
+    confirmed = await run_isolated_stage(
+        None,
+        progress,
+        pipeline.confirm_pack_overwrite,
+        pack_path,
+        dest,
+        overwrite=overwrite,
+        delete_macos_files_flag=delete_macos_files_flag,
+    )
+    async with destination_lock(dest):
+        with STAGE_SECONDS.time(stage="install"):
+            pack_dir, num_courses = await run_isolated_stage(
+                INSTALL_EXECUTOR,
+                progress,
+                pipeline.install_pack,
+                pack_path,
+                working_dir,
                 packs,
                 courses,
-                downloads=downloads,
                 overwrite=overwrite,
                 delete_macos_files_flag=delete_macos_files_flag,
-            ),
-        )
+                confirmed=confirmed,
+                cancellable=False,
+            )
+    # See install_song_async
+    if cache is not None:
+        song_cache.invalidate_later(cache, pack_dir=pack_dir)
+    return pack_dir, num_courses
 
 
-# Stderr redirection stuff
-# Progress bars in itg_cli are written to stderr, so we can instead pipe stderr
-# updates to a custom handler that regularly updates our bot's responses with
-# the current progress.
-class ItgCliStdOutHandler(TextIOBase):
-    inter_or_msg: discord.Message | discord.Interaction
-    last_updated: float
-    buffer: str
-    loop: asyncio.AbstractEventLoop
-
-    def __init__(
-        self,
-        inter_or_msg: discord.Message | discord.Interaction,
-        loop: asyncio.AbstractEventLoop,
-    ):
-        super().__init__()
-        self.inter_or_msg = inter_or_msg
-        self.loop = loop
-        self.buffer = ""
-        self.last_updated = 0
-
-    @property
-    def encoding(self):
-        return sys.stdout.encoding
-
-    @override
-    def write(self, text: str):
-        self.buffer += text
-        return len(text)
-
-    @override
-    def flush(self):
-        now = time.time()
-        # Post an update only if
-        #   It's been at least 1 second since our last update
-        #   Our buffer contains a percent (1-3 digits followed by %)
-        if 1 + self.last_updated < now and re.search(
-            r"[0-9]{1,3}%", self.buffer
-        ):
-            self.last_updated = now
-            asyncio.run_coroutine_threadsafe(
-                edit_response(
-                    self.inter_or_msg, embed=progress_embed(self.buffer)
-                ),
-                self.loop,
-            )
-        self.buffer = ""
+# Async replacement for itg_cli.add_pack, run as a pipeline of stages
+# Takes the same additional arguments as add_song_async (on_extracted receives
+# the extracted pack directory)
+# Returns the installed pack directory and the number of courses added
+async def add_pack_async(
+    path_or_url: str,
+    packs: Path,
+    courses: Path,
+    bot_response: discord.Message | discord.Interaction,
+    downloads: Path | None = None,
+    overwrite: OverwriteHandler = keep_existing,
+    delete_macos_files_flag: bool = False,
+    on_download: Callable[[str], None] | None = None,
+    on_extracted: Callable[[Path], Awaitable[None]] | None = None,
+    cache: Path | None = None,
+) -> tuple[Path, int]:
+    async with prepare_pack(
+        path_or_url,
+        bot_response,
+        downloads,
+        on_download,
+        pipeline.staging_dir(packs),
+    ) as (pack_path, working_dir):
+        if on_extracted is not None:
+            await on_extracted(pack_path)
+        return await install_pack_async(
+            pack_path,
+            working_dir,
+            packs,
+            courses,
+            bot_response,
+            overwrite,
+            delete_macos_files_flag,
+            cache,
+        )
 
 
-@contextmanager
-def edit_response_with_stderr(
+# Progress reporting
+# Progress bars in itg_cli are written to stderr. Each job captures the stderr
+# of its own executor thread (see progress.capture_progress) and submits the
+# parsed progress to the shared EDIT_SCHEDULER, which coalesces and throttles
+# the resulting edits to the job's bot response.
+def progress_updater(
     inter_or_msg: discord.Message | discord.Interaction,
     loop: asyncio.AbstractEventLoop,
-):
-    original_stderr = sys.stderr
-    custom_stderr = ItgCliStdOutHandler(inter_or_msg, loop)
-    sys.stderr = custom_stderr
-    try:
-        yield
-    finally:
-        sys.stderr = original_stderr
+) -> Callable[[ProgressEvent], None]:
+    def on_event(event: ProgressEvent) -> None:
+        EDIT_SCHEDULER.submit_threadsafe(
+            loop, inter_or_msg, embed=progress_embed(event)
+        )
+
+    return on_event
+
+
+def run_with_progress(
+    progress: ProgressTarget,
+    loop: asyncio.AbstractEventLoop,
+    func: Callable[[], T],
+    cancelled: threading.Event | None = None,
+) -> Callable[[], T]:
+    """
+    Wraps `func` to report its stderr progress to `progress`, raising
+    StageCancelled into it once `cancelled` is set.
+    """
+    if callable(progress):
+        on_event = progress
+    else:
+        on_event = progress_updater(progress, loop)
+
+    def wrapped() -> T:
+        with capture_progress(on_event, cancelled):
+            return func()
+
+    return wrapped
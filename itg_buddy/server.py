@@ -1,18 +1,47 @@
+import asyncio
+import importlib
 import os
+import time
+from typing import Optional
 from dotenv import load_dotenv
 import logging
 import discord
 from itg_buddy.extensions.example import ExampleCog
-from itg_buddy.extensions.itg_cli import ItgCliCog, ItgCliCogConfigError
+from itg_buddy.watchdog import LoopWatchdog
+from discord import app_commands
 from discord.ext import commands
 
+# Seconds from startup to answering commands; slower startups are logged as
+# warnings
+READY_TARGET = 10.0
+
+
+class ItgBuddyTree(app_commands.CommandTree):
+    async def interaction_check(
+        self, interaction: discord.Interaction
+    ) -> bool:
+        # Commands of cogs still loading in the background aren't in the tree
+        # yet (see ItgBuddy.setup_hook)
+        await self.client.cogs_loaded.wait()
+        return True
+
 
 class ItgBuddy(commands.Bot):
     logger: logging.Logger
+    # Logs event loop stalls, if enabled with LOOP_STALL_THRESHOLD_MS
+    watchdog: Optional[LoopWatchdog]
+    # Set once every cog has been loaded (or failed to)
+    cogs_loaded: asyncio.Event
+    # time.monotonic() at startup, and seconds from then until the bot first
+    # answered commands
+    started: float
+    ready_in: Optional[float]
 
     def __init__(
         self,
         *args,
+        stall_threshold: Optional[float] = None,
+        started: Optional[float] = None,
         **kwargs,
     ):
         intents = discord.Intents.default()
@@ -23,28 +52,71 @@ class ItgBuddy(commands.Bot):
             **kwargs,
             intents=intents,
             command_prefix=commands.when_mentioned,
+            tree_cls=ItgBuddyTree,
         )
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.watchdog = None
+        if stall_threshold is not None:
+            self.watchdog = LoopWatchdog(stall_threshold)
+        self.cogs_loaded = asyncio.Event()
+        self.started = time.monotonic() if started is None else started
+        self.ready_in = None
 
     async def setup_hook(self):
+        if self.watchdog is not None:
+            self.watchdog.start()
+
         # Load ExampleCog
         await self.add_cog(ExampleCog(self))
         self.logger.info("Loaded ExampleCog")
 
-        # Load ItgCliCog
+        # ItgCliCog imports itg_cli, simfile and the rest of its pipeline,
+        # which takes a while, so it loads while the bot logs in
+        self._itg_cli_load = asyncio.create_task(self._load_itg_cli())
+
+    async def _load_itg_cli(self) -> None:
         try:
-            await self.add_cog(ItgCliCog(self))
-            self.logger.info("Loaded ItgCliCog")
-        except ItgCliCogConfigError:
-            self.logger.error(
-                "Aboarted load: missing or invalid ItgCliCog environment variables."
+            module = await asyncio.to_thread(
+                importlib.import_module, "itg_buddy.extensions.itg_cli"
+            )
+            try:
+                cog = await asyncio.to_thread(module.ItgCliCog, self)
+            except module.ItgCliCogConfigError:
+                self.logger.error(
+                    "Aboarted load: missing or invalid ItgCliCog environment variables."
+                )
+                return
+            await self.add_cog(cog)
+            self.logger.info(
+                f"Loaded ItgCliCog "
+                f"({time.monotonic() - self.started:.2f} s after startup)"
             )
+        except Exception:
+            self.logger.exception("Could not load ItgCliCog")
+        finally:
+            self.cogs_loaded.set()
 
     async def on_ready(self) -> None:
         self.logger.info(f"Logged in as {self.user} ({self.user.id})")
+        if self.ready_in is not None:
+            # Reconnected
+            return
+        await self.cogs_loaded.wait()
+        self.ready_in = time.monotonic() - self.started
+        message = f"Answering commands {self.ready_in:.2f} s after startup"
+        if self.ready_in > READY_TARGET:
+            self.logger.warning(f"{message} (target {READY_TARGET:.0f} s)")
+        else:
+            self.logger.info(message)
+
+    async def close(self) -> None:
+        await super().close()
+        if self.watchdog is not None:
+            await self.watchdog.stop()
 
 
 def main():
+    started = time.monotonic()
     # Load API Key from environment variables in .env
     load_dotenv()
     discord_key = os.getenv("DISCORD_API_KEY")
@@ -53,7 +125,13 @@ def main():
         print("Please set DISCORD_API_KEY or include it in a .env file")
         exit(1)
 
-    bot = ItgBuddy()
+    stall_threshold_ms = os.getenv("LOOP_STALL_THRESHOLD_MS")
+    bot = ItgBuddy(
+        stall_threshold=(
+            int(stall_threshold_ms) / 1000 if stall_threshold_ms else None
+        ),
+        started=started,
+    )
     bot.run(discord_key, root_logger=True)
 
 
@@ -0,0 +1,140 @@
+# Event loop watchdog.
+# Anything that blocks the event loop (a synchronous call in a command, a
+# future waited on with .result()) holds up every other command, progress
+# edit and gateway heartbeat, which users only see as the bot being randomly
+# slow. The watchdog measures how late a heartbeat task wakes up, and a thread
+# alongside it captures the loop thread's stack while a heartbeat is overdue,
+# so a stall is logged with the code that caused it.
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from types import FrameType
+from typing import Optional
+
+# Most seconds between heartbeats; shorter for low thresholds
+MAX_INTERVAL = 0.25
+# Innermost stack frames kept for a stall
+STACK_LIMIT = 30
+
+
+@dataclass
+class StallStats:
+    # Times a heartbeat was at least the threshold late
+    stalls: int = 0
+    # Total time the loop spent blocked in those stalls, in seconds
+    blocked: float = 0.0
+    longest: float = 0.0
+    # Lateness of the last heartbeat, in seconds
+    lag: float = 0.0
+    # Where the loop was stuck during the last stall, if it was caught
+    last_stack: Optional[str] = None
+
+    def __str__(self) -> str:
+        return (
+            f"{self.stalls} stalls, {self.blocked:.2f} s blocked in total, "
+            f"longest {self.longest:.2f} s (lag now {self.lag * 1000:.0f} ms)"
+        )
+
+
+def format_loop_stack(frame: FrameType) -> str:
+    """
+    The stack of the loop thread at `frame`, starting from the callback the
+    loop is running (usually a task's coroutine) rather than the loop itself.
+    """
+    stack = traceback.extract_stack(frame, limit=STACK_LIMIT)
+    start = 0
+    for i, entry in enumerate(stack):
+        if entry.filename == asyncio.events.__file__ and entry.name == "_run":
+            start = i + 1
+    return "".join(traceback.format_list(stack[start:]))
+
+
+class LoopWatchdog:
+    """
+    Logs the event loop being blocked for `threshold` seconds or more, with
+    the stack of whatever blocked it, and counts such stalls in `stats`.
+    Call `start` on the loop to watch and `stop` when done.
+    """
+
+    logger: logging.Logger
+    threshold: float
+    interval: float
+    stats: StallStats
+
+    def __init__(self, threshold: float):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.threshold = threshold
+        self.interval = min(threshold / 2, MAX_INTERVAL)
+        self.stats = StallStats()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._loop_thread_id: Optional[int] = None
+        # When the next heartbeat is due, and the stack captured while it's
+        # overdue
+        self._due = 0.0
+        self._stack: Optional[str] = None
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._due = time.monotonic() + self.interval
+        self._heartbeat_task = asyncio.get_running_loop().create_task(
+            self._heartbeat()
+        )
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+        self.logger.info(
+            f"Watching for event loop stalls over {self.threshold:.2f} s"
+        )
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            with self._lock:
+                lag = max(now - self._due, 0.0)
+                stack, self._stack = self._stack, None
+                self._due = now + self.interval
+            self.stats.lag = lag
+            if lag >= self.threshold:
+                self._record(lag, stack)
+
+    def _record(self, lag: float, stack: Optional[str]) -> None:
+        self.stats.stalls += 1
+        self.stats.blocked += lag
+        self.stats.longest = max(self.stats.longest, lag)
+        if stack is None:
+            # Over before the watchdog thread looked
+            self.logger.warning(f"Event loop was blocked for {lag:.2f} s")
+            return
+        self.stats.last_stack = stack
+        self.logger.warning(
+            f"Event loop was blocked for {lag:.2f} s, here:\n{stack}"
+        )
+
+    def _watch(self) -> None:
+        """Captures the loop thread's stack while a heartbeat is overdue."""
+        while not self._stopped.wait(self.interval / 2):
+            with self._lock:
+                overdue = time.monotonic() - self._due
+                if overdue < self.threshold / 2 or self._stack is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                self._stack = format_loop_stack(frame)
+                del frame
@@ -0,0 +1,59 @@
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+import discord
+import pytest
+from discord.ext import commands
+
+CHANNEL_ID = 42
+
+
+@pytest.fixture
+def machine(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A library, song cache and data directory under `tmp_path`."""
+    root = tmp_path.joinpath("machine")
+    for name in ("Songs/Singles", "Courses", "Cache", "data"):
+        root.joinpath(name).mkdir(parents=True)
+    for key, value in {
+        "PACKS_PATH": root.joinpath("Songs"),
+        "COURSES_PATH": root.joinpath("Courses"),
+        "SINGLES_FOLDER_NAME": "Singles",
+        "ITGMANIA_CACHE_PATH": root.joinpath("Cache"),
+        "ADD_SONG_CHANNEL_ID": CHANNEL_ID,
+        "DATA_PATH": root.joinpath("data"),
+        "INSTALL_WORKERS": 0,
+    }.items():
+        monkeypatch.setenv(key, str(value))
+    monkeypatch.delenv("METRICS_PORT", raising=False)
+    return root
+
+
+@pytest.fixture
+def cog(machine: Path):
+    """An ItgCliCog on `machine`, not attached to a logged-in bot."""
+    from itg_buddy.extensions.itg_cli import ItgCliCog
+
+    bot = commands.Bot(
+        command_prefix="!", intents=discord.Intents.none(), help_command=None
+    )
+    cog = ItgCliCog(bot)
+    yield cog
+    asyncio.run(cog.cog_unload())
+
+
+@pytest.fixture
+def user() -> SimpleNamespace:
+    return SimpleNamespace(id=7, name="tester", mention="<@7>")
+
+
+@pytest.fixture
+def file_server(tmp_path: Path):
+    """Serves `tmp_path`/served over HTTP, with range requests."""
+    from benchmarks.file_server import FileServer
+
+    root = tmp_path.joinpath("served")
+    root.mkdir()
+    with FileServer(str(root)) as server:
+        server.root = root
+        yield server
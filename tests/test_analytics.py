@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from benchmarks.synthetic import simfile
+from itg_buddy.extensions.itg_cli import analytics
+from itg_buddy.extensions.itg_cli.analytics import ChartAnalytics
+from itg_buddy.extensions.itg_cli.embeds import format_chart_stats
+from itg_buddy.extensions.itg_cli.headers import read_headers
+
+pytest.importorskip("numpy")
+
+
+def write_simfile(song_dir, text: str):
+    song_dir.mkdir(parents=True)
+    path = song_dir.joinpath("song.sm")
+    path.write_text(text)
+    return read_headers(path, fingerprints=True)
+
+
+@pytest.fixture
+def reads(monkeypatch) -> list:
+    """Simfiles whose note data `stats` reads."""
+    paths = []
+    read_chart_data = analytics.read_chart_data
+
+    def recording(path):
+        paths.append(path)
+        return read_chart_data(path)
+
+    monkeypatch.setattr(analytics, "read_chart_data", recording)
+    return paths
+
+
+def test_cached_stats_need_no_simfile_reads(tmp_path, reads):
+    sf = write_simfile(
+        tmp_path.joinpath("Song"), simfile(random.Random(0), "Song", 16)
+    )
+    stats = ChartAnalytics(tmp_path.joinpath("analytics.db"))
+
+    first = stats.stats([sf])
+    assert reads == [sf.path]
+    assert len(first[sf.dir]) == len(sf.charts)
+    assert all(s is not None and s.steps > 0 for s in first[sf.dir])
+
+    assert stats.stats([sf]) == first
+    assert reads == [sf.path]
+
+
+def test_headers_without_fingerprints_are_read(tmp_path, reads):
+    sf = write_simfile(
+        tmp_path.joinpath("Song"), simfile(random.Random(0), "Song", 16)
+    )
+    stats = ChartAnalytics(tmp_path.joinpath("analytics.db"))
+    first = stats.stats([sf])
+    # e.g. a header parsed just for a listing
+    plain = read_headers(sf.path)
+    assert stats.stats([plain]) == first
+    assert reads == [sf.path, sf.path]
+
+
+def test_rate_mods_get_their_own_stats(tmp_path, reads):
+    text = simfile(random.Random(0), "Song", 16)
+    bpms = text.split("#BPMS:")[1].split(";")[0]
+    faster = ",".join(
+        f"{beat}={float(bpm) * 1.5:g}"
+        for beat, bpm in (item.split("=") for item in bpms.split(","))
+    )
+    normal = write_simfile(tmp_path.joinpath("Normal"), text)
+    rate = write_simfile(tmp_path.joinpath("Rate"), text.replace(bpms, faster))
+    # Same notes, so they're the same charts as far as duplicates go
+    assert normal.fingerprint == rate.fingerprint
+    stats = ChartAnalytics(tmp_path.joinpath("analytics.db")).stats(
+        [normal, rate]
+    )
+    assert reads == [normal.path, rate.path]
+    for a, b in zip(stats[normal.dir], stats[rate.dir]):
+        assert a.steps == b.steps
+        assert b.peak_nps == pytest.approx(a.peak_nps * 1.5, rel=0.01)
+
+
+def test_chart_stats_line():
+    stats = analytics.ChartStats(
+        steps=400,
+        jumps=12,
+        holds=5,
+        rolls=0,
+        mines=3,
+        peak_nps=8.5,
+        average_nps=6.25,
+        stream_measures=20,
+        measures=40,
+        breakdown="16 (4) 4",
+    )
+    assert format_chart_stats(stats) == (
+        "400 steps (12 jumps, 5 holds), 6.25 average / 8.5 peak NPS, "
+        "20 measures of stream (16 (4) 4)"
+    )
@@ -0,0 +1,122 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fake_discord import DiscordLog, FakeChannel, FakeInteraction
+from benchmarks.synthetic import write_pack, write_zip
+from itg_buddy.extensions.itg_cli import batch as batch_module
+from itg_buddy.extensions.itg_cli.batch import Batch, BatchItem, parse_links
+from itg_buddy.extensions.itg_cli.progress import ProgressEvent
+
+CHANNEL_ID = 42
+TIMEOUT = 30
+
+
+def test_parse_links_skips_duplicates_and_junk():
+    assert parse_links(
+        "https://a.com/1.zip, see also https://a.com/2.zip,,"
+        + " http://A.com/1.zip#again ftp://a.com/3.zip"
+        + " https://cdn.discordapp.com/x/4.zip?ex=1"
+        + " https://cdn.discordapp.com/x/4.zip?ex=2"
+    ) == [
+        "https://a.com/1.zip",
+        "https://a.com/2.zip",
+        "https://cdn.discordapp.com/x/4.zip?ex=1",
+    ]
+
+
+def test_parse_links_reads_text_files():
+    text = (
+        "# Packs for the tournament\r\n"
+        "https://a.com/1.zip\r\n"
+        "\r\n"
+        "  https://a.com/2.zip  \r\n"
+        "https://a.com/1.zip\r\n"
+        "not a link\r\n"
+    )
+    assert parse_links(text) == ["https://a.com/1.zip", "https://a.com/2.zip"]
+    assert parse_links("") == []
+
+
+@pytest.fixture
+def tables(monkeypatch) -> list[list[str]]:
+    """Rows of each progress table a Batch submits, as text lines."""
+    tables = []
+
+    def submit(target, embed, **kwargs):
+        tables.append(embed.description.strip("`").split("\n"))
+
+    monkeypatch.setattr(
+        batch_module, "EDIT_SCHEDULER", SimpleNamespace(submit=submit)
+    )
+    return tables
+
+
+def test_batch_table_follows_its_items(tables):
+    items = [BatchItem("a.zip"), BatchItem("b.zip")]
+    batch = Batch("Adding 2 packs...", items, None)
+    batch.update()
+    assert tables[-1] == ["a.zip: Queued", "b.zip: Queued"]
+
+    batch.queue_reporter(items[1])(2, 95)
+    assert tables[-1][1] == "b.zip: Queued: #2, ~0:01:35"
+
+    async def report():
+        on_event = batch.reporter(items[0])
+        await asyncio.to_thread(
+            on_event, ProgressEvent(text="", percent=40, done=4, total=10)
+        )
+        await asyncio.sleep(0)
+
+    asyncio.run(report())
+    assert tables[-1][0] == "a.zip: Downloading... 40%"
+
+    items[0].name = "Pack A"
+    batch.finish(items[0], "Installed")
+    batch.finish(items[1], "Failed", "404 Not Found")
+    assert tables[-1] == ["Pack A: Installed", "b.zip: Failed"]
+    assert [(item.done, item.error) for item in items] == [
+        (True, None),
+        (True, "404 Not Found"),
+    ]
+
+
+def test_bulk_add_reports_from_the_batch(
+    cog, machine, file_server, user, monkeypatch
+):
+    pack = file_server.root.joinpath("src", "Pack")
+    write_pack(random.Random(0), pack, 2, 8, 1, 0, 0)
+    write_zip(pack, file_server.root.joinpath("Pack.zip"))
+    url = f"{file_server.url}/Pack.zip"
+    missing = f"{file_server.url}/Missing.zip"
+
+    async def read():
+        return f"{url}\n{missing}\n{url}#again\njunk\n".encode()
+
+    reports = []
+    bulk_report = cog._bulk_report
+
+    def recording(pack_dirs, skipped, user):
+        report = bulk_report(pack_dirs, skipped, user)
+        reports.append((pack_dirs, skipped, report))
+        return report
+
+    monkeypatch.setattr(cog, "_bulk_report", recording)
+    channel = FakeChannel(DiscordLog(), CHANNEL_ID)
+    inter = FakeInteraction(channel.log, channel, user)
+    asyncio.run(
+        asyncio.wait_for(
+            cog.bulk_add.callback(
+                cog, inter, links=None, file=SimpleNamespace(read=read)
+            ),
+            TIMEOUT,
+        )
+    )
+
+    [(pack_dirs, skipped, report)] = reports
+    assert pack_dirs == [machine.joinpath("Songs", "Pack")]
+    assert [name for name, _error in skipped] == ["Missing.zip"]
+    assert report.title == "Added 1 of 2 packs"
+    assert report.fields[0].value == "**Pack** (2 songs)"
@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import http.server
+import random
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+import pytest
+import requests
+
+from itg_buddy.extensions.itg_cli import downloader
+from itg_buddy.extensions.itg_cli.downloader import Downloader, split
+
+RANGE = re.compile(r"bytes=(\d+)-(\d+)$")
+
+
+@dataclass
+class Upstream:
+    """What the test server serves at /pack.zip, and what it was asked."""
+
+    data: bytes
+    etag: Optional[str] = '"v1"'
+    digest: Optional[str] = None
+    # Bytes to send of each of the next responses before hanging up, or
+    # None to send all of one
+    cuts: list[Optional[int]] = field(default_factory=list)
+    # Headers of each request received
+    requests: list[dict[str, str]] = field(default_factory=list)
+
+    def replace(self, data: bytes, etag: str) -> None:
+        self.data, self.etag = data, etag
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        upstream: Upstream = self.server.upstream
+        upstream.requests.append(dict(self.headers))
+        data = upstream.data
+        start, end, status = 0, len(data) - 1, 200
+        match = RANGE.match(self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if match and upstream.etag and if_range in (None, upstream.etag):
+            start, end = int(match[1]), min(int(match[2]), len(data) - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start + 1))
+        if upstream.etag:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", upstream.etag)
+        if status == 206:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end}/{len(data)}"
+            )
+        if upstream.digest:
+            self.send_header("Repr-Digest", f"sha-256=:{upstream.digest}:")
+        self.end_headers()
+        body = data[start : end + 1]
+        if upstream.cuts:
+            body = body[: upstream.cuts.pop(0)]
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def upstream():
+    data = random.Random(0).randbytes(1_000_000)
+    upstream = Upstream(data)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.upstream = upstream
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream.url = f"http://127.0.0.1:{server.server_address[1]}/pack.zip"
+    yield upstream
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetch(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "RETRY_DELAY", 0)
+    downloads = tmp_path.joinpath("downloads")
+    downloads.mkdir()
+    loader = Downloader(tmp_path.joinpath("partial"))
+    yield lambda url: loader.download(url, downloads)
+    loader.session.close()
+
+
+def sha256_b64(data: bytes) -> str:
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def kept(cut: int) -> int:
+    # Chunks cut short by the hangup are dropped
+    return cut // downloader.CHUNK_SIZE * downloader.CHUNK_SIZE
+
+
+def ranges(upstream: Upstream) -> list[tuple[str, str]]:
+    return [
+        (r["Range"], r.get("If-Range"))
+        for r in upstream.requests
+        if "Range" in r
+    ]
+
+
+def test_truncated_download_resumes_with_if_range(
+    upstream, fetch, monkeypatch
+):
+    monkeypatch.setattr(downloader, "MAX_ATTEMPTS", 1)
+    upstream.cuts = [300_000]
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        fetch(upstream.url)
+
+    # A later job for the same link picks up where this one stopped
+    result = fetch(upstream.url)
+    assert result.path.read_bytes() == upstream.data
+    assert result.sha256 == hashlib.sha256(upstream.data).hexdigest()
+    assert ranges(upstream) == [(f"bytes={kept(300_000)}-999999", '"v1"')]
+
+
+def test_truncated_download_is_retried_within_a_job(upstream, fetch):
+    # Each retry starts with a plain request (closed unread) before the
+    # range request that resumes
+    upstream.cuts = [100_000, None, 250_000]
+    result = fetch(upstream.url)
+    assert result.path.read_bytes() == upstream.data
+    first = kept(100_000)
+    assert ranges(upstream) == [
+        (f"bytes={first}-999999", '"v1"'),
+        (f"bytes={first + kept(250_000)}-999999", '"v1"'),
+    ]
+
+
+def test_changed_validator_restarts_the_download(upstream, fetch, monkeypatch):
+    monkeypatch.setattr(downloader, "MAX_ATTEMPTS", 1)
+    upstream.cuts = [300_000]
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        fetch(upstream.url)
+
+    upstream.replace(random.Random(1).randbytes(1_000_000), '"v2"')
+    result = fetch(upstream.url)
+    assert result.path.read_bytes() == upstream.data
+    # Nothing of the old file was kept
+    assert ranges(upstream) == []
+
+
+def test_short_response_is_rejected(upstream, fetch):
+    # Without a validator there's nothing to resume, so every attempt is a
+    # fresh download; each one hangs up early
+    upstream.etag = None
+    upstream.cuts = [500_000] * downloader.MAX_ATTEMPTS
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        fetch(upstream.url)
+    assert len(upstream.requests) == downloader.MAX_ATTEMPTS
+
+
+def test_segmented_download_checks_the_digest(upstream, fetch, monkeypatch):
+    monkeypatch.setattr(downloader, "SEGMENT_THRESHOLD", 0)
+    upstream.digest = sha256_b64(upstream.data)
+    result = fetch(upstream.url)
+    assert result.path.read_bytes() == upstream.data
+    expected = [
+        (f"bytes={start}-{end}", '"v1"')
+        for start, end, _next in split(len(upstream.data), 4)
+    ]
+    assert sorted(ranges(upstream)) == sorted(expected)
+
+
+def test_digest_mismatch_discards_the_download(upstream, fetch, tmp_path):
+    upstream.digest = sha256_b64(b"something else")
+    with pytest.raises(Exception, match="checksum mismatch"):
+        fetch(upstream.url)
+    assert list(tmp_path.joinpath("partial").iterdir()) == []
+    assert list(tmp_path.joinpath("downloads").iterdir()) == []
+
+
+def test_concurrent_state_saves(tmp_path):
+    loader = Downloader(tmp_path)
+    state = downloader.PartialDownload(
+        "http://example.com/pack.zip", '"v1"', 100, "pack.zip", split(100, 4)
+    )
+    state_path = tmp_path.joinpath("state.json")
+    errors = []
+
+    def save():
+        try:
+            for _ in range(200):
+                loader._save_state(state_path, state)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert loader._load_state(state_path) == state
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from itg_buddy.extensions.itg_cli import edits
+from itg_buddy.extensions.itg_cli.edits import EditScheduler
+
+
+class FakeDiscord:
+    """
+    Stands in for Discord's edit endpoint: records each edit made and can
+    be told to answer the next ones with 429s.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        # (message id, content, time sent)
+        self.edits: list[tuple[int, str, float]] = []
+        # Errors to raise instead of editing, in order
+        self.errors: list[Exception] = []
+
+    async def edit_message(self, target, **kwargs) -> None:
+        await asyncio.sleep(self.latency)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append((target.id, kwargs["content"], time.monotonic()))
+
+    def contents(self, message) -> list[str]:
+        return [content for id, content, _ in self.edits if id == message.id]
+
+
+def message(id: int, channel: int) -> SimpleNamespace:
+    return SimpleNamespace(id=id, channel=SimpleNamespace(id=channel))
+
+
+def too_many_requests() -> discord.HTTPException:
+    response = SimpleNamespace(status=429, reason="Too Many Requests")
+    return discord.HTTPException(response, "rate limited")
+
+
+async def drain(scheduler: EditScheduler) -> None:
+    while scheduler._pending or scheduler._in_flight:
+        await asyncio.sleep(0.01)
+
+
+def test_submissions_for_a_message_coalesce():
+    fake = FakeDiscord()
+    scheduler = EditScheduler(fake.edit_message)
+    msg = message(1, 10)
+
+    async def run():
+        for i in range(10):
+            scheduler.submit(msg, content=str(i))
+        await drain(scheduler)
+
+    asyncio.run(run())
+    assert fake.contents(msg) == ["9"]
+    assert scheduler.stats.coalesced == 9
+    assert scheduler.stats.sent == 1
+
+
+def test_channels_are_throttled_separately():
+    fake = FakeDiscord()
+    scheduler = EditScheduler(fake.edit_message, rate=1, per=0.2)
+    first, second = message(1, 10), message(2, 10)
+    other = message(3, 20)
+
+    async def run():
+        start = time.monotonic()
+        for msg in (first, second, other):
+            scheduler.submit(msg, content="progress")
+        await drain(scheduler)
+        return {id: sent - start for id, _, sent in fake.edits}
+
+    sent = asyncio.run(run())
+    assert sent[1] < 0.1
+    assert sent[3] < 0.1
+    # Waits for the channel's one edit per 0.2 s
+    assert sent[2] >= 0.2
+
+
+@pytest.mark.parametrize(
+    "error, wait",
+    [
+        (discord.RateLimited(0.2), 0.2),
+        (too_many_requests(), 0.1),
+    ],
+)
+def test_rate_limited_edits_are_retried_after_backing_off(
+    error, wait, monkeypatch
+):
+    # Used when a 429 doesn't say how long to wait
+    monkeypatch.setattr(edits, "DEFAULT_RETRY_AFTER", 0.1)
+    fake = FakeDiscord()
+    fake.errors.append(error)
+    scheduler = EditScheduler(fake.edit_message)
+    msg = message(1, 10)
+
+    async def run():
+        start = time.monotonic()
+        scheduler.submit(msg, content="progress")
+        await drain(scheduler)
+        return fake.edits[0][2] - start
+
+    sent = asyncio.run(run())
+    assert fake.contents(msg) == ["progress"]
+    assert sent >= wait
+    assert scheduler.stats.rate_limited == 1
+    assert scheduler.stats.failed == 0
+
+
+def test_final_edit_is_not_overwritten_by_progress():
+    fake = FakeDiscord(latency=0.05)
+    # Throttled, so progress can't go out as soon as its message is free
+    scheduler = EditScheduler(fake.edit_message, rate=1, per=0.2)
+    msg = message(1, 10)
+
+    async def run():
+        scheduler.submit(msg, content="progress 1")
+        await asyncio.sleep(0.01)  # now in flight
+        final = asyncio.create_task(scheduler.edit(msg, content="done"))
+        await asyncio.sleep(0.01)
+        # Arrives while the final edit waits for the one in flight
+        scheduler.submit(msg, content="progress 2")
+        await final
+        await drain(scheduler)
+
+    asyncio.run(run())
+    assert fake.contents(msg) == ["progress 1", "done"]
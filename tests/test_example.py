@@ -0,0 +1,77 @@
+import asyncio
+
+import discord
+import pytest
+from discord import app_commands
+from discord.ext import commands
+
+from itg_buddy.extensions.example import ExampleCog, tree_fingerprint
+
+GUILD = discord.Object(id=123)
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch) -> commands.Bot:
+    """A bot with the ping command, recording the scopes it syncs."""
+    monkeypatch.setenv("DATA_PATH", str(tmp_path))
+    bot = commands.Bot(
+        command_prefix="!", intents=discord.Intents.none(), help_command=None
+    )
+    bot._connection.application_id = 1
+    bot.synced = []
+
+    async def sync(guild=None):
+        bot.synced.append(None if guild is None else guild.id)
+        return bot.tree.get_commands(guild=guild)
+
+    monkeypatch.setattr(bot.tree, "sync", sync)
+    asyncio.run(bot.add_cog(ExampleCog(bot)))
+    return bot
+
+
+def sync(bot: commands.Bot, guild=None, force: bool = False):
+    cog = bot.get_cog("ExampleCog")
+    return asyncio.run(cog._sync_tree(guild, force))
+
+
+def test_unchanged_trees_are_not_synced_again(bot):
+    assert [c.name for c in sync(bot)] == ["ping"]
+    assert sync(bot) is None
+    # Each scope is tracked on its own
+    bot.tree.copy_global_to(guild=GUILD)
+    assert [c.name for c in sync(bot, GUILD)] == ["ping"]
+    assert sync(bot, GUILD) is None
+    assert bot.synced == [None, GUILD.id]
+
+
+def test_force_syncs_anyway(bot):
+    sync(bot)
+    assert [c.name for c in sync(bot, force=True)] == ["ping"]
+    assert bot.synced == [None, None]
+
+
+def test_changed_trees_are_synced(bot):
+    sync(bot)
+
+    @app_commands.command(description="Responds with pang.")
+    async def pang(inter: discord.Interaction) -> None:
+        pass
+
+    bot.tree.add_command(pang)
+    assert sorted(c.name for c in sync(bot)) == ["pang", "ping"]
+    assert bot.synced == [None, None]
+
+
+def test_tree_fingerprint_ignores_command_order(bot):
+    fingerprint = tree_fingerprint(bot.tree, None)
+
+    @app_commands.command(description="Responds with pang.")
+    async def pang(inter: discord.Interaction) -> None:
+        pass
+
+    bot.tree.add_command(pang)
+    with_pang = tree_fingerprint(bot.tree, None)
+    assert with_pang != fingerprint
+    ping = bot.tree.remove_command("ping")
+    bot.tree.add_command(ping)
+    assert tree_fingerprint(bot.tree, None) == with_pang
@@ -0,0 +1,133 @@
+from pathlib import Path
+from typing import Optional
+
+import pytest
+import simfile
+
+from itg_buddy.extensions.itg_cli.headers import (
+    chart_fingerprint,
+    read_headers,
+)
+
+NOTES = "1000\n0100\n0010\n0001\n"
+
+
+def sm_chart(fields: str, notes: str = NOTES) -> str:
+    return f"#NOTES:\n{fields}:\n{notes};\n"
+
+
+def strip(value: Optional[str]) -> Optional[str]:
+    """Normalizes a value for comparison: stripped, with empty as None."""
+    return (value or "").strip() or None
+
+
+def chart_fields(chart) -> tuple:
+    return tuple(
+        strip(getattr(chart, name))
+        for name in ("stepstype", "difficulty", "meter", "description")
+    )
+
+
+def assert_matches_simfile(path: Path):
+    """read_headers agrees with simfile.open on everything it reads."""
+    expected = simfile.open(str(path))
+    header = read_headers(path)
+    assert header.title == expected.title.strip()
+    assert header.titletranslit == strip(expected.titletranslit)
+    assert strip(header.artist) == strip(expected.artist)
+    assert header.banner == strip(expected.banner)
+    assert list(map(chart_fields, header.charts)) == list(
+        map(chart_fields, expected.charts)
+    )
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        pytest.param(
+            "#TITLE:Colon\\: Semi\\; Slash\\\\;\n#ARTIST:A\\#1;\n"
+            + sm_chart(" dance-single: De\\:sc: Hard: 10: 0,0,0,0,0"),
+            id="escapes",
+        ),
+        pytest.param(
+            "// leading comment\n#TITLE:Title // trailing comment\n;\n"
+            + "#ARTIST:Artist;// #BANNER:not.png;\n"
+            + sm_chart(
+                " dance-single: // no description\n: Easy: 3: 0,0,0,0,0",
+                "1000 // a comment, with a comma\n0000\n",
+            ),
+            id="comments",
+        ),
+        pytest.param(
+            "#TITLE:Unterminated\n#ARTIST:Artist\n#BANNER:bn.png\n"
+            + sm_chart(" dance-single: : Medium: 7: 0,0,0,0,0"),
+            id="missing-semicolons",
+        ),
+        pytest.param(
+            "#TITLE:First;\n#TITLE:Second;\n#TITLETRANSLIT:Translit;\n"
+            + sm_chart(" dance-single: a: Hard: 9: 0,0,0,0,0")
+            + sm_chart(" dance-double: b: Challenge: 12: 0,0,0,0,0"),
+            id="repeats-and-charts",
+        ),
+    ],
+)
+def test_sm_headers_match_simfile(tmp_path, text):
+    path = tmp_path.joinpath("song.sm")
+    path.write_text(text)
+    assert_matches_simfile(path)
+
+
+def test_ssc_chart_fields_match_simfile(tmp_path):
+    path = tmp_path.joinpath("song.ssc")
+    path.write_text(
+        "#VERSION:0.83;\n#TITLE:SSC Song;\n#ARTIST:Artist;\n#BANNER:bn.png;\n"
+        + "#BPMS:0=120;\n"
+        # Chart properties must not leak into the song's, or between charts
+        + "#NOTEDATA:;\n#STEPSTYPE:dance-single;\n#DESCRIPTION:Desc\\;;\n"
+        + "#DIFFICULTY:Hard;\n#METER:11;\n#BPMS:0=240;\n"
+        + f"#NOTES:\n{NOTES};\n"
+        + "#NOTEDATA:;\n#STEPSTYPE:dance-double;\n#DIFFICULTY:Edit;\n"
+        + "#METER:4 // meter comment\n"
+        + f"#NOTES:\n{NOTES};\n"
+    )
+    assert_matches_simfile(path)
+    header = read_headers(path, fingerprints=True)
+    assert header.title == "SSC Song"
+    assert [c.description for c in header.charts] == ["Desc;", None]
+    # The first chart has its own timing; the second falls back to the song's
+    assert header.charts[0].timing != header.charts[1].timing
+
+
+@pytest.mark.parametrize(
+    "notes",
+    [
+        pytest.param("1000\n0000\n0100\n0000\n,\n0011\n0000\n", id="16ths"),
+        pytest.param(
+            "1000 // step\n0000\n0100\n0000\n,\n// jump\n0011\n0000\n",
+            id="comments",
+        ),
+        pytest.param(
+            "1000\n0100\n,\n0011\n0000\n,\n0000\n0000\n,\n0000\n",
+            id="trailing-blank-measures",
+        ),
+        pytest.param("  1000\n\t0100\n,\n  0011\n0000\n\n", id="whitespace"),
+    ],
+)
+def test_chart_fingerprint_ignores_formatting(notes):
+    expected = chart_fingerprint("dance-single", "1000\n0100\n,\n0011\n")
+    assert chart_fingerprint(" Dance-Single ", notes) == expected
+
+
+def test_chart_fingerprint_tells_charts_apart():
+    notes = "1000\n0100\n,\n0011\n"
+    fingerprint = chart_fingerprint("dance-single", notes)
+    # Steps moved by a 16th, another arrow, another style
+    assert chart_fingerprint(
+        "dance-single", "1000\n0000\n0000\n0100\n,\n0011\n"
+    ) not in (None, fingerprint)
+    assert chart_fingerprint("dance-single", "1000\n0010\n,\n0011\n") not in (
+        None,
+        fingerprint,
+    )
+    assert chart_fingerprint("dance-double", notes) != fingerprint
+    assert chart_fingerprint("dance-single", "0000\n,\n0000\n") is None
@@ -0,0 +1,347 @@
+import asyncio
+import random
+import shutil
+import sqlite3
+
+from benchmarks.fake_discord import (
+    DiscordLog,
+    FakeChannel,
+    FakeInteraction,
+    FakeMessage,
+    FakeUser,
+)
+from benchmarks.synthetic import write_pack, write_song, write_zip
+from itg_buddy.extensions.itg_cli import itg_cli
+from itg_buddy.extensions.itg_cli.jobs import (
+    JOURNAL_EXECUTOR,
+    JobCancelled,
+    JobKind,
+    JobQueue,
+    JobState,
+)
+from itg_buddy.extensions.itg_cli.singleflight import (
+    FlightRedirect,
+    SingleFlight,
+)
+
+CHANNEL_ID = 42
+TIMEOUT = 30
+
+
+async def add_job(queue: JobQueue, link: str):
+    return await queue.create(JobKind.ADD_SONG, link, 1, CHANNEL_ID, 1)
+
+
+def test_released_slot_lets_a_queued_job_start(tmp_path):
+    async def run():
+        queue = JobQueue(tmp_path.joinpath("jobs.db"), concurrency=1)
+        first, second = await add_job(queue, "a"), await add_job(queue, "b")
+        prompt_open, answer = asyncio.Event(), asyncio.Event()
+        order = []
+
+        async def prompting():
+            async with queue.released(first):
+                prompt_open.set()
+                await answer.wait()
+            order.append("first")
+
+        async def quick():
+            order.append("second")
+
+        a = asyncio.create_task(queue.run(first, prompting))
+        await prompt_open.wait()
+        await asyncio.wait_for(queue.run(second, quick), TIMEOUT)
+        # The second job ran while the first one's prompt was still open
+        assert not answer.is_set()
+        assert [job.id for job in queue.running()] == [first.id]
+        answer.set()
+        await asyncio.wait_for(a, TIMEOUT)
+        assert order == ["second", "first"]
+
+    asyncio.run(run())
+
+
+def test_job_waits_for_a_slot_after_its_prompt(tmp_path):
+    async def run():
+        queue = JobQueue(tmp_path.joinpath("jobs.db"), concurrency=1)
+        first, second = await add_job(queue, "a"), await add_job(queue, "b")
+        second_started, second_done = asyncio.Event(), asyncio.Event()
+
+        async def prompting():
+            async with queue.released(first):
+                await second_started.wait()
+            # Only gets its slot back once the second job is done
+            assert second_done.is_set()
+
+        async def slow():
+            second_started.set()
+            await asyncio.sleep(0.1)
+            second_done.set()
+
+        a = asyncio.create_task(queue.run(first, prompting))
+        await asyncio.wait_for(
+            asyncio.gather(a, queue.run(second, slow)), TIMEOUT
+        )
+
+    asyncio.run(run())
+
+
+def test_cancelling_a_job_with_its_slot_released(tmp_path):
+    async def run():
+        queue = JobQueue(tmp_path.joinpath("jobs.db"), concurrency=1)
+        job = await add_job(queue, "a")
+        prompt_open = asyncio.Event()
+
+        async def prompting():
+            async with queue.released(job):
+                prompt_open.set()
+                await asyncio.Event().wait()
+
+        task = asyncio.create_task(queue.run(job, prompting))
+        await prompt_open.wait()
+        assert queue.cancel(job.id) is job
+        try:
+            await asyncio.wait_for(task, TIMEOUT)
+        except JobCancelled:
+            pass
+        else:
+            raise AssertionError("JobCancelled not raised")
+        assert job.state == JobState.CANCELLED
+        assert not queue.running() and not queue.queued()
+
+    asyncio.run(run())
+
+
+def test_overwrite_prompt_does_not_hold_a_queue_slot(
+    cog, machine, file_server, user, monkeypatch
+):
+    rng = random.Random(0)
+    src = file_server.root.joinpath("src")
+    for name in ("Existing Pack", "Other Pack"):
+        write_pack(rng, src.joinpath(name), 2, 16, 2, 0, 0)
+        write_zip(src.joinpath(name), file_server.root.joinpath(f"{name}.zip"))
+    # Already on the machine, so adding it again asks about overwriting
+    write_pack(rng, machine.joinpath("Songs", "Existing Pack"), 2, 16, 2, 0, 0)
+    cog.job_queue.concurrency = 1
+
+    prompt_open, answer = asyncio.Event(), asyncio.Event()
+
+    async def ask_overwrite_pack(*args):
+        prompt_open.set()
+        await answer.wait()
+        return True
+
+    monkeypatch.setattr(itg_cli, "ask_overwrite_pack", ask_overwrite_pack)
+
+    async def add_pack(name: str) -> FakeChannel:
+        channel = FakeChannel(DiscordLog(), CHANNEL_ID)
+        inter = FakeInteraction(channel.log, channel, user)
+        url = f"{file_server.url}/{name.replace(' ', '%20')}.zip"
+        await cog._run_add_pack(inter, user, url)
+        return channel
+
+    async def run():
+        existing = asyncio.create_task(add_pack("Existing Pack"))
+        await asyncio.wait_for(prompt_open.wait(), TIMEOUT)
+        other = await asyncio.wait_for(add_pack("Other Pack"), TIMEOUT)
+        assert other.sent == ["Added Other Pack"]
+        assert not answer.is_set()
+        answer.set()
+        existing = await asyncio.wait_for(existing, TIMEOUT)
+        assert existing.sent == ["Added Existing Pack"]
+
+    asyncio.run(run())
+
+
+def journal(queue: JobQueue) -> list[tuple]:
+    # Journal writes are made in order, on one thread
+    JOURNAL_EXECUTOR.submit(lambda: None).result()
+    with sqlite3.connect(queue.db_path) as db:
+        return db.execute(
+            "SELECT kind, link, state FROM jobs ORDER BY id"
+        ).fetchall()
+
+
+def test_bulk_add_queues_a_job_per_link(
+    cog, machine, file_server, user, monkeypatch
+):
+    rng = random.Random(0)
+    urls = []
+    for i in range(3):
+        pack = file_server.root.joinpath("src", f"Pack {i}")
+        write_pack(rng, pack, 1, 8, 1, 0, 0)
+        write_zip(pack, file_server.root.joinpath(f"Pack{i}.zip"))
+        urls.append(f"{file_server.url}/Pack{i}.zip")
+    cog.job_queue.concurrency = 1
+    installing, most_installing, queued = 0, 0, []
+    install_pack_async = itg_cli.install_pack_async
+
+    async def counting(*args, **kwargs):
+        nonlocal installing, most_installing
+        installing += 1
+        most_installing = max(most_installing, installing)
+        queued.append(len(cog.job_queue.queued()))
+        try:
+            return await install_pack_async(*args, **kwargs)
+        finally:
+            installing -= 1
+
+    monkeypatch.setattr(itg_cli, "install_pack_async", counting)
+    channel = FakeChannel(DiscordLog(), CHANNEL_ID)
+    inter = FakeInteraction(channel.log, channel, user)
+
+    asyncio.run(
+        asyncio.wait_for(
+            cog.bulk_add.callback(cog, inter, links=" ".join(urls)), TIMEOUT
+        )
+    )
+
+    for i in range(3):
+        assert machine.joinpath("Songs", f"Pack {i}").is_dir()
+    # The links waited their turn in the queue like any other job
+    assert most_installing == 1
+    assert queued[0] == 2
+    assert sorted(journal(cog.job_queue)) == [
+        (JobKind.ADD_PACK, url, JobState.DONE) for url in urls
+    ]
+
+
+def test_song_batches_are_one_resumable_job(cog, machine, file_server, user):
+    rng = random.Random(0)
+    urls = []
+    for i in range(2):
+        song = file_server.root.joinpath("src", f"Song {i}")
+        write_song(rng, song, f"Song {i}", 8, 1, 0, 0)
+        write_zip(song, file_server.root.joinpath(f"Song{i}.zip"))
+        urls.append(f"{file_server.url}/Song{i}.zip")
+
+    async def run():
+        # Journaled by a bot that stopped before running it
+        queue = JobQueue(cog.job_queue.db_path, concurrency=1)
+        await queue.create(JobKind.ADD_SONGS, "\n".join(urls), 1, 42, 1)
+        cog.job_queue = JobQueue(cog.job_queue.db_path, concurrency=1)
+        [job] = cog.job_queue.interrupted()
+        assert job.links == urls
+
+        channel = FakeChannel(DiscordLog(), CHANNEL_ID)
+        bot_response = FakeMessage(channel.log, channel, FakeUser(0))
+        await cog._run_add_song_batch(bot_response, user, job.links, job)
+        return channel
+
+    channel = asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert channel.sent == ["Added 2 songs to Singles"]
+    for i in range(2):
+        assert machine.joinpath("Songs", "Singles", f"Song {i}").is_dir()
+    assert journal(cog.job_queue) == [
+        (JobKind.ADD_SONGS, "\n".join(urls), JobState.DONE)
+    ]
+
+
+def test_unloading_cancels_resumed_jobs(cog, user, monkeypatch):
+    started = []
+
+    async def ready():
+        pass
+
+    async def fetch_user(_id):
+        return user
+
+    async def hang(bot_response, user, link, job):
+        started.append(job.link)
+        await asyncio.Event().wait()
+
+    channel = FakeChannel(DiscordLog(), CHANNEL_ID)
+    monkeypatch.setattr(cog.bot, "wait_until_ready", ready)
+    monkeypatch.setattr(cog.bot, "get_channel", lambda _id: channel)
+    monkeypatch.setattr(cog.bot, "fetch_user", fetch_user)
+    monkeypatch.setattr(cog, "_warm_up", ready)
+    monkeypatch.setattr(cog, "_run_add_pack", hang)
+
+    async def run():
+        # Journaled by a bot that stopped before running it
+        await cog.job_queue.create(JobKind.ADD_PACK, "link", 7, 42, 1)
+        cog.job_queue = JobQueue(cog.job_queue.db_path, concurrency=1)
+        await cog.cog_load()
+        while not started:
+            await asyncio.sleep(0.01)
+        [task] = cog._resumed_jobs
+        await cog.cog_unload()
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        assert cog._resume_task.done()
+
+    asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert started == ["link"]
+
+
+def test_redirected_jobs_are_not_failures(tmp_path):
+    async def run():
+        queue = JobQueue(tmp_path.joinpath("jobs.db"), concurrency=1)
+        flights = SingleFlight(60)
+
+        async def first(flight):
+            flight.claim(("sha256", "abc"))
+            return "installed"
+
+        async def second(flight):
+            # Turns out to be the same archive as the first
+            flight.claim(("sha256", "abc"))
+            return "installed twice"
+
+        results = []
+        for link, func in (("a", first), ("b", second)):
+            job = await add_job(queue, link)
+            results.append(
+                await flights.run(
+                    link,
+                    lambda flight: queue.run(job, lambda: func(flight)),
+                )
+            )
+        assert results == ["installed", "installed"]
+        assert [state for _, _, state in journal(queue)] == [
+            JobState.DONE,
+            JobState.DONE,
+        ]
+
+    asyncio.run(run())
+
+
+def test_bulk_add_shares_identical_archives(
+    cog, machine, file_server, user, monkeypatch
+):
+    pack = file_server.root.joinpath("src", "Pack")
+    write_pack(random.Random(0), pack, 1, 8, 1, 0, 0)
+    for name in ("Pack.zip", "Mirror.zip"):
+        write_zip(pack, file_server.root.joinpath(name))
+    urls = [f"{file_server.url}/{name}" for name in ("Pack.zip", "Mirror.zip")]
+    cog.job_queue.concurrency = 1
+    installs = []
+    install_pack_async = itg_cli.install_pack_async
+
+    async def counting(*args, **kwargs):
+        installs.append(args[0].name)
+        return await install_pack_async(*args, **kwargs)
+
+    monkeypatch.setattr(itg_cli, "install_pack_async", counting)
+    channel = FakeChannel(DiscordLog(), CHANNEL_ID)
+
+    def bulk_add():
+        inter = FakeInteraction(channel.log, channel, user)
+        asyncio.run(
+            asyncio.wait_for(
+                cog.bulk_add.callback(cog, inter, links=" ".join(urls)),
+                TIMEOUT,
+            )
+        )
+
+    bulk_add()
+    assert installs == ["Pack"]
+    assert [state for _, _, state in journal(cog.job_queue)] == [
+        JobState.DONE,
+        JobState.DONE,
+    ]
+    # A result is only reused while its pack is still there
+    shutil.rmtree(machine.joinpath("Songs", "Pack"))
+    bulk_add()
+    assert installs == ["Pack", "Pack"]
+    assert machine.joinpath("Songs", "Pack").is_dir()
@@ -0,0 +1,218 @@
+import os
+import random
+from pathlib import Path
+
+import pytest
+
+from benchmarks.synthetic import png, simfile, write_pack
+from itg_buddy.extensions.itg_cli import library
+from itg_buddy.extensions.itg_cli.headers import SimfileHeader, read_headers
+from itg_buddy.extensions.itg_cli.library import LibraryIndex
+
+
+@pytest.fixture
+def packs(tmp_path) -> Path:
+    packs = tmp_path.joinpath("Songs")
+    packs.mkdir()
+    return packs
+
+
+@pytest.fixture
+def index(tmp_path, packs) -> LibraryIndex:
+    return LibraryIndex(tmp_path.joinpath("library.db"), packs)
+
+
+@pytest.fixture
+def parsed(monkeypatch) -> list:
+    """Simfiles the index parses, by file name."""
+    paths = []
+    try_parse_simfile = library.try_parse_simfile
+
+    def recording(path):
+        paths.append(path.parent.name)
+        return try_parse_simfile(path)
+
+    monkeypatch.setattr(library, "try_parse_simfile", recording)
+    return paths
+
+
+def keep_mtime(path: Path):
+    """Restores `path`'s mtime later, like an rsync -t or an unzip would."""
+    stat = path.stat()
+    return lambda: os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def test_refresh_only_parses_changes(index, packs, parsed):
+    pack_dir = packs.joinpath("Pack")
+    write_pack(random.Random(0), pack_dir, 3, 4, 1, 0, 0)
+    index.refresh()
+    assert sorted(parsed) == ["Song 000", "Song 001", "Song 002"]
+    assert len(index.simfiles(pack_dir)) == 3
+
+    parsed.clear()
+    index.refresh()
+    assert parsed == []
+
+    pack_dir.joinpath("Song 001", "song.sm").write_text(
+        simfile(random.Random(1), "Edited", 4, 1)
+    )
+    pack_dir.joinpath("Song 002", "song.sm").unlink()
+    index.refresh()
+    assert parsed == ["Song 001"]
+    assert sorted(sf.title for sf in index.simfiles(pack_dir)) == [
+        "Edited",
+        "Pack Song 000",
+    ]
+
+
+def test_refresh_forgets_removed_songs_and_packs(index, packs):
+    write_pack(random.Random(0), packs.joinpath("Pack A"), 2, 4, 1, 0, 0)
+    write_pack(random.Random(1), packs.joinpath("Pack B"), 2, 4, 1, 0, 0)
+    index.refresh()
+    packs.joinpath("Pack A", "Song 000", "song.sm").unlink()
+    packs.joinpath("Pack A", "Song 000").rmdir()
+    for path in sorted(packs.joinpath("Pack B").rglob("*"), reverse=True):
+        path.unlink() if path.is_file() else path.rmdir()
+    packs.joinpath("Pack B").rmdir()
+    index.refresh()
+    assert [p.name for p in index.packs_list()] == ["Pack A"]
+    assert [sf.dir.name for sf in index.simfiles()] == ["Song 001"]
+
+
+def test_refresh_songs_adds_just_those_songs(index, packs, parsed):
+    pack_dir = packs.joinpath("Singles")
+    write_pack(random.Random(0), pack_dir, 3, 4, 1, 0, 0)
+    index.refresh_songs([pack_dir.joinpath("Song 001")])
+    assert parsed == ["Song 001"]
+    assert index.pack(pack_dir).name == "Singles"
+    assert [sf.dir.name for sf in index.simfiles(pack_dir)] == ["Song 001"]
+
+
+def test_unparsable_simfiles_are_not_retried(index, packs, parsed):
+    pack_dir = packs.joinpath("Pack")
+    write_pack(random.Random(0), pack_dir, 2, 4, 1, 0, 0)
+    broken = pack_dir.joinpath("Song 001", "song.sm")
+    broken.write_bytes(b"#TITLE:\x81\xff\x80\xfe;")
+    index.refresh()
+    assert sorted(parsed) == ["Song 000", "Song 001"]
+    assert index.simfile(broken.parent) is None
+
+    parsed.clear()
+    index.refresh()
+    index.refresh_songs([broken.parent])
+    assert parsed == []
+
+    # Until it's fixed
+    broken.write_text(simfile(random.Random(1), "Fixed", 4, 1))
+    index.refresh()
+    assert parsed == ["Song 001"]
+    assert index.simfile(broken.parent).title == "Fixed"
+
+
+def test_unparsable_simfiles_are_forgotten_with_their_song(index, packs):
+    pack_dir = packs.joinpath("Pack")
+    write_pack(random.Random(0), pack_dir, 1, 4, 1, 0, 0)
+    broken = pack_dir.joinpath("Song 000", "song.sm")
+    broken.write_bytes(b"#TITLE:\x81\xff\x80\xfe;")
+    index.refresh()
+    broken.unlink()
+    broken.parent.rmdir()
+    # Same name, new song
+    write_pack(random.Random(1), pack_dir, 1, 4, 1, 0, 0)
+    index.refresh()
+    assert [sf.title for sf in index.simfiles(pack_dir)] == ["Pack Song 000"]
+
+
+def test_banner_changes_are_picked_up(index, packs):
+    pack_dir = packs.joinpath("Pack")
+    write_pack(random.Random(0), pack_dir, 1, 4, 1, 64, 0)
+    index.refresh()
+    assert index.pack(pack_dir).banner == pack_dir.joinpath("banner.png")
+
+    # Swapped for a banner of another type, leaving the pack's mtime alone
+    restore = keep_mtime(pack_dir)
+    pack_dir.joinpath("banner.png").unlink()
+    pack_dir.joinpath("banner.jpg").write_bytes(png(random.Random(1), 64))
+    restore()
+    index.refresh_pack(pack_dir)
+    assert index.pack(pack_dir).banner == pack_dir.joinpath("banner.jpg")
+
+
+def two_charts(title: str, second: str) -> str:
+    """An .sm file with a fixed first chart and `second` as the other."""
+    return (
+        f"#TITLE:{title};\n#BPMS:0=150;\n"
+        + "#NOTES:\n dance-single:\n :\n Easy:\n 3:\n 0,0,0,0,0:\n"
+        + "1000\n0100\n,\n0011\n;\n"
+        + "#NOTES:\n dance-single:\n :\n Hard:\n 9:\n 0,0,0,0,0:\n"
+        + f"{second};\n"
+    )
+
+
+def new_song(tmp_path: Path, name: str, text: str) -> SimfileHeader:
+    song_dir = tmp_path.joinpath("new", name)
+    song_dir.mkdir(parents=True)
+    song_dir.joinpath("song.sm").write_text(text)
+    return read_headers(song_dir.joinpath("song.sm"), fingerprints=True)
+
+
+def test_duplicates_share_charts(tmp_path, index, packs):
+    song_dir = packs.joinpath("Pack", "Song")
+    song_dir.mkdir(parents=True)
+    song_dir.joinpath("song.sm").write_text(two_charts("Old", "1111\n"))
+    index.refresh()
+
+    # Reformatted, renamed and retimed, but the same charts
+    same = new_song(
+        tmp_path,
+        "Same",
+        two_charts("New", "1111\n0000\n,\n0000\n").replace("150", "151"),
+    )
+    edited = new_song(tmp_path, "Edited", two_charts("Old", "1001\n"))
+    unrelated = new_song(
+        tmp_path,
+        "Unrelated",
+        two_charts("Old", "1001\n").replace("0011", "1100"),
+    )
+    duplicates = index.duplicates([same, edited, unrelated])
+    assert sorted(
+        (d.new.dir.name, d.existing.dir, d.shared_charts, d.identical)
+        for d in duplicates
+    ) == [("Edited", song_dir, 1, False), ("Same", song_dir, 2, True)]
+
+
+def test_duplicates_ignore_the_install_destination(tmp_path, index, packs):
+    song_dir = packs.joinpath("Pack", "Song")
+    song_dir.mkdir(parents=True)
+    song_dir.joinpath("song.sm").write_text(two_charts("Old", "1111\n"))
+    index.refresh()
+    new = new_song(tmp_path, "Song", two_charts("Old", "1111\n"))
+    assert len(index.duplicates([new])) == 1
+    # Replacing the pack (or just the song) isn't duplicating it
+    assert index.duplicates([new], exclude=packs.joinpath("Pack")) == []
+    assert index.duplicates([new], exclude=song_dir) == []
+    # Unlike installing into a pack with a similar name
+    assert len(index.duplicates([new], exclude=packs.joinpath("Pa"))) == 1
+
+
+def test_trusted_snapshots_still_see_changed_song_dirs(index, packs, parsed):
+    pack_dir = packs.joinpath("Pack")
+    write_pack(random.Random(0), pack_dir, 3, 4, 1, 0, 0)
+    index.refresh()
+    index.save_snapshot()
+
+    # Swapped for an .ssc while the bot was down, leaving the pack's mtime
+    song_dir = pack_dir.joinpath("Song 001")
+    restore = keep_mtime(pack_dir)
+    song_dir.joinpath("song.sm").rename(song_dir.joinpath("song.ssc"))
+    restore()
+    parsed.clear()
+    assert index.take_snapshot()
+    index.refresh(trust_snapshot=True)
+    assert parsed == ["Song 001"]
+    assert index.simfile(song_dir).path == song_dir.joinpath("song.ssc")
+
+    # Nor is it parsed again next time
+    parsed.clear()
+    index.refresh(trust_snapshot=True)
+    assert parsed == []
@@ -0,0 +1,87 @@
+import random
+import shutil
+import sys
+import threading
+import time
+
+import pytest
+
+from benchmarks.synthetic import write_pack
+from itg_buddy.extensions.itg_cli import pipeline
+from itg_buddy.extensions.itg_cli.itg_cli import INSTALL_ECHO_SECONDS
+from itg_buddy.extensions.itg_cli.watcher import LibraryWatcher
+
+TIMEOUT = 10
+
+
+def record_indexing(cog, monkeypatch) -> list:
+    indexed = []
+    monkeypatch.setattr(cog, "_index_pack", indexed.append)
+    monkeypatch.setattr(cog, "_index_songs", lambda dirs: indexed.extend(dirs))
+    return indexed
+
+
+def test_changes_leave_the_callers_sets_alone(cog, machine, monkeypatch):
+    indexed = record_indexing(cog, monkeypatch)
+    gone_song = machine.joinpath("Songs", "Gone Pack", "Song")
+    pack_dirs, song_dirs = set(), {gone_song}
+    cog._apply_library_changes(pack_dirs, song_dirs)
+    assert indexed == [gone_song.parent]
+    assert (pack_dirs, song_dirs) == (set(), {gone_song})
+
+
+def test_installed_dirs_are_skipped_once(cog, machine, monkeypatch):
+    indexed = record_indexing(cog, monkeypatch)
+    pack_dir = machine.joinpath("Songs", "Installed Pack")
+    other = machine.joinpath("Songs", "Other Pack")
+    cog._record_install(pack_dir)
+    cog._apply_library_changes({pack_dir, other}, set())
+    assert indexed == [other]
+    # Later changes to it are someone else's
+    cog._apply_library_changes({pack_dir}, set())
+    assert indexed == [other, pack_dir]
+
+
+def test_old_installs_are_forgotten(cog, machine, monkeypatch):
+    indexed = record_indexing(cog, monkeypatch)
+    pack_dir = machine.joinpath("Songs", "Installed Pack")
+    cog._record_install(pack_dir)
+    cog.installed[pack_dir] -= 2 * INSTALL_ECHO_SECONDS
+    cog._apply_library_changes({pack_dir}, set())
+    assert indexed == [pack_dir]
+    assert cog.installed == {}
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="needs inotify"
+)
+def test_watcher_skips_promoted_packs(cog, machine, tmp_path, monkeypatch):
+    indexed = record_indexing(cog, monkeypatch)
+    done = threading.Event()
+    packs = machine.joinpath("Songs")
+    copied = packs.joinpath("Copied Pack")
+
+    def on_change(pack_dirs, song_dirs):
+        cog._apply_library_changes(pack_dirs, song_dirs)
+        if copied in indexed:
+            done.set()
+
+    watcher = LibraryWatcher(packs, on_change, debounce=0.1)
+    watcher.start()
+    try:
+        # An install: staged, recorded and renamed into place
+        staged = cog.staging.joinpath("Promoted Pack")
+        write_pack(random.Random(0), staged, 2, 4, 1, 0, 0)
+        promoted = packs.joinpath(staged.name)
+        cog._record_install(promoted)
+        pipeline.promote(staged, promoted, cog.staging)
+        time.sleep(0.3)
+        # A pack copied over by hand
+        source = tmp_path.joinpath("Copied Pack")
+        write_pack(random.Random(1), source, 2, 4, 1, 0, 0)
+        shutil.copytree(source, copied)
+        assert done.wait(TIMEOUT)
+    finally:
+        watcher.stop()
+    assert promoted not in indexed
+    assert indexed == [copied]
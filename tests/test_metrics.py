@@ -0,0 +1,31 @@
+import asyncio
+import socket
+
+import discord
+from discord.ext import commands
+
+from itg_buddy.extensions.itg_cli import ItgCliCog
+
+
+def test_cog_loads_without_metrics_if_the_port_is_taken(
+    machine, monkeypatch, caplog
+):
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+        monkeypatch.setenv("METRICS_PORT", str(port))
+        bot = commands.Bot(
+            command_prefix="!",
+            intents=discord.Intents.none(),
+            help_command=None,
+        )
+        cog = ItgCliCog(bot)
+
+        async def run():
+            await cog.cog_load()
+            await cog.cog_unload()
+
+        asyncio.run(run())
+    assert cog.metrics_server is None
+    assert f"Could not serve metrics on {port}" in caplog.text
@@ -0,0 +1,161 @@
+import random
+from pathlib import Path
+
+import pytest
+
+from benchmarks.synthetic import write_pack
+from itg_buddy.extensions.itg_cli import pipeline
+
+
+@pytest.fixture
+def packs(tmp_path) -> Path:
+    packs = tmp_path.joinpath("Songs")
+    packs.mkdir()
+    return packs
+
+
+@pytest.fixture
+def courses(tmp_path) -> Path:
+    courses = tmp_path.joinpath("Courses")
+    courses.mkdir()
+    return courses
+
+
+def extracted(tmp_path: Path, seed: int, crs: list[str]) -> tuple[Path, Path]:
+    """An extracted pack and the working directory it's in, with courses."""
+    working_dir = tmp_path.joinpath(f"work-{seed}")
+    pack_path = working_dir.joinpath("Pack")
+    write_pack(random.Random(seed), pack_path, 1, 4, 1, 0, 0)
+    for name in crs:
+        path = working_dir.joinpath("Courses", name)
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(f"#COURSE:{name};")
+    return pack_path, working_dir
+
+
+def install(tmp_path, packs, courses, seed, crs):
+    pack_path, working_dir = extracted(tmp_path, seed, crs)
+    return pipeline.install_pack(
+        pack_path, working_dir, packs, courses, lambda _q: True, False, True
+    )
+
+
+def test_overwriting_a_pack_replaces_its_courses(tmp_path, packs, courses):
+    install(tmp_path, packs, courses, 0, ["old.crs", "shared.crs"])
+    dest, num_courses = install(
+        tmp_path, packs, courses, 1, ["new.crs", "shared.crs"]
+    )
+    assert num_courses == 2
+    assert sorted(p.name for p in courses.joinpath("Pack").iterdir()) == [
+        "new.crs",
+        "shared.crs",
+    ]
+    assert dest.joinpath("Song 000").is_dir()
+    assert list(pipeline.staging_dir(packs).iterdir()) == []
+
+
+def test_courses_swap_in_the_packs_transaction(
+    tmp_path, packs, courses, monkeypatch
+):
+    install(tmp_path, packs, courses, 0, ["old.crs"])
+    swaps = []
+    swap = pipeline._swap
+
+    def dying(staged, dest, backup):
+        swaps.append(dest)
+        if dest.parent == courses:
+            raise SystemExit("Killed")
+        swap(staged, dest, backup)
+
+    monkeypatch.setattr(pipeline, "_swap", dying)
+    with pytest.raises(SystemExit):
+        install(tmp_path, packs, courses, 1, ["new.crs"])
+    assert swaps == [packs.joinpath("Pack"), courses.joinpath("Pack")]
+    monkeypatch.setattr(pipeline, "_swap", swap)
+
+    # The next start finishes the courses' half of the install
+    staging = pipeline.staging_dir(packs)
+    assert pipeline.recover_installs(staging) == swaps
+    assert [p.name for p in courses.joinpath("Pack").iterdir()] == ["new.crs"]
+    assert list(staging.iterdir()) == []
+
+
+def song(path: Path, title: str) -> Path:
+    path.mkdir(parents=True)
+    path.joinpath("song.sm").write_text(f"#TITLE:{title};")
+    return path
+
+
+def title(path: Path) -> str:
+    return path.joinpath("song.sm").read_text()
+
+
+@pytest.fixture
+def staging(packs) -> Path:
+    return pipeline.staging_dir(packs)
+
+
+def test_promote_replaces_dest(tmp_path, packs, staging):
+    dest = song(packs.joinpath("Song"), "Old")
+    pipeline.promote(song(tmp_path.joinpath("new"), "New"), dest, staging)
+    assert title(dest) == "#TITLE:New;"
+    assert list(staging.iterdir()) == []
+
+
+def test_swap_can_be_rerun(tmp_path, packs):
+    dest = song(packs.joinpath("Song"), "Old")
+    staged = song(tmp_path.joinpath("new"), "New")
+    backup = tmp_path.joinpath("backup")
+    for _ in range(2):
+        pipeline._swap(staged, dest, backup)
+    assert title(dest) == "#TITLE:New;"
+    assert title(backup) == "#TITLE:Old;"
+
+
+def killed_swap(steps: int):
+    """A _swap that dies after its first `steps` renames."""
+
+    def swap(staged, dest, backup):
+        if steps > 0:
+            dest.rename(backup)
+        raise SystemExit("Killed")
+
+    return swap
+
+
+@pytest.mark.parametrize(
+    "steps",
+    [
+        pytest.param(0, id="after-journal-write"),
+        pytest.param(1, id="after-dest-to-backup"),
+    ],
+)
+def test_recovery_finishes_interrupted_swaps(
+    tmp_path, packs, staging, monkeypatch, steps
+):
+    dest = song(packs.joinpath("Song"), "Old")
+    swap = pipeline._swap
+    monkeypatch.setattr(pipeline, "_swap", killed_swap(steps))
+    with pytest.raises(SystemExit):
+        pipeline.promote(song(tmp_path.joinpath("new"), "New"), dest, staging)
+    assert dest.exists() == (steps == 0)
+    monkeypatch.setattr(pipeline, "_swap", swap)
+
+    assert pipeline.recover_installs(staging) == [dest]
+    assert title(dest) == "#TITLE:New;"
+    assert list(staging.iterdir()) == []
+
+
+def test_recovery_deletes_leftovers_without_a_journal(
+    tmp_path, packs, staging
+):
+    dest = song(packs.joinpath("Song"), "Old")
+    # Died extracting, and while moving a download into its transaction
+    song(staging.joinpath("tmp-extract", "Song"), "Half")
+    txn = staging.joinpath(f"{pipeline.TRANSACTION_PREFIX}abc")
+    song(txn.joinpath("staged-0"), "New")
+    staging.joinpath("download.zip.part").write_bytes(b"PK")
+
+    assert pipeline.recover_installs(staging) == []
+    assert title(dest) == "#TITLE:Old;"
+    assert list(staging.iterdir()) == []
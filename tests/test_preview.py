@@ -0,0 +1,160 @@
+import asyncio
+import http.server
+import random
+import threading
+from functools import partial
+
+import pytest
+
+from benchmarks.synthetic import write_pack, write_song, write_zip
+from itg_buddy.extensions.itg_cli import preview, wrappers
+from itg_buddy.extensions.itg_cli.downloader import Downloader
+from itg_buddy.extensions.itg_cli.preview import (
+    PreviewUnavailable,
+    install_names,
+    preview_archive,
+)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    # Ignores Range headers and always sends the whole file
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def plain_server(tmp_path):
+    root = tmp_path.joinpath("plain")
+    root.mkdir()
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(QuietHandler, directory=str(root))
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.root = root
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_pack_preview_reads_only_the_listing_and_simfiles(
+    tmp_path, file_server
+):
+    pack_dir = tmp_path.joinpath("Preview Pack")
+    # Each simfile sits between a megabyte of audio
+    write_pack(random.Random(0), pack_dir, 6, 16, 3, 2_000, 1_000_000)
+    write_zip(pack_dir, file_server.root.joinpath("Preview Pack.zip"))
+
+    result = preview_archive(f"{file_server.url}/Preview Pack.zip")
+
+    assert (
+        result.size
+        == file_server.root.joinpath("Preview Pack.zip").stat().st_size
+    )
+    assert result.fetched < result.size / 4
+    assert result.pack_name == "Preview Pack"
+    assert result.song_name is None
+    assert sorted(s.title for s in result.simfiles) == [
+        f"Preview Pack Song {i:03d}" for i in range(6)
+    ]
+    assert all(len(s.charts) == 3 for s in result.simfiles)
+
+
+def test_song_preview_names_the_song(tmp_path, file_server):
+    song_dir = tmp_path.joinpath("Lone Song")
+    write_song(random.Random(0), song_dir, "Lone Song", 16, 2, 0, 0)
+    write_zip(song_dir, file_server.root.joinpath("song.zip"))
+
+    result = preview_archive(f"{file_server.url}/song.zip")
+
+    assert result.pack_name is None
+    assert result.song_name == "Lone Song"
+    assert [s.title for s in result.simfiles] == ["Lone Song"]
+
+
+def test_previews_share_the_downloaders_session(
+    tmp_path, file_server, monkeypatch
+):
+    song_dir = tmp_path.joinpath("Lone Song")
+    write_song(random.Random(0), song_dir, "Lone Song", 16, 2, 0, 0)
+    write_zip(song_dir, file_server.root.joinpath("song.zip"))
+    downloader = Downloader(tmp_path.joinpath("partial"), 1)
+    adapter = downloader.session.get_adapter(file_server.url)
+    monkeypatch.setattr(wrappers, "DOWNLOADER", downloader)
+
+    events = []
+    for _ in range(2):
+        result = asyncio.run(
+            wrappers.preview_stage(
+                f"{file_server.url}/song.zip", events.append
+            )
+        )
+        assert result.song_name == "Lone Song"
+    # Both previews went through the downloader's pool, which stays open
+    assert len(adapter.poolmanager.pools) == 1
+    assert downloader.session.get(f"{file_server.url}/song.zip").ok
+
+
+def test_preview_needs_a_zip(file_server):
+    file_server.root.joinpath("notes.zip").write_bytes(b"not a zip" * 100)
+    with pytest.raises(PreviewUnavailable) as info:
+        preview_archive(f"{file_server.url}/notes.zip")
+    assert isinstance(info.value.__cause__, Exception)
+
+
+def test_server_without_ranges_gives_no_preview(tmp_path, plain_server):
+    song_dir = tmp_path.joinpath("Lone Song")
+    write_song(random.Random(0), song_dir, "Lone Song", 16, 2, 0, 0)
+    write_zip(song_dir, plain_server.root.joinpath("song.zip"))
+    url = f"{plain_server.url}/song.zip"
+
+    with pytest.raises(PreviewUnavailable):
+        preview_archive(url)
+    events = []
+    assert asyncio.run(wrappers.preview_stage(url, events.append)) is None
+
+
+def test_drive_links_are_not_previewed():
+    assert not preview.can_preview(
+        "https://drive.google.com/file/d/abc123/view"
+    )
+    assert not preview.can_preview("/tmp/pack.zip")
+    assert preview.can_preview("https://example.com/pack.zip")
+
+
+@pytest.mark.parametrize(
+    "members, names",
+    [
+        (
+            ["Pack/Song A/a.sm", "Pack/Song B/b.ssc"],
+            ("Pack", None),
+        ),
+        (["Song/song.ssc"], (None, "Song")),
+        (["Pack/Song/song.sm"], ("Pack", "Song")),
+        (["song.sm"], (None, None)),
+        (["A/x.sm", "A/y.sm"], (None, "A")),
+        (
+            ["Big/1/a.sm", "Big/2/b.sm", "Small/3/c.sm"],
+            ("Big", None),
+        ),
+        ([], (None, None)),
+    ],
+)
+def test_install_names(members, names):
+    assert install_names(members) == names
+
+
+def test_simfile_members_prefers_ssc_and_skips_metadata():
+    names = [
+        "Pack/Song/song.sm",
+        "Pack/Song/song.ssc",
+        "Pack/Song/song.ogg",
+        "__MACOSX/Pack/Song/._song.sm",
+        "Pack/Other/._hidden.sm",
+        "Pack/Other/other.SM",
+    ]
+    assert sorted(preview.simfile_members(names)) == [
+        "Pack/Other/other.SM",
+        "Pack/Song/song.ssc",
+    ]
@@ -0,0 +1,136 @@
+import random
+from pathlib import Path
+
+import pytest
+
+from itg_buddy.extensions.itg_cli import search
+from itg_buddy.extensions.itg_cli.headers import ChartHeader, SimfileHeader
+from itg_buddy.extensions.itg_cli.search import SearchIndex, normalize
+
+PACKS = Path("/Songs")
+
+
+def header(
+    pack: str,
+    title: str,
+    artist: str = "Artist",
+    meters: tuple[str, ...] = (),
+    translit: str | None = None,
+) -> SimfileHeader:
+    song_dir = PACKS.joinpath(pack, title)
+    return SimfileHeader(
+        dir=song_dir,
+        path=song_dir.joinpath("song.sm"),
+        title=title,
+        titletranslit=translit,
+        artist=artist,
+        banner=None,
+        charts=[ChartHeader("dance-single", "Hard", m, None) for m in meters],
+    )
+
+
+def titles(index: SearchIndex, query: str) -> list[str]:
+    return [entry.title for entry in index.search(query)]
+
+
+@pytest.fixture
+def index() -> SearchIndex:
+    index = SearchIndex()
+    index.replace(
+        [
+            header("Pack A", "Butterfly", "smile.dk", ("9", "12")),
+            header("Pack A", "Max 300", "Ω", ("10", "14")),
+            header("Pack A", "Café Dance!", "DJ Go", ("5",)),
+            header("Pack B", "Dance Dance Revolution", "DE-SIRE", ("9",)),
+            header("Pack B", "Xepher", "Tatsh", ("13",)),
+            header("Pack B", "恋", "Artist", ("7",), translit="Koi"),
+        ]
+    )
+    return index
+
+
+def test_normalize():
+    assert normalize("  Café☆Dance!  ") == "cafe dance"
+
+
+def test_search_matches_word_prefixes_and_substrings(index):
+    assert titles(index, "butter") == ["Butterfly"]
+    assert titles(index, "utterf") == ["Butterfly"]
+    # Short words only match the starts of words
+    assert titles(index, "x") == ["Xepher"]
+    assert titles(index, "ep") == []
+    assert titles(index, "cafe") == ["Café Dance!"]
+    assert titles(index, "koi") == ["恋"]
+
+
+def test_search_needs_every_word(index):
+    assert titles(index, "revolution dance") == ["Dance Dance Revolution"]
+    # By artist and pack, too
+    assert titles(index, "dance dj") == ["Café Dance!"]
+    assert titles(index, "revolution pack b") == ["Dance Dance Revolution"]
+    assert titles(index, "dance xepher") == []
+    assert titles(index, "   ") == []
+
+
+def test_titles_starting_with_the_query_come_first(index):
+    index.replace([header("Pack C", "Another Dance", "Dance Masters")])
+    assert titles(index, "dance") == [
+        "Dance Dance Revolution",
+        "Another Dance",
+        "Café Dance!",
+    ]
+
+
+def test_numbers_match_meters(index):
+    assert titles(index, "9") == ["Butterfly", "Dance Dance Revolution"]
+    assert titles(index, "dance 9") == ["Dance Dance Revolution"]
+    # ...and numbers in titles
+    assert titles(index, "300") == ["Max 300"]
+    assert titles(index, "14 max") == ["Max 300"]
+
+
+def test_replace_drops_songs_removed_from_a_pack(index):
+    index.replace(
+        [header("Pack A", "Butterfly", "smile.dk", ("9",))],
+        pack_dirs=[PACKS.joinpath("Pack A")],
+    )
+    assert len(index) == 4
+    assert titles(index, "max") == []
+    assert titles(index, "12") == []
+    assert titles(index, "butterfly") == ["Butterfly"]
+
+
+def test_replace_updates_songs(index):
+    song_dir = PACKS.joinpath("Pack B", "Xepher")
+    index.replace(
+        [header("Pack B", "Xepher", "Tatsh", ("15",))], song_dirs=[song_dir]
+    )
+    assert len(index) == 6
+    assert titles(index, "13") == []
+    assert titles(index, "15") == ["Xepher"]
+    index.replace([], song_dirs=[song_dir])
+    assert index.get(song_dir) is None
+    assert titles(index, "xepher") == []
+
+
+@pytest.mark.parametrize("batch", [1, 100])
+def test_title_order_survives_updates(monkeypatch, batch):
+    # Small updates are made in place, big ones merged
+    monkeypatch.setattr(search, "MAX_INPLACE_UPDATES", 8)
+    rng = random.Random(0)
+    index = SearchIndex()
+    songs = {}
+    for _ in range(20):
+        added = [
+            header(f"Pack {rng.randrange(5)}", f"Song {rng.randrange(300)}")
+            for _ in range(batch)
+        ]
+        gone = rng.sample(sorted(songs), min(len(songs), batch // 2 + 1))
+        for song_dir in gone:
+            del songs[song_dir]
+        songs.update((sf.dir, sf) for sf in added)
+        index.replace(added, song_dirs=gone)
+        assert index._sorted == sorted(
+            (normalize(sf.title), index._ids[sf.dir]) for sf in songs.values()
+        )
+    assert len(index) == len(songs)
@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from itg_buddy.extensions.itg_cli.singleflight import (
+    SingleFlight,
+    normalize_url,
+)
+
+DRIVE_ID = "1AbC-d_E"
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("  https://Example.com/a.zip  ", "https://example.com/a.zip"),
+        ("http://example.com/a.zip#top", "https://example.com/a.zip"),
+        ("https://example.com/a.zip?v=2", "https://example.com/a.zip?v=2"),
+        (
+            "https://cdn.discordapp.com/attachments/1/2/a.zip?ex=1&is=2&hm=3",
+            "https://cdn.discordapp.com/attachments/1/2/a.zip",
+        ),
+        (f"https://drive.google.com/file/d/{DRIVE_ID}/view", "gdrive:"),
+        (f"https://drive.google.com/open?id={DRIVE_ID}", "gdrive:"),
+        (
+            f"https://drive.usercontent.google.com/download?id={DRIVE_ID}"
+            + "&export=download",
+            "gdrive:",
+        ),
+        ("  /srv/packs/a.zip ", "/srv/packs/a.zip"),
+    ],
+)
+def test_normalize_url(url, expected):
+    if expected == "gdrive:":
+        expected += DRIVE_ID
+    assert normalize_url(url) == expected
+
+
+def test_concurrent_runs_share_one_job():
+    flights = SingleFlight(60)
+    runs, waits = [], []
+
+    async def job(flight):
+        runs.append(flight)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def on_wait():
+        waits.append(None)
+
+    async def run():
+        return await asyncio.gather(
+            *(flights.run("key", job, on_wait) for _ in range(3))
+        )
+
+    assert asyncio.run(run()) == ["result"] * 3
+    assert len(runs) == 1
+    assert len(waits) == 2
+
+
+def test_recent_results_are_reused_until_they_expire():
+    runs = []
+
+    async def job(flight):
+        runs.append(flight)
+        return len(runs)
+
+    async def run(flights):
+        return [await flights.run("key", job) for _ in range(2)]
+
+    assert asyncio.run(run(SingleFlight(60))) == [1, 1]
+    runs.clear()
+    assert asyncio.run(run(SingleFlight(0))) == [1, 2]
+
+
+def test_recent_results_are_reused_while_still_valid():
+    valid = {1}
+
+    async def value(result):
+        return result
+
+    async def run():
+        flights = SingleFlight(60, still_valid=lambda result: result in valid)
+        results = []
+        for result in (1, 2, 3):
+            results.append(await flights.run("key", lambda _f: value(result)))
+        valid.clear()
+        results.append(await flights.run("key", lambda _f: value(4)))
+        return results
+
+    # 1 is reused until it's no longer valid
+    assert asyncio.run(run()) == [1, 1, 1, 4]
+
+
+def test_failures_are_shared_but_not_remembered():
+    runs = []
+
+    async def job(flight):
+        runs.append(flight)
+        await asyncio.sleep(0.01)
+        raise ValueError("broken")
+
+    async def run():
+        flights = SingleFlight(60)
+        results = await asyncio.gather(
+            flights.run("key", job),
+            flights.run("key", job),
+            return_exceptions=True,
+        )
+        with pytest.raises(ValueError):
+            await flights.run("key", job)
+        return results
+
+    results = asyncio.run(run())
+    assert [type(e) for e in results] == [ValueError, ValueError]
+    assert len(runs) == 2
+
+
+def test_claimed_keys_redirect_to_the_flight_holding_them():
+    waits = []
+
+    async def by_link(flight):
+        flight.claim(("sha256", "abc"))
+        await asyncio.sleep(0.05)
+        return "first"
+
+    async def by_mirror(flight):
+        await asyncio.sleep(0.01)
+        # Same archive from another link
+        flight.claim(("sha256", "abc"))
+        return "second"
+
+    async def on_wait():
+        waits.append(None)
+
+    async def run():
+        flights = SingleFlight(60)
+        results = await asyncio.gather(
+            flights.run("link", by_link),
+            flights.run("mirror", by_mirror, on_wait),
+        )
+        # Both links now map to the first flight's result
+        assert await flights.run("mirror", by_mirror) == "first"
+        return results
+
+    assert asyncio.run(run()) == ["first", "first"]
+    assert len(waits) == 1
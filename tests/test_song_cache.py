@@ -0,0 +1,117 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from itg_buddy.extensions.itg_cli import song_cache
+from itg_buddy.extensions.itg_cli.song_cache import (
+    CacheSweep,
+    entry_name,
+    invalidate_later,
+    invalidate_pack,
+    sweep,
+)
+
+SECOND = 1_000_000_000
+
+
+@pytest.fixture
+def packs(tmp_path) -> Path:
+    packs = tmp_path.joinpath("Songs")
+    packs.mkdir()
+    return packs
+
+
+@pytest.fixture
+def cache(tmp_path) -> Path:
+    cache = tmp_path.joinpath("Cache")
+    cache.joinpath("Songs").mkdir(parents=True)
+    return cache
+
+
+def song(packs: Path, pack: str, name: str) -> Path:
+    song_dir = packs.joinpath(pack, name)
+    song_dir.mkdir(parents=True)
+    song_dir.joinpath("song.sm").write_text(f"#TITLE:{name};")
+    return song_dir
+
+
+def entry(cache: Path, name: str, age: int = 0) -> Path:
+    """A cache entry written `age` seconds after now."""
+    path = cache.joinpath("Songs", name)
+    path.write_text("#TITLE:cached;")
+    mtime = time.time_ns() + age * SECOND
+    os.utime(path, ns=(mtime, mtime))
+    return path
+
+
+def entries(cache: Path) -> list[str]:
+    return sorted(os.listdir(cache.joinpath("Songs")))
+
+
+def test_entry_names_follow_the_song_path(packs):
+    assert entry_name(packs.joinpath("Pack", "Song")) == "Songs_Pack_Song"
+
+
+def test_sweep_removes_stale_and_orphaned_entries(packs, cache, monkeypatch):
+    # Checked a song at a time, across threads
+    monkeypatch.setattr(song_cache, "SWEEP_CHUNKSIZE", 1)
+    fresh, stale = song(packs, "Pack", "Fresh"), song(packs, "Pack", "Stale")
+    song(packs, "Pack", "Missing")
+    song(packs, ".itg-buddy-staging", "Staged")
+    entry(cache, entry_name(fresh), 10)
+    entry(cache, entry_name(stale), -10)
+    entry(cache, "Songs_Gone_Song")
+    entry(cache, "AdditionalSongs_Pack_Song")
+
+    result = sweep(cache, packs, workers=2)
+
+    assert result == CacheSweep(songs=3, fresh=1, stale=1, orphaned=1)
+    assert result.missing == 1
+    assert entries(cache) == ["AdditionalSongs_Pack_Song", "Songs_Pack_Fresh"]
+    # A second sweep finds nothing more to do
+    assert sweep(cache, packs) == CacheSweep(songs=3, fresh=1)
+
+
+def test_sweep_sees_edits_to_a_songs_files(packs, cache):
+    song_dir = song(packs, "Pack", "Song")
+    path = entry(cache, entry_name(song_dir), 10)
+    later = time.time_ns() + 20 * SECOND
+    os.utime(song_dir.joinpath("song.sm"), ns=(later, later))
+    assert sweep(cache, packs).stale == 1
+    assert not path.exists()
+
+
+def test_sweep_without_a_cache(packs, tmp_path):
+    song(packs, "Pack", "Song")
+    assert sweep(tmp_path.joinpath("Nowhere"), packs) == CacheSweep()
+
+
+def test_invalidate_pack_keeps_packs_with_longer_names(packs, cache):
+    song(packs, "Pack", "A")
+    song(packs, "Pack_A", "B")
+    song(packs, "Other", "C")
+    for name in ("Songs_Pack_A", "Songs_Pack_Old", "Songs_Pack_A_B"):
+        entry(cache, name)
+    entry(cache, "Songs_Other_C")
+
+    # "Songs_Pack_A_B" is song B of "Pack_A", not song "A_B" of "Pack"
+    assert invalidate_pack(cache, packs.joinpath("Pack")) == 2
+    assert entries(cache) == ["Songs_Other_C", "Songs_Pack_A_B"]
+
+
+def test_invalidate_later_removes_entries_in_the_background(packs, cache):
+    songs = [song(packs, "Singles", name) for name in ("A", "B", "C")]
+    song(packs, "Pack", "D")
+    for song_dir in songs:
+        entry(cache, entry_name(song_dir))
+    entry(cache, "Songs_Pack_D")
+    entry(cache, "Songs_Pack_Replaced")
+
+    invalidate_later(cache, songs[:2], packs.joinpath("Pack"))
+
+    deadline = time.monotonic() + 10
+    while entries(cache) != ["Songs_Singles_C"]:
+        assert time.monotonic() < deadline, entries(cache)
+        time.sleep(0.01)
@@ -0,0 +1,47 @@
+import asyncio
+import random
+import time
+from typing import Any, Awaitable
+
+from benchmarks.synthetic import write_pack
+
+# Longest the event loop may go without running while a summary is built
+MAX_LAG = 0.1
+HEARTBEAT = 0.005
+
+
+async def max_loop_lag(work: Awaitable) -> tuple[float, Any]:
+    """
+    Awaits `work`, returning the most a heartbeat task woke up late meanwhile
+    and `work`'s result.
+    """
+    lag = 0.0
+    done = False
+
+    async def heartbeat():
+        nonlocal lag
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(HEARTBEAT)
+            lag = max(lag, time.perf_counter() - start - HEARTBEAT)
+
+    task = asyncio.create_task(heartbeat())
+    try:
+        result = await work
+    finally:
+        done = True
+        await task
+    return lag, result
+
+
+def test_large_pack_summary_keeps_loop_responsive(cog, machine, user):
+    pack_dir = machine.joinpath("Songs", "Large Pack")
+    write_pack(random.Random(0), pack_dir, 150, 32, 5, 20_000, 0)
+
+    lag, (embed, file) = asyncio.run(
+        max_loop_lag(asyncio.to_thread(cog._pack_success, pack_dir, user))
+    )
+
+    assert embed.fields[0].name == "Contains 150 songs"
+    assert file is not None
+    assert lag < MAX_LAG, f"event loop was blocked for {lag:.3f} s"
@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+from itg_buddy.watchdog import LoopWatchdog
+
+
+def block_the_loop(seconds: float) -> None:
+    time.sleep(seconds)
+
+
+def test_stalls_are_counted_with_their_stack():
+    async def run():
+        watchdog = LoopWatchdog(0.1)
+        watchdog.start()
+        await asyncio.sleep(0.2)
+        block_the_loop(0.5)
+        # Let the heartbeat notice
+        await asyncio.sleep(0.2)
+        await watchdog.stop()
+        return watchdog.stats
+
+    stats = asyncio.run(run())
+    assert stats.stalls >= 1
+    assert stats.longest >= 0.3
+    assert stats.blocked >= stats.longest
+    assert "block_the_loop" in stats.last_stack
+    assert "time.sleep(seconds)" in stats.last_stack
+
+
+def test_awaiting_is_not_a_stall():
+    async def run():
+        watchdog = LoopWatchdog(1.0)
+        watchdog.start()
+        await asyncio.sleep(0.3)
+        await watchdog.stop()
+        return watchdog.stats
+
+    stats = asyncio.run(run())
+    assert stats.stalls == 0
+    assert stats.last_stack is None
@@ -0,0 +1,49 @@
+import operator
+import time
+
+import pytest
+
+from itg_buddy.extensions.itg_cli.worker import WorkerCrashed, WorkerPool
+
+TIMEOUT = 30
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(1)
+    yield pool
+    pool.shutdown()
+
+
+def wait_for_exit(worker) -> None:
+    deadline = time.monotonic() + TIMEOUT
+    while worker.alive and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not worker.alive
+
+
+def test_calls_get_their_own_kwargs(pool):
+    first = pool.submit(dict, kwargs={"a": 1})
+    assert first.future.result(TIMEOUT) == {"a": 1}
+    second = pool.submit(dict)
+    assert second.future.result(TIMEOUT) == {}
+
+
+def test_dead_worker_is_cleaned_up_and_replaced(pool):
+    dead = pool._workers[0]
+    dead.process.kill()
+    wait_for_exit(dead)
+
+    call = pool.submit(operator.add, (1, 2))
+    assert call.future.result(TIMEOUT) == 3
+    assert pool._workers[0] is not dead
+    assert dead.conn.closed
+    assert not dead.reader.is_alive()
+    assert dead.process.exitcode is not None
+
+
+def test_calls_on_a_dead_worker_fail(pool):
+    call = pool.submit(time.sleep, (TIMEOUT,))
+    pool._workers[0].process.kill()
+    with pytest.raises(WorkerCrashed):
+        call.future.result(TIMEOUT)
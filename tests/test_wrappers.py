@@ -0,0 +1,35 @@
+import asyncio
+from pathlib import Path
+
+from itg_buddy.extensions.itg_cli.wrappers import (
+    DESTINATION_LOCKS,
+    destination_lock,
+)
+
+
+def test_destination_locks_serialize_and_are_dropped():
+    dest = Path("Songs", "Pack")
+    steps = []
+
+    async def install(name: str):
+        async with destination_lock(dest):
+            steps.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            steps.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(install("a"), install("b"))
+        assert dest not in DESTINATION_LOCKS
+        # A new install gets a fresh lock
+        await install("c")
+
+    asyncio.run(main())
+    assert steps == [
+        "a start",
+        "a end",
+        "b start",
+        "b end",
+        "c start",
+        "c end",
+    ]
+    assert len(DESTINATION_LOCKS) == 0